@@ -0,0 +1,126 @@
+"""
+Command line entry point
+
+    python -m fMRI decode|encode|pack|bench|batch [options]
+
+decode and encode run the analyses as staged, checkpointed pipelines:
+fetch -> mask -> clean -> select -> fit -> score -> render. A rerun skips
+the completed stages and resumes an interrupted fit at the last finished
+task. pack preprocesses the runs into one .npz file, bench runs an
+analysis without checkpoints and reports the cost of every stage (with
+--compare-reductions, the time and accuracy of decoding with each
+reduction of the design). batch runs an analysis on every subject of a
+manifest.
+"""
+
+import os
+import sys
+import argparse
+
+import numpy as np
+
+# The modules of this project are imported as top-level modules, as when
+# running the scripts from this directory.
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import batch
+import instrument
+import pipeline
+
+
+def _analysis(name):
+    if name == 'decode':
+        import decode
+        return decode
+    import encode
+    return encode
+
+
+def _format_tradeoff(rows):
+    """Text table of (reduction, reduce time, fit time, summary) rows."""
+    names = sorted(rows[0][3])
+    lines = ['%-10s %10s %10s' % ('reduction', 'reduce (s)', 'fit (s)') +
+             ''.join(' %14s' % name[:14] for name in names)]
+    for reduction, reduce_time, fit_time, summary in rows:
+        lines.append('%-10s %10.2f %10.2f' % (reduction, reduce_time,
+                                               fit_time) +
+                     ''.join(' %14.3f' % np.mean(summary[name])
+                             for name in names))
+    return '\n'.join(lines)
+
+
+def bench(args, parser=None):
+    """Run an analysis with instrumentation and print the stage costs."""
+    if args.compare_reductions and args.analysis != 'decode':
+        # The voxels are the targets of the encoding models
+        raise ValueError('Reductions only apply to decoding, '
+                         '--compare-reductions needs the decode analysis')
+    args.no_checkpoint = True
+    analysis = _analysis(args.analysis)
+    reductions = [args.reduction]
+    if args.compare_reductions:
+        reductions = [None, 'pca', 'parcels']
+    rows = []
+    for reduction in reductions:
+        args.reduction = reduction
+        name = args.analysis
+        if args.compare_reductions:
+            name += '_%s' % (reduction or 'none')
+        path = os.path.join(args.output_dir, 'bench_%s.json' % name)
+        instrument.enable(path, memory=args.trace_memory)
+        state = pipeline.execute(analysis.build, args, parser)
+        summary = instrument.summary()
+        print(instrument.format_summary(summary))
+        instrument.disable()
+        sys.stderr.write("Report written in %s\n" % path)
+        if args.compare_reductions:
+            durations = dict((row['name'], row['duration'])
+                             for row in summary)
+            rows.append((reduction or 'none', durations.get('reduce', 0.),
+                         durations.get('fit', 0.), analysis.summarize(state)))
+    if rows:
+        # Speed versus accuracy of the reductions of the design
+        print(_format_tradeoff(rows))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog='python -m fMRI',
+        description=__doc__, formatter_class=argparse.RawTextHelpFormatter)
+    commands = parser.add_subparsers(dest='command')
+    commands.required = True
+
+    parsers = {}
+    for name, help in [('decode', 'Reconstruct the stimuli from fMRI'),
+                       ('encode', 'Predict fMRI from the stimuli'),
+                       ('pack', 'Preprocess the runs into one .npz file')]:
+        parsers[name] = pipeline.add_arguments(
+            commands.add_parser(name, help=help))
+    bench_parser = pipeline.add_arguments(commands.add_parser(
+        'bench', help='Time the stages of an analysis'))
+    bench_parser.add_argument('analysis', nargs='?', default='decode',
+                              choices=('decode', 'encode'))
+    bench_parser.add_argument('--trace-memory', action='store_true',
+                              help='Also record the peak memory of the '
+                                   'stages, which slows them down')
+    bench_parser.add_argument('--compare-reductions', action='store_true',
+                              help='Decode without reduction, then with each '
+                                   'reduction, and compare time and accuracy')
+    parsers['bench'] = bench_parser
+    parsers['batch'] = batch.add_arguments(commands.add_parser(
+        'batch', help='Run an analysis on the subjects of a manifest'))
+
+    args = parser.parse_args(argv)
+    if args.command == 'bench':
+        bench(args, parsers['bench'])
+    elif args.command == 'batch':
+        batch.execute(args, parsers['batch'])
+    elif args.command == 'pack':
+        pipeline.execute(pipeline.build_pack, args, parsers['pack'])
+    else:
+        pipeline.execute(_analysis(args.command).build, args,
+                         parsers[args.command])
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,302 @@
+# *- encoding: utf-8 -*-
+"""
+Batch execution of an analysis over many subjects and sessions
+
+The subjects are listed in a JSON manifest:
+
+    [{"subject": "sub-01", "session": "ses-1",
+      "func": ["sub-01/run01.nii.gz", ...],
+      "label": ["sub-01/run01_label.csv", ...],
+      "mask": "sub-01/mask.nii.gz"},
+     ...]
+
+"label" may also be the .npz file written by ``python -m fMRI pack``,
+holding the bitpacked labels of all the runs. Relative paths are taken
+from the directory of the manifest. Without a "mask" key, or with the
+--epi-mask option, the brain mask is computed from the mean EPI of the
+runs, and cached by the fingerprint of the runs. Each entry runs the
+whole pipeline (masking, cleaning, decoding or encoding) in a worker
+process, with its own checkpoints. Workers are only started while the
+estimated memory of the running subjects fits in the memory budget.
+"""
+
+import os
+import sys
+import json
+import functools
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+
+import numpy as np
+import nibabel
+from sklearn.utils import Bunch
+
+import instrument
+import masking
+import outofcore
+import pipeline
+
+
+def load_manifest(path):
+    """Read and validate a manifest of (subject, runs, labels, mask).
+
+    Returns
+    -------
+    entries: list of dict
+        One entry per subject and session, paths made absolute, with an
+        'id' key combining subject and session.
+    """
+    with open(path) as f:
+        entries = json.load(f)
+    root = os.path.dirname(os.path.abspath(path))
+    ids = set()
+    for entry in entries:
+        for key in ('subject', 'func', 'label'):
+            if key not in entry:
+                raise ValueError('Manifest entry %r has no %r key'
+                                 % (entry.get('subject'), key))
+        if isinstance(entry['label'], str):
+            # Packed labels of all the runs
+            entry['label'] = os.path.join(root, entry['label'])
+        elif len(entry['func']) != len(entry['label']):
+            raise ValueError('Subject %s: %d runs but %d label files'
+                             % (entry['subject'], len(entry['func']),
+                                len(entry['label'])))
+        else:
+            entry['label'] = [os.path.join(root, f) for f in entry['label']]
+        entry['func'] = [os.path.join(root, f) for f in entry['func']]
+        if entry.get('mask') is not None:
+            entry['mask'] = os.path.join(root, entry['mask'])
+        entry['id'] = '_'.join([entry['subject']] +
+                               ([entry['session']] if 'session' in entry
+                                else []))
+        if entry['id'] in ids:
+            raise ValueError('Duplicate manifest entry %s' % entry['id'])
+        ids.add(entry['id'])
+    return entries
+
+
+def estimate_memory(entry, prefetch=0):
+    """Rough peak memory, in bytes, of the preprocessing of one entry.
+
+    Only headers are read. Masking holds one full run in memory, plus the
+    prefetch runs read ahead, then the masked runs exist in up to three
+    float32 copies (masked, cleaned and stacked training set). Without a
+    mask, all the voxels of the volume are counted.
+    """
+    n_voxels = None
+    if entry.get('mask') is not None:
+        n_voxels = np.count_nonzero(nibabel.load(entry['mask']).get_data())
+    largest_run, n_scans = 0, 0
+    for path in entry['func']:
+        img = nibabel.load(path)
+        shape = img.shape
+        n_scans += shape[3] if len(shape) > 3 else 1
+        largest_run = max(largest_run, int(np.prod(shape)) *
+                          max(img.get_data_dtype().itemsize, 4))
+        if n_voxels is None:
+            n_voxels = int(np.prod(shape[:3]))
+    return (1 + prefetch) * largest_run + 3 * 4 * n_scans * n_voxels
+
+
+def run_bounded(func, jobs, costs, n_jobs, budget):
+    """Run func(job) for all jobs in a process pool under a memory budget.
+
+    A job is started only if its cost, added to the cost of the running
+    jobs, fits in the budget. A job costing more than the whole budget is
+    run alone.
+
+    Returns
+    -------
+    results: list
+        Result of every job, in the order of jobs.
+    """
+    results = [None] * len(jobs)
+    # Largest jobs first, so that small ones fill the remaining memory
+    pending = sorted(range(len(jobs)), key=lambda i: -costs[i])
+    running = {}
+    # The spans of the workers are merged in the profile
+    func = instrument.remote(func)
+    with ProcessPoolExecutor(n_jobs) as executor:
+        while pending or running:
+            used = sum(costs[i] for i in running.values())
+            for i in list(pending):
+                if len(running) >= n_jobs:
+                    break
+                if running and used + costs[i] > budget:
+                    continue
+                running[executor.submit(func, jobs[i])] = i
+                used += costs[i]
+                pending.remove(i)
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                results[running.pop(future)] = instrument.merge(
+                    future.result())
+    return results
+
+
+def _analysis(name):
+    if name == 'decode':
+        import decode
+        return decode
+    import encode
+    return encode
+
+
+def manifest_fetch_stage(entry, state, pipe):
+    """Fetch stage taking the files of a manifest entry.
+
+    The mask is computed from the runs if the entry has none or with the
+    epi_mask option.
+    """
+    mask = entry.get('mask')
+    if mask is None or pipe.options.get('epi_mask'):
+        mask = pipeline.epi_mask(entry['func'], pipe)
+    dataset = Bunch(func=entry['func'], label=entry['label'], mask=mask)
+    return dict(dataset=dataset, func=entry['func'], label=entry['label'])
+
+
+def subject_pipeline(analysis_name, entry, options):
+    """Pipeline of the analysis of one manifest entry."""
+    analysis = _analysis(analysis_name)
+    options = dict(options, n_jobs=1,
+                   output_dir=os.path.join(options['output_dir'], entry['id']))
+    checkpoint_dir = None
+    if not options.get('no_checkpoint'):
+        checkpoint_dir = os.path.join(options['checkpoint_dir'], entry['id'])
+    # The identity of the files, not only their paths, keys the checkpoints
+    label = entry['label']
+    inputs = entry['func'] + ([label] if isinstance(label, str) else label)
+    if entry.get('mask') is not None:
+        inputs = inputs + [entry['mask']]
+    stages = [pipeline.Stage('fetch',
+                             functools.partial(manifest_fetch_stage, entry),
+                             dict(func=entry['func'], label=entry['label'],
+                                  mask=entry.get('mask'),
+                                  epi_mask=options.get('epi_mask', False),
+                                  inputs=masking.files_fingerprint(inputs)))]
+    out_of_core = options.get('out_of_core', False)
+    stages += pipeline.preprocessing_stages(
+        out_of_core=out_of_core,
+        interpolation=options.get('interpolation'))[1:]
+    stages += analysis.analysis_stages(nested=options.get('nested', False),
+                                       out_of_core=out_of_core,
+                                       reduction=options.get('reduction'),
+                                       stability=options.get('stability', 0),
+                                       resampling=options.get('resampling',
+                                                           'subsample'),
+                                       bundle=options.get('bundle'),
+                                       resample_maps=options.get(
+                                           'resample_maps', False),
+                                       rsa=options.get('rsa'),
+                                       searchlight=options.get(
+                                           'searchlight', 0),
+                                       output_dir=options['output_dir'],
+                                       compress_maps=options.get(
+                                           'compress_maps', False),
+                                       lags=options.get('lags'))
+    return pipeline.Pipeline(analysis_name, stages,
+                             checkpoint_dir=checkpoint_dir, options=options)
+
+
+def run_subject(job):
+    """Run the analysis of one manifest entry, return its summary."""
+    analysis_name, entry, options = job
+    pipe = subject_pipeline(analysis_name, entry, options)
+    options = pipe.options
+    if options.get('restart_from'):
+        pipe.invalidate(options['restart_from'])
+    skip = ['render'] if options.get('no_plots') else []
+    return _analysis(analysis_name).summarize(pipe.run(skip=skip))
+
+
+def run_batch(manifest, analysis='decode', options=None, n_jobs=1,
+              memory=None):
+    """Run an analysis on every entry of a manifest and stack the results.
+
+    Parameters
+    ----------
+    manifest: string
+        Path of the JSON manifest.
+
+    analysis: 'decode' or 'encode'
+
+    options: dict, optional
+        Pipeline options (see pipeline.add_arguments).
+
+    n_jobs: int
+        Maximum number of subjects processed at once.
+
+    memory: int, optional
+        Memory budget in bytes. Default: 75% of the physical memory.
+
+    Returns
+    -------
+    group: dict
+        Group-level arrays of shape (n_subjects, ...) for every result of
+        the analysis summary, plus the 'subjects' ids.
+    """
+    options = dict(options or {})
+    options.setdefault('output_dir', 'output')
+    options.setdefault('checkpoint_dir', 'checkpoints')
+    entries = load_manifest(manifest)
+    if memory is None:
+        memory = int(.75 * outofcore.available_memory())
+    with instrument.span('estimate_memory'):
+        costs = [estimate_memory(entry, options.get('prefetch') or 0)
+                 for entry in entries]
+    sys.stderr.write("Batch %s: %d entries, largest needs %.1f GB, "
+                     "budget %.1f GB\n" % (analysis, len(entries),
+                                           max(costs) / 1024. ** 3,
+                                           memory / 1024. ** 3))
+
+    # Out of core, every subject streams its data within its share, and
+    # so are the CPUs rendering the figures
+    subject_options = dict(options, memory=memory // max(n_jobs, 1))
+    if not options.get('render_jobs'):
+        subject_options['render_jobs'] = max(
+            (os.cpu_count() or 1) // max(n_jobs, 1), 1)
+    jobs = [(analysis, entry, subject_options) for entry in entries]
+    with instrument.span('batch'):
+        if n_jobs == 1:
+            summaries = [run_subject(job) for job in jobs]
+        else:
+            summaries = run_bounded(run_subject, jobs, costs, n_jobs, memory)
+
+    group = {'subjects': np.array([entry['id'] for entry in entries])}
+    for key in summaries[0]:
+        shapes = set(np.shape(s[key]) for s in summaries)
+        if len(shapes) > 1:
+            raise ValueError('Cannot stack %s, shapes differ across '
+                             'subjects: %s' % (key, sorted(shapes)))
+        group[key] = np.stack([s[key] for s in summaries])
+    return group
+
+
+def add_arguments(parser):
+    """Options of the batch command."""
+    pipeline.add_arguments(parser)
+    parser.add_argument('manifest', help='JSON manifest of the subjects')
+    parser.add_argument('--analysis', choices=('decode', 'encode'),
+                        default='decode')
+    return parser
+
+
+def execute(args, parser=None):
+    """Run the batch command and save the group arrays.
+
+    The stage options are checked against the pipeline of the first
+    subject if the parser of the arguments is given.
+    """
+    options = vars(args)
+    entries = load_manifest(args.manifest)
+    if parser is not None and entries:
+        pipeline.check_stages(parser, args, subject_pipeline(
+            args.analysis, entries[0], options).stage_names())
+    group = run_batch(args.manifest, analysis=args.analysis,
+                      options=options, n_jobs=args.n_jobs, memory=args.memory)
+    if not os.path.exists(args.output_dir):
+        os.makedirs(args.output_dir)
+    path = os.path.join(args.output_dir, 'group_%s.npz' % args.analysis)
+    np.savez(path, **group)
+    sys.stderr.write("Group results written in %s\n" % path)
+    return group
@@ -0,0 +1,148 @@
+# *- encoding: utf-8 -*-
+"""
+Decoder bundles: fitted decoders of all the pixels, for deployment
+
+A bundle is a directory holding the decoders of every pixel stacked in
+one float32 weight matrix, so that decoding new scans is a single matrix
+product:
+
+  * weights.npy, shape (n_pixels, n_features): weights on the lagged
+    voxels, zero outside the voxels selected for each pixel;
+  * intercepts.npy, shape (n_pixels,);
+  * selected.npy, shape (n_pixels, k): voxels selected for each pixel;
+  * mask.npy: flat indices of the mask voxels in the volume;
+  * bundle.json: mask shape and affine, lags, image shape, cleaning
+    parameters and the kind of model.
+
+Arrays are memory-mapped when loading, which takes milliseconds whatever
+the size of the bundle.
+"""
+
+import os
+import json
+
+import numpy as np
+import nibabel
+
+import lags
+import preprocess
+
+
+class DecoderBundle(object):
+    """Stacked linear decoders of the pixels of the stimuli.
+
+    Parameters
+    ----------
+    weights: numpy.ndarray
+        Shape (n_pixels, n_features), n_features = n_lags * n_voxels.
+
+    intercepts: numpy.ndarray
+        Shape (n_pixels,).
+
+    selected: numpy.ndarray
+        Selected features of every pixel, shape (n_pixels, k).
+
+    mask: numpy.ndarray
+        Flat indices of the mask voxels in a volume of shape
+        meta['mask_shape'].
+
+    meta: dict
+        'mask_shape', 'affine', 'lags', 'y_shape', 'clean' (parameters of
+        preprocess.clean), 'model' (name) and 'classifier' (bool).
+    """
+
+    def __init__(self, weights, intercepts, selected, mask, meta):
+        self.weights = weights
+        self.intercepts = intercepts
+        self.selected = selected
+        self.mask = mask
+        self.meta = meta
+
+    def mask_img(self):
+        """Mask of the voxels, as a nibabel image."""
+        shape = tuple(self.meta['mask_shape'])
+        data = np.zeros(int(np.prod(shape)), dtype=np.int8)
+        data[self.mask] = 1
+        return nibabel.Nifti1Image(data.reshape(shape),
+                                   np.array(self.meta['affine']))
+
+    def design(self, runs):
+        """Cleaned, lagged design of masked runs.
+
+        Returns
+        -------
+        X: numpy.ndarray, shape (n_rows, n_features)
+
+        rows: numpy.ndarray
+            Scans described by the rows of X, in stacked coordinates.
+        """
+        runs = [preprocess.clean(run, **self.meta['clean']) for run in runs]
+        data, run_lengths = lags.stack_runs(runs, dtype=np.float32)
+        rows = lags.lagged_rows(run_lengths, self.meta['lags'][-1])
+        return lags.take(lags.lag_windows(data, self.meta['lags']), rows), rows
+
+    def decision_function(self, X):
+        """Scores of every pixel, shape (n_samples, n_pixels)."""
+        X = np.asarray(X, dtype=np.float32)
+        if X.shape[1] != self.weights.shape[1]:
+            raise ValueError('Bundle expects %d features, got %d'
+                             % (self.weights.shape[1], X.shape[1]))
+        # One product for all the pixels
+        scores = np.dot(X, self.weights.T)
+        scores += self.intercepts
+        return scores
+
+    def predict(self, X):
+        """Stimuli of the rows of X, shape (n_samples,) + y_shape, 0/1."""
+        scores = self.decision_function(X)
+        threshold = 0. if self.meta['classifier'] else .5
+        return (scores > threshold).astype(np.uint8).reshape(
+            (-1,) + tuple(self.meta['y_shape']))
+
+    def save(self, path):
+        """Write the bundle in directory path."""
+        if not os.path.exists(path):
+            os.makedirs(path)
+        for name in ('weights', 'intercepts', 'selected', 'mask'):
+            np.save(os.path.join(path, name + '.npy'), getattr(self, name))
+        with open(os.path.join(path, 'bundle.json'), 'w') as f:
+            json.dump(self.meta, f, indent=2)
+        return path
+
+
+def load(path, mmap_mode='r'):
+    """Bundle of directory path, with its arrays memory-mapped."""
+    with open(os.path.join(path, 'bundle.json')) as f:
+        meta = json.load(f)
+    arrays = [np.load(os.path.join(path, name + '.npy'), mmap_mode=mmap_mode)
+              for name in ('weights', 'intercepts', 'selected', 'mask')]
+    return DecoderBundle(*arrays, meta=meta)
+
+
+def from_fits(fits, mask_img, meta):
+    """Bundle of the decoders fitted on every pixel.
+
+    Parameters
+    ----------
+    fits: list of (coef, intercept, selected)
+        One per pixel: weights on the selected features, intercept and
+        selected features.
+
+    mask_img: string or nibabel image
+
+    meta: dict
+        See DecoderBundle, without the mask geometry.
+    """
+    if isinstance(mask_img, str):
+        mask_img = nibabel.load(mask_img)
+    mask = mask_img.get_data() != 0
+    n_features = mask.sum() * len(meta['lags'])
+    weights = np.zeros((len(fits), n_features), dtype=np.float32)
+    for pixel, (coef, _, selected) in enumerate(fits):
+        weights[pixel, selected] = coef
+    meta = dict(meta, mask_shape=list(mask.shape),
+                affine=np.asarray(mask_img.get_affine()).tolist())
+    return DecoderBundle(
+        weights, np.array([fit[1] for fit in fits], dtype=np.float32),
+        np.array([fit[2] for fit in fits], dtype=np.int32),
+        np.flatnonzero(mask).astype(np.int32), meta)
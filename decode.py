@@ -1,78 +1,43 @@
-from matplotlib.colors import LinearSegmentedColormap
+"""
+Decoding: reconstruction of the visual stimuli from fMRI, pixel by pixel
 
-import matplotlib as mpl
-mpl.use('TkAgg')
+Run with ``python decode.py`` or ``python -m fMRI decode``. Stages are
+checkpointed, a rerun resumes where the previous one stopped.
+"""
 
-import numpy as np
+import os
 import sys
-import time
-
-bluegreen = LinearSegmentedColormap('bluegreen', {
-    'red': ((0., 0., 0.),
-            (1., 0., 0.)),
-    'green': ((0., 0., 0.),
-              (1., 1., 1.)),
-    'blue': ((0., 0.2, 0.2),
-             (0.5, 0.5, 0.5),
-             (1., 0., 0.))
-    })
-
-### Load the Miyawaki dataset #####################################################
-import datasets
-dataset = datasets.get_miyawaki()
-
-# Keep only random runs
-X_random = dataset.func[12:]
-y_random = dataset.label[12:]
-y_shape = (10, 10)
+import argparse
 
-### Preprocess data ###########################################################
-import masking, preprocess
+import numpy as np
 import nibabel
 
-sys.stderr.write("Preprocessing data...")
-t0 = time.time()
-
-# Load and mask fMRI data
-
-X_train = []
-for x_random in X_random:
-    # Mask data
-    x_img = nibabel.load(x_random)
-    x = masking.apply_mask(x_img, dataset.mask)
-    x = preprocess.clean(x)
-    X_train.append(x)
-
-# Load target data
-y_train = []
-for y in y_random:
-    y_train.append(np.reshape(np.loadtxt(y, dtype=np.int, delimiter=','),
-                              (-1,) + y_shape, order='F'))
-
-X_train = [x[3:] for x in X_train]
-y_train = [y[:-3] for y in y_train]
-
-X_train = np.vstack(X_train)
-y_train = np.vstack(y_train).astype(np.float)
-
-# Remove rest period
-X_train = X_train[y_train[:, 0, 0] != -1]
-y_train = y_train[y_train[:, 0, 0] != -1]
-
-y_train = np.reshape(y_train, (-1, y_shape[0] * y_shape[1]))
-
-sys.stderr.write(" Done (%.2fs)\n" % (time.time() - t0))
-
-### Prediction function #######################################################
-import pylab as pl
-import os
-
+from sklearn.base import clone, is_classifier
 from sklearn.svm import LinearSVC
 from sklearn.linear_model import LogisticRegression as LogR
 from sklearn.linear_model import LinearRegression as LinR
+from sklearn.linear_model import SGDClassifier, SGDRegressor
 from sklearn.feature_selection import f_classif, SelectKBest
+from sklearn.pipeline import Pipeline
+from sklearn.model_selection import cross_val_score
+from sklearn.utils import Bunch
+
+import bundle
+import instrument
+import labels
+import lags
+import masking
+import nested
+import outofcore
+import pipeline
+import reduction
+import rendering
+import rsa
+import splits
+import stability
+import volumes
 
-sys.stderr.write("Single pixel prediction\n")
+y_shape = (10, 10)
 
 # Pixel chosen for the study
 p = (4, 2)
@@ -80,245 +45,641 @@ p = (4, 2)
 # Get index of the chosen pixel in flattened array
 i_p = 42
 
-# Logistic Regression
-sys.stderr.write("\tLogistic regression...")
-t0 = time.time()
-cache_path = os.path.join('output', 'logr_coef.npy')
-logr = LogR(penalty='l1', C=0.05)
-logr.fit(X_train, y_train[:, i_p])
-np.save(cache_path, logr.coef_)
-logr_coef = np.load(cache_path)
-sys.stderr.write(" Done (%.2fs)\n" % (time.time() - t0))
-
-# Linear Regression
-sys.stderr.write("\tLinear regression...")
-t0 = time.time()
-cache_path = os.path.join('output', 'logr_coef.npy')
-linr = LinR(normalize=True)
-linr.fit(X_train, y_train[:, i_p])
-np.save(cache_path, logr.coef_)
-linr_coef = np.load(cache_path)
-sys.stderr.write(" Done (%.2fs)\n" % (time.time() - t0))
-
-# Support Vector Classifier
-sys.stderr.write("\tSupport vector classifier...")
-t0 = time.time()
-cache_path = os.path.join('output', 'svc_coef.npy')
-svc = LinearSVC(penalty='l1', dual=False, C=0.01)
-svc.fit(X_train, y_train[:, i_p])
-np.save(cache_path, svc.coef_)
-svc_coef = np.load(cache_path)
-sys.stderr.write(" Done (%.2fs)\n" % (time.time() - t0))
-
-### Output ###################################################################
-from matplotlib.lines import Line2D
-
-# Create masks for contour
-### Mask of chosen voxels
-contour = np.zeros(nibabel.load(dataset.mask).shape, dtype=bool)
-for x, y in [(31, 9), (31, 10), (30, 10), (32, 10)]:
-    contour[x, y, 10] = 1
-### Mask of chosen pixel
-pixmask = np.zeros((10, 10), dtype=bool)
-pixmask[p] = 1
-
-
-def plot_lines(mask, linewidth=3, color='b'):
-    for i, j in np.ndindex(mask.shape):
-        if i + 1 < mask.shape[0] and mask[i, j] != mask[i + 1, j]:
-            pl.gca().add_line(Line2D([j - .5, j + .5], [i + .5, i + .5],
-                color=color, linewidth=linewidth))
-        if j + 1 < mask.shape[1] and mask[i, j] != mask[i, j + 1]:
-            pl.gca().add_line(Line2D([j + .5, j + .5], [i - .5, i + .5],
-                color=color, linewidth=linewidth))
-
-
-fig = pl.figure(figsize=(8, 8))
-ax1 = pl.axes([0., 0., 1., 1.])
-sbrain = masking.unmask(logr_coef[0], dataset.mask)
-bg = nibabel.load(os.path.join('bg.nii.gz'))
-pl.imshow(bg.get_data()[:, :, 10].T, interpolation="nearest", cmap='gray',
-          origin='lower')
-pl.imshow(np.ma.masked_equal(sbrain[:, :, 10].T, 0.), interpolation="nearest",
-          cmap=bluegreen, origin='lower', vmin=0., vmax=2.6)
-plot_lines(contour[:, :, 10].T, color='r')
-pl.axis('off')
-ax2 = pl.axes([.1, .5, .05, .45])
-cb = pl.colorbar(cax=ax2, ax=ax1)
-cb.ax.yaxis.set_ticks_position('left')
-cb.ax.yaxis.set_tick_params(labelcolor='white')
-cb.ax.yaxis.set_tick_params(labelsize=32)
-cb.set_ticks([0., 1.3, 2.6])
-pl.savefig(os.path.join('output', 'decoding_pixel_logistic.pdf'))
-pl.savefig(os.path.join('output', 'decoding_pixel_logistic.png'))
-pl.savefig(os.path.join('output', 'decoding_pixel_logistic.eps'))
-sys.stderr.write("Logistic regression: %d nonzero voxels\n" %
-        np.sum(logr_coef != 0.))
-pl.close()
-
-fig = pl.figure(figsize=(8, 8))
-ax1 = pl.axes([0., 0., 1., 1.])
-sbrain = masking.unmask(linr_coef[0], dataset.mask)
-bg = nibabel.load(os.path.join('bg.nii.gz'))
-pl.imshow(bg.get_data()[:, :, 10].T, interpolation="nearest", cmap='gray',
-          origin='lower')
-pl.imshow(np.ma.masked_equal(sbrain[:, :, 10].T, 0.), interpolation="nearest",
-          cmap=bluegreen, origin='lower', vmin=0., vmax=2.6)
-plot_lines(contour[:, :, 10].T, color='r')
-pl.axis('off')
-ax2 = pl.axes([.1, .5, .05, .45])
-cb = pl.colorbar(cax=ax2, ax=ax1)
-cb.ax.yaxis.set_ticks_position('left')
-cb.ax.yaxis.set_tick_params(labelcolor='white')
-cb.ax.yaxis.set_tick_params(labelsize=32)
-cb.set_ticks([0., 1.3, 2.6])
-pl.savefig(os.path.join('output', 'decoding_pixel_linear.pdf'))
-pl.savefig(os.path.join('output', 'decoding_pixel_linear.png'))
-pl.savefig(os.path.join('output', 'decoding_pixel_linear.eps'))
-sys.stderr.write("Linear regression: %d nonzero voxels\n" %
-        np.sum(logr_coef != 0.))
-pl.close()
-
-fig = pl.figure(figsize=(8, 8))
-ax1 = pl.axes([0., 0., 1., 1.])
-sbrain = masking.unmask(svc_coef[0], dataset.mask)
-vmax = np.max(np.abs(sbrain[:, :, 10].T))
-pl.imshow(bg.get_data()[:, :, 10].T, interpolation="nearest", cmap='gray',
-          origin='lower')
-pl.imshow(np.ma.masked_equal(sbrain[:, :, 10].T, 0.), interpolation="nearest",
-          cmap=bluegreen, origin='lower', vmin=0., vmax=1.0)
-plot_lines(contour[:, :, 10].T, color='r')
-pl.axis('off')
-ax2 = pl.axes([.1, .5, .05, .45])
-cb = pl.colorbar(cax=ax2, ax=ax1)
-cb.ax.yaxis.set_ticks_position('left')
-cb.ax.yaxis.set_tick_params(labelcolor='white')
-cb.ax.yaxis.set_tick_params(labelsize=28)
-cb.set_ticks([0., .5, 1.])
-pl.savefig(os.path.join('output', 'pixel_svc.pdf'))
-pl.savefig(os.path.join('output', 'pixel_svc.png'))
-pl.savefig(os.path.join('output', 'pixel_svc.eps'))
-sys.stderr.write("SVC: %d nonzero voxels\n" % np.sum(logr_coef != 0.))
-pl.close()
-
-
-### Calcualte the Cross Validation Scores ###################################################
-from sklearn.cross_validation import cross_val_score
-from sklearn.pipeline import Pipeline
-from sklearn.externals.joblib import Parallel, delayed
-
-pipeline_LogR = Pipeline([('selection', SelectKBest(f_classif, 500)),
-                     ('clf', LogR(penalty="l1", C=0.05))])
-pipeline_LinR = Pipeline([('selection', SelectKBest(f_classif, 500)),
-                     ('clf', LinR(normalize=True))])
-pipeline_SVC = Pipeline([('selection', SelectKBest(f_classif, 500)),
-                     ('clf', LinearSVC(penalty='l1', dual=False, C=0.01))])
-pipeline_SVCL2 = Pipeline([('selection', SelectKBest(f_classif, 500)),
-                     ('clf', LinearSVC(penalty='l2', dual=False, C=0.001))])
-
-sys.stderr.write("Cross validation\n")
-
-sys.stderr.write("\tLogistic regression...")
-t0 = time.time()
-cache_path = os.path.join('output', 'logR_scores.npy')
-if not os.path.exists(cache_path):
-    scores_log = Parallel(n_jobs=1)(delayed(cross_val_score)(
-        pipeline_LogR, X_train, y, cv=5, verbose=True) for y in y_train.T)
-    np.save(cache_path, scores_log)
-logr_scores = np.load(cache_path)
-sys.stderr.write(" Done (%.2fs)\n" % (time.time() - t0))
-
-sys.stderr.write("\tLinear regression...")
-t0 = time.time()
-cache_path = os.path.join('output', 'linR_scores.npy')
-if not os.path.exists(cache_path):
-    scores_log = Parallel(n_jobs=1)(delayed(cross_val_score)(
-        pipeline_LinR, X_train, y, cv=5, verbose=True) for y in y_train.T)
-    np.save(cache_path, scores_log)
-linr_scores = np.load(cache_path)
-sys.stderr.write(" Done (%.2fs)\n" % (time.time() - t0))
-
-sys.stderr.write("\tSupport vector classifier...")
-t0 = time.time()
-cache_path = os.path.join('output', 'svc_scores.npy')
-if not os.path.exists(cache_path):
-    scores_svc = Parallel(n_jobs=1)(delayed(cross_val_score)(
-        pipeline_SVC, X_train, y, cv=5, verbose=True) for y in y_train.T)
-    np.save(cache_path, scores_svc)
-svc_scores = np.load(cache_path)
-sys.stderr.write(" Done (%.2fs)\n" % (time.time() - t0))
-
-sys.stderr.write("\tSupport vector classifier L2...")
-t0 = time.time()
-cache_path = os.path.join('output', 'svcl2_scores.npy')
-if not os.path.exists(cache_path):
-    scores_svcl2 = Parallel(n_jobs=1)(delayed(cross_val_score)(
-        pipeline_SVCL2, X_train, y, cv=5, verbose=True) for y in y_train.T)
-    np.save(cache_path, scores_svcl2)
-svcl2_scores = np.load(cache_path)
-sys.stderr.write(" Done (%.2fs)\n" % (time.time() - t0))
-
-### Output ####################################################################
-
-fig = pl.figure(figsize=(8, 8))
-pl.imshow(np.array(logr_scores).mean(1).reshape(10, 10),
-    interpolation="nearest", vmin=.3, vmax=1.)
-plot_lines(pixmask, linewidth=6)
-pl.axis('off')
-pl.hot()
-fig.subplots_adjust(bottom=0., top=1., left=0., right=1.)
-pl.savefig(os.path.join('output', 'decoding_scores_log.pdf'))
-pl.savefig(os.path.join('output', 'decoding_scores_log.eps'))
-print('Logistic Regression mean accuracy: %f' % logr_scores.mean())
-pl.close()
-
-fig = pl.figure(figsize=(8, 8))
-pl.imshow(np.array(linr_scores).mean(1).reshape(10, 10),
-    interpolation="nearest", vmin=.3, vmax=1.)
-plot_lines(pixmask, linewidth=6)
-pl.axis('off')
-pl.hot()
-fig.subplots_adjust(bottom=0., top=1., left=0., right=1.)
-pl.savefig(os.path.join('output', 'decoding_scores_lin.pdf'))
-pl.savefig(os.path.join('output', 'decoding_scores_lin.eps'))
-print('Linear Regression mean accuracy: %f' % linr_scores.mean())
-pl.close()
-
-fig = pl.figure(figsize=(8, 8))
-pl.imshow(np.array(svc_scores).mean(1).reshape(10, 10),
-        interpolation="nearest", vmin=.3, vmax=1.)
-plot_lines(pixmask, linewidth=6)
-pl.axis('off')
-pl.hot()
-fig.subplots_adjust(bottom=0., top=1., left=0., right=1.)
-pl.savefig(os.path.join('output', 'decoding_scores_svc.pdf'))
-pl.savefig(os.path.join('output', 'decoding_scores_svc.eps'))
-print('SVC L1 mean accuracy: %f' % svc_scores.mean())
-pl.close()
-
-
-fig = pl.figure(figsize=(8, 8))
-pl.imshow(np.array(svcl2_scores).mean(1).reshape(10, 10),
-        interpolation="nearest", vmin=.3, vmax=1.)
-plot_lines(pixmask, linewidth=6)
-pl.axis('off')
-pl.hot()
-fig.subplots_adjust(bottom=0., top=1., left=0., right=1.)
-pl.savefig(os.path.join('output', 'decoding_scores_svcl2.pdf'))
-pl.savefig(os.path.join('output', 'decoding_scores_svcl2.eps'))
-print('SVC L2 mean accuracy: %f' % svcl2_scores.mean())
-pl.close()
-
-### Colorbar #########################################################
-import matplotlib as mpl
-
-fig = pl.figure(figsize=(.6, 3.6))
-cmap = mpl.cm.hot
-norm = mpl.colors.Normalize(vmin=.3, vmax=1.)
-cb = mpl.colorbar.ColorbarBase(pl.gca(), cmap=cmap, norm=norm)
-# cb.ax.yaxis.set_ticks_position('left')
-cb.set_ticks(np.arange(0.3, 1.1, 0.1))
-fig.subplots_adjust(bottom=0.03, top=.97, left=0., right=.5)
-pl.savefig(os.path.join('output', 'decoding_scores_colorbar.png'))
-pl.savefig(os.path.join('output', 'decoding_scores_colorbar.pdf'))
-pl.savefig(os.path.join('output', 'decoding_scores_colorbar.eps'))
+# Delays, in scans, between the stimuli and the BOLD response. Several
+# evenly spaced lags make a FIR model of the response (--lags).
+hrf_lags = (3,)
+
+# Cross-validation folds, each testing on consecutive whole runs (one
+# fold per run if there are fewer runs)
+n_folds = 5
+
+# Principal components kept by the PCA reduction (--reduction pca)
+n_components = 200
+
+
+def f_classif_timed(X, y):
+    # Univariate scores of SelectKBest, timed as the feature selection stage
+    with instrument.span('feature_selection'):
+        return f_classif(X, y)
+
+
+# Models fitted on the chosen pixel, their weights are displayed
+estimators = [
+    ('logr', LogR(penalty='l1', C=0.05)),
+    ('linr', LinR(normalize=True)),
+    ('svc', LinearSVC(penalty='l1', dual=False, C=0.01)),
+]
+
+# Models cross-validated on every pixel
+pipelines = [
+    ('logR', Pipeline([('selection', SelectKBest(f_classif_timed, 500)),
+                       ('clf', LogR(penalty="l1", C=0.05))])),
+    ('linR', Pipeline([('selection', SelectKBest(f_classif_timed, 500)),
+                       ('clf', LinR(normalize=True))])),
+    ('svc', Pipeline([('selection', SelectKBest(f_classif_timed, 500)),
+                      ('clf', LinearSVC(penalty='l1', dual=False, C=0.01))])),
+    ('svcl2', Pipeline([('selection', SelectKBest(f_classif_timed, 500)),
+                        ('clf', LinearSVC(penalty='l2', dual=False,
+                                          C=0.001))])),
+]
+
+# Minibatch counterparts of the single pixel estimators, fitted on every
+# voxel out of core. The C of the models above becomes alpha = 1 / (C n).
+stream_estimators = [
+    ('logr', SGDClassifier(loss='log', penalty='l1'), 0.05),
+    ('linr', SGDRegressor(penalty='l2', alpha=1e-6), None),
+    ('svc', SGDClassifier(loss='squared_hinge', penalty='l1'), 0.01),
+]
+
+# Hyper-parameter grids searched by nested cross-validation (--nested):
+# ridge classifiers share one SVD per outer fold, the L1 logistic
+# regression follows a warm-started path from sparse to dense, with a
+# loose tolerance: every fit starts close to its solution.
+ridge_alphas = np.logspace(-1, 5, 13)
+logr_path = ('logR', Pipeline([('selection',
+                                SelectKBest(f_classif_timed, 500)),
+                               ('clf', LogR(penalty='l1', solver='saga',
+                                            max_iter=100, tol=1e-3))]),
+             'clf__C', np.logspace(-3, 0, 7))
+
+
+### Stages ####################################################################
+
+def _lags(pipe):
+    # Lags of the --lags option, or the default ones
+    return tuple(pipe.options.get('lags') or hrf_lags)
+
+
+def select_stage(state, pipe):
+    """Pair stimuli with the lagged scans and drop rest periods."""
+    y = labels.load(state['label'], y_shape)
+    windows, rows, _, groups = lags.decoding_design(
+        state['runs'], y.runs(), _lags(pipe))
+
+    # Remove rest period
+    stimulus = y.stimulus[rows]
+    rows, groups = rows[stimulus], groups[stimulus]
+
+    # Only the stimulus rows are gathered, in float64 as the columns read
+    # out of core: both paths fit the same values
+    return dict(X_train=lags.take(windows, rows).astype(np.float64),
+                y_train=y.targets(rows), groups=groups)
+
+
+def _coef(estimator, X, y):
+    with instrument.span('estimator_fit'):
+        return np.atleast_2d(estimator.fit(X, y).coef_)
+
+
+def _cross_val(estimator, X, y, cv):
+    return cross_val_score(estimator, X, y, cv=cv)
+
+
+def _nested(name, X_train, y_train, cv, n_jobs):
+    # Chosen parameters and outer scores, stacked in one checkpointed array
+    if name == 'ridge':
+        result = nested.nested_ridge(X_train, y_train, ridge_alphas, cv=cv,
+                                     classification=True, n_jobs=n_jobs)
+    else:
+        _, estimator, param, grid = logr_path
+        result = nested.nested_path(estimator, X_train, y_train, param, grid,
+                                    cv=cv, classification=True, n_jobs=n_jobs)
+    return np.array([result.params, result.scores])
+
+
+def fit_stage(state, pipe):
+    """Single pixel fits, then one cross-validation per (pipeline, pixel).
+
+    Every fit is a task checkpointed on its own: an interrupted stage
+    resumes at the last finished one. With the nested option, the
+    hyper-parameters of every pixel are also chosen by nested
+    cross-validation.
+    """
+    X_train, y_train = state['X_train'], state['y_train']
+    store = pipe.tasks('fit')
+    n_jobs = pipe.options.get('n_jobs', 1)
+    cv = splits.run_split(state['groups'], n_folds)
+
+    sys.stderr.write("Single pixel prediction\n")
+    coefs = pipeline.run_tasks(
+        store, [(('coef', name), (estimator, X_train, y_train[:, i_p]))
+                for name, estimator in estimators], _coef, n_jobs=n_jobs)
+
+    sys.stderr.write("Cross validation\n")
+    with instrument.span('cross_validation'):
+        scores = pipeline.run_tasks(
+            store, [((name, i), (clf, X_train, y, cv))
+                    for name, clf in pipelines
+                    for i, y in enumerate(y_train.T)],
+            _cross_val, n_jobs=n_jobs)
+
+    result = dict(
+        coef=dict((name, coefs[('coef', name)]) for name, _ in estimators),
+        scores=dict((name, np.array([scores[(name, i)]
+                                     for i in range(y_train.shape[1])]))
+                    for name, _ in pipelines))
+
+    if pipe.options.get('nested'):
+        sys.stderr.write("Nested cross validation\n")
+        names = ['ridge', logr_path[0]]
+        # Outer folds are parallel inside each task
+        results = pipeline.run_tasks(
+            store, [(('nested', name), (name, X_train, y_train, cv, n_jobs))
+                    for name in names], _nested)
+        result['nested'] = dict(
+            (name, Bunch(params=results[('nested', name)][0],
+                         scores=results[('nested', name)][1]))
+            for name in names)
+    return result
+
+
+def stability_stage(state, pipe):
+    """Selection frequency and weight moments of the single pixel models,
+    over resamples of the scans of every run."""
+    n_jobs = pipe.options.get('n_jobs', 1)
+    n_resamples = pipe.options['stability']
+    maps = {}
+    for name, estimator in estimators:
+        sys.stderr.write("Stability of %s over %d resamples\n"
+                         % (name, n_resamples))
+        writer = None
+        if pipe.options.get('resample_maps'):
+            # The weights of every fit, written by the workers
+            writer = volumes.MapWriter(
+                volumes.map_path(pipe.options.get('output_dir', 'output'),
+                                 '%s_resamples' % name, pipe.options),
+                state['dataset'].mask, n_resamples * len(_lags(pipe)))
+        maps[name] = stability.stability_maps(
+            estimator, state['X_train'], state['y_train'][:, i_p],
+            state['groups'], n_resamples=n_resamples,
+            method=pipe.options.get('resampling') or 'subsample',
+            n_jobs=n_jobs, writer=writer)
+        if writer is not None:
+            writer.close(wait=True)
+    return dict(stability=maps)
+
+
+### Reduced design ############################################################
+
+def reduce_stage(state, pipe):
+    """Project the design on a few features, fitted on every training fold.
+
+    The projections are cached by (mask, fold) next to the checkpoints.
+    The last one is fitted on all the rows, for the single pixel weights.
+    """
+    X_train = state['X_train']
+    cv = splits.run_split(state['groups'], n_folds)
+    directory = None
+    if pipe.directory is not None:
+        directory = os.path.join(os.path.dirname(pipe.directory),
+                                 'projections')
+    projections = reduction.fold_projections(
+        X_train, [train for train, _ in cv] + [slice(None)],
+        pipe.options['reduction'], state['dataset'].mask,
+        rois=state['dataset'].get('mask_roi'), n_components=n_components,
+        n_lags=len(_lags(pipe)), cache=reduction.ProjectionCache(directory))
+    sys.stderr.write("Design reduced from %d to %d features\n"
+                     % (X_train.shape[1], projections[-1].n_features))
+    with instrument.span('projection'):
+        return dict(Z_folds=[p.transform(X_train) for p in projections[:-1]],
+                    Z_train=projections[-1].transform(X_train),
+                    projection=projections[-1])
+
+
+def _reduced_cross_val(estimator, Z_folds, y, cv):
+    scores = []
+    for Z, (train, test) in zip(Z_folds, cv):
+        estimator = clone(estimator)
+        with instrument.span('estimator_fit'):
+            estimator.fit(Z[train], y[train])
+        scores.append(estimator.score(Z[test], y[test]))
+    return np.array(scores)
+
+
+def reduced_fit_stage(state, pipe):
+    """fit_stage on the reduced design.
+
+    The reduction replaces the univariate selection of the pipelines: only
+    their classifiers are fitted, each fold on its own projection. The
+    single pixel weights are mapped back to the voxels.
+    """
+    y_train = state['y_train']
+    store = pipe.tasks('fit')
+    n_jobs = pipe.options.get('n_jobs', 1)
+    cv = splits.run_split(state['groups'], n_folds)
+
+    sys.stderr.write("Single pixel prediction\n")
+    coefs = pipeline.run_tasks(
+        store, [(('coef', name), (estimator, state['Z_train'],
+                                  y_train[:, i_p]))
+                for name, estimator in estimators], _coef, n_jobs=n_jobs)
+
+    sys.stderr.write("Cross validation\n")
+    with instrument.span('cross_validation'):
+        scores = pipeline.run_tasks(
+            store, [((name, i), (clf.named_steps['clf'], state['Z_folds'], y,
+                                 cv))
+                    for name, clf in pipelines
+                    for i, y in enumerate(y_train.T)],
+            _reduced_cross_val, n_jobs=n_jobs)
+
+    return dict(
+        coef=dict((name, state['projection'].inverse_weights(
+            coefs[('coef', name)])) for name, _ in estimators),
+        scores=dict((name, np.array([scores[(name, i)]
+                                     for i in range(y_train.shape[1])]))
+                    for name, _ in pipelines))
+
+
+### Out-of-core stages #######################################################
+
+def stream_select_stage(state, pipe):
+    """Select the stimulus rows of the runs stacked on disk.
+
+    The lagged design is not materialized: X_train reads its rows from
+    the memory-mapped runs.
+    """
+    stack = state['stack']
+    y = labels.load(state['label'], y_shape)
+    if not np.array_equal(stack.run_lengths, y.run_lengths):
+        raise ValueError('Runs and labels have different lengths: %s, %s'
+                         % (stack.run_lengths, y.run_lengths))
+    hrf = _lags(pipe)
+    rows = lags.lagged_rows(stack.run_lengths, hrf[-1])
+    groups = lags.row_runs(stack.run_lengths, rows)
+
+    # Remove rest period
+    stimulus = y.stimulus[rows]
+    rows, groups = rows[stimulus], groups[stimulus]
+
+    return dict(X_train=outofcore.StackRows(stack, rows, hrf),
+                y_train=y.targets(rows), groups=groups)
+
+
+def _stream_coef(estimator, C, X, y, block_size):
+    estimator = clone(estimator)
+    if C is not None:
+        estimator.set_params(alpha=1. / (C * len(X)))
+    with instrument.span('estimator_fit'):
+        outofcore.partial_fit_stream(estimator, X, y, block_size=block_size)
+    return np.atleast_2d(estimator.coef_)
+
+
+def _stream_fold(X, Y, train, test, budget):
+    """Scores of every (pipeline, pixel) on one fold.
+
+    The F scores of the feature selection are accumulated by blocks of
+    rows, then only the selected voxels are read, for as many pixels at
+    once as the budget allows, and the classifiers of the pipelines are
+    fitted on them in memory: the scores are those of the in-memory path.
+    """
+    block_size = outofcore.block_rows(X.row_bytes, budget)
+    with instrument.span('feature_selection'):
+        F = outofcore.f_classif_stream(X, Y, train, block_size)
+        selected = [outofcore.select_k_best(F, clf.named_steps['selection'].k)
+                    for _, clf in pipelines]
+    width = sum(s.shape[1] for s in selected)
+    chunk = max(1, budget // (2 * 8 * len(X) * width))
+    scores = np.empty((len(pipelines), Y.shape[1]))
+    for start in range(0, Y.shape[1], chunk):
+        targets = np.arange(start, min(start + chunk, Y.shape[1]))
+        columns = np.unique(np.concatenate([s[targets].ravel()
+                                            for s in selected]))
+        data = X.columns(columns, block_size=block_size)
+        for t in targets:
+            for m, (_, clf) in enumerate(pipelines):
+                X_t = data[:, np.searchsorted(columns, selected[m][t])]
+                clf = clone(clf.named_steps['clf'])
+                with instrument.span('estimator_fit'):
+                    clf.fit(X_t[train], Y[train, t])
+                scores[m, t] = clf.score(X_t[test], Y[test, t])
+    return scores
+
+
+def stream_fit_stage(state, pipe):
+    """fit_stage reading the design by blocks, within the memory budget.
+
+    Single pixel weights are fitted by minibatches on every voxel, the
+    cross-validation is one task per fold.
+    """
+    X_train, y_train = state['X_train'], state['y_train']
+    store = pipe.tasks('fit')
+    n_jobs = pipe.options.get('n_jobs', 1)
+    budget = outofcore.memory_budget(pipe.options)
+    cv = splits.run_split(state['groups'], n_folds)
+
+    sys.stderr.write("Single pixel prediction, by minibatches\n")
+    coefs = pipeline.run_tasks(
+        store, [(('coef', name), (estimator, C, X_train, y_train[:, i_p],
+                                  outofcore.block_rows(X_train.row_bytes,
+                                                       budget)))
+                for name, estimator, C in stream_estimators],
+        _stream_coef, n_jobs=n_jobs)
+
+    sys.stderr.write("Cross validation, by folds\n")
+    with instrument.span('cross_validation'):
+        scores = pipeline.run_tasks(
+            store, [(('fold', f), (X_train, y_train, train, test, budget))
+                    for f, (train, test) in enumerate(cv)],
+            _stream_fold, n_jobs=n_jobs)
+
+    return dict(
+        coef=dict((name, coefs[('coef', name)])
+                  for name, _, _ in stream_estimators),
+        scores=dict((name, np.array([scores[('fold', f)][m]
+                                     for f in range(len(cv))]).T)
+                    for m, (name, _) in enumerate(pipelines)))
+
+
+def score_stage(state, pipe):
+    """Save coefficients and scores, report accuracies."""
+    output_dir = pipe.options.get('output_dir', 'output')
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+    for name, coef in state['coef'].items():
+        np.save(os.path.join(output_dir, '%s_coef.npy' % name), coef)
+        sys.stderr.write("%s: %d nonzero voxels\n"
+                         % (name, np.sum(coef != 0.)))
+    for name, scores in state['scores'].items():
+        np.save(os.path.join(output_dir, '%s_scores.npy' % name), scores)
+        print('%s mean accuracy: %f' % (name, scores.mean()))
+    mean_scores = dict((name, scores.mean(1)) for name, scores
+                       in state['scores'].items())
+
+    # Scores of shape (n_outer_folds, n_pixels), with the chosen parameters
+    for name, result in state.get('nested', {}).items():
+        np.save(os.path.join(output_dir, 'nested_%s_scores.npy' % name),
+                result.scores)
+        np.save(os.path.join(output_dir, 'nested_%s_params.npy' % name),
+                result.params)
+        print('%s nested mean accuracy: %f, median parameter %g'
+              % (name, result.scores.mean(), np.median(result.params)))
+        mean_scores['%s_nested' % name] = result.scores.mean(0)
+
+    # Weight maps, and frequency, mean and std maps, of every lag
+    mask = state['dataset'].mask
+    n_voxels = np.count_nonzero(nibabel.load(mask).get_data())
+    writers = [volumes.write_maps(
+        volumes.map_path(output_dir, '%s_coef' % name, pipe.options),
+        coef.reshape(-1, n_voxels), mask)
+        for name, coef in state['coef'].items()]
+    for name, maps in state.get('stability', {}).items():
+        writers.append(volumes.write_maps(
+            volumes.map_path(output_dir, '%s_stability' % name, pipe.options),
+            maps.reshape(-1, n_voxels), mask))
+        sys.stderr.write("%s: %d voxels selected in more than half of the "
+                         "fits\n" % (name, np.sum(maps[0] > .5)))
+    for writer in writers:
+        writer.wait()
+    return dict(mean_scores=mean_scores)
+
+
+### Representational similarity #############################################
+
+def rsa_stage(state, pipe):
+    """RDMs of the stimuli in the whole mask, every ROI and optionally every
+    searchlight, compared to the model RDMs of the stimuli."""
+    metric = pipe.options['rsa']
+    X, y, groups = state['X_train'], state['y_train'], state['groups']
+    if metric == 'crossnobis':
+        # Cross-validated distances need every condition in every run
+        keep = rsa.common_conditions(rsa.stimulus_conditions(y)[0], groups)
+        if len(np.unique(y[keep], axis=0)) < 2:
+            raise ValueError('Cross-validated distances need stimuli shown '
+                             'in every run, less than 2 are')
+        X, y, groups = X[keep], y[keep], groups[keep]
+    conditions, stimuli = rsa.stimulus_conditions(y)
+    model_names, models = rsa.stimulus_rdms(stimuli)
+    patterns, residuals = rsa.condition_patterns(
+        X, conditions, groups if metric == 'crossnobis' else None)
+    sys.stderr.write("RSA of %d conditions (%s)\n" % (len(stimuli), metric))
+
+    mask = state['dataset'].mask
+    names, regions = rsa.roi_regions(state['dataset'].get('mask_roi', []),
+                                     mask, len(_lags(pipe)))
+    names.insert(0, 'mask')
+    regions.insert(0, np.arange(X.shape[1]))
+    n_jobs = pipe.options.get('n_jobs', 1)
+    rdms = rsa.region_rdms(patterns, regions, metric, residuals,
+                           n_jobs=n_jobs)
+    scores = rsa.compare(rdms, models)
+    for name, row in zip(names, scores):
+        print('RSA %s: %s' % (name, ', '.join(
+            '%s %.3f' % item for item in zip(model_names, row))))
+
+    output_dir = pipe.options.get('output_dir', 'output')
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+    np.savez(os.path.join(output_dir, 'rsa_%s.npz' % metric), rdms=rdms,
+             regions=names, models=models, model_names=model_names,
+             scores=scores, stimuli=stimuli)
+    outputs = dict(rsa_scores=scores)
+    radius = pipe.options.get('searchlight')
+    if radius:
+        spheres = rsa.searchlight_regions(mask, radius, len(_lags(pipe)))
+        searchlight = rsa.region_rdms(patterns, spheres, metric, residuals,
+                                      models=models, n_jobs=n_jobs)
+        # One map per model
+        volumes.write_maps(volumes.map_path(
+            output_dir, 'rsa_%s_searchlight' % metric, pipe.options),
+            searchlight.T, mask).wait()
+        outputs['searchlight_scores'] = searchlight
+    return outputs
+
+
+def _fit_pixel(estimator, X, y):
+    # Selected voxels, their weights and the intercept, in one record: the
+    # voxel indices stay integers through the task checkpoints
+    estimator = clone(estimator)
+    with instrument.span('estimator_fit'):
+        estimator.fit(X, y)
+    selected = estimator.named_steps['selection'].get_support(indices=True)
+    clf = estimator.named_steps['clf']
+    fit = np.zeros((), dtype=[('selected', np.int64, len(selected)),
+                              ('coef', np.float64, len(selected)),
+                              ('intercept', np.float64)])
+    fit['selected'] = selected
+    fit['coef'] = np.ravel(clf.coef_)
+    fit['intercept'] = np.ravel(clf.intercept_)[0]
+    return fit
+
+
+def bundle_stage(state, pipe):
+    """Refit a pipeline on all the scans of every pixel, save the decoders
+    as a bundle (see bundle.py)."""
+    name = pipe.options['bundle']
+    estimator = dict(pipelines)[name]
+    y_train = state['y_train']
+    fits = pipeline.run_tasks(
+        pipe.tasks('bundle'), [(('pixel', i), (estimator, state['X_train'], y))
+                               for i, y in enumerate(y_train.T)],
+        _fit_pixel, n_jobs=pipe.options.get('n_jobs', 1))
+    fits = [fits[('pixel', i)] for i in range(y_train.shape[1])]
+    fits = [(fit['coef'], float(fit['intercept']), fit['selected'])
+            for fit in fits]
+    decoders = bundle.from_fits(fits, state['dataset'].mask, dict(
+        lags=list(_lags(pipe)), y_shape=list(y_shape),
+        clean=pipeline.clean_params, model=name,
+        classifier=is_classifier(estimator)))
+    path = decoders.save(os.path.join(pipe.options.get('output_dir', 'output'),
+                                      'decoder_%s' % name))
+    sys.stderr.write("Decoders of %d pixels saved in %s\n"
+                     % (len(fits), path))
+    return dict(bundle=path)
+
+
+def render_stage(state, pipe):
+    renderer = rendering.Renderer(
+        output_dir=pipe.options.get('output_dir', 'output'),
+        n_jobs=pipe.options.get('render_jobs'))
+    mask = state['dataset'].mask
+
+    # Create masks for contour
+    ### Mask of chosen voxels
+    contour = np.zeros(nibabel.load(mask).shape, dtype=bool)
+    for x, y in [(31, 9), (31, 10), (30, 10), (32, 10)]:
+        contour[x, y, 10] = 1
+    ### Mask of chosen pixel
+    pixmask = np.zeros(y_shape, dtype=bool)
+    pixmask[p] = 1
+
+    bg = nibabel.load(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                   'bg.nii.gz'))
+    bg_slice = bg.get_data()[:, :, 10].T
+    contour_slice = contour[:, :, 10].T
+
+    for name, figure, vmax, ticks, labelsize in [
+            ('logr', 'decoding_pixel_logistic', 2.6, [0., 1.3, 2.6], 32),
+            ('linr', 'decoding_pixel_linear', 2.6, [0., 1.3, 2.6], 32),
+            ('svc', 'pixel_svc', 1.0, [0., .5, 1.], 28)]:
+        # Weights of a FIR model are summed over lags
+        coef = state['coef'][name][0].reshape(len(_lags(pipe)), -1)
+        sbrain = masking.unmask(coef.sum(axis=0), mask)
+        renderer.submit(rendering.brain_map, figure, bg=bg_slice,
+                        data=sbrain[:, :, 10].T, contour=contour_slice,
+                        vmin=0., vmax=vmax, ticks=ticks, labelsize=labelsize)
+
+    for name, figure in [('logR', 'log'), ('linR', 'lin'), ('svc', 'svc'),
+                         ('svcl2', 'svcl2')]:
+        renderer.submit(rendering.score_map, 'decoding_scores_%s' % figure,
+                        formats=('pdf', 'eps'),
+                        scores=state['mean_scores'][name].reshape(y_shape),
+                        pixmask=pixmask)
+
+    ### Colorbar
+    renderer.submit(rendering.colorbar, 'decoding_scores_colorbar',
+                    cmap='hot', vmin=.3, vmax=1.,
+                    ticks=np.arange(0.3, 1.1, 0.1), figsize=(.6, 3.6),
+                    adjust=dict(bottom=0.03, top=.97, left=0., right=.5))
+    return dict(figures=renderer.render())
+
+
+def summarize(state):
+    """Subject-level results stacked into group arrays by the batch runner."""
+    return dict(('%s_accuracy' % name, scores)
+                for name, scores in state['mean_scores'].items())
+
+
+def analysis_stages(nested=False, out_of_core=False, reduction=None,
+                    stability=0, resampling='subsample', bundle=None,
+                    resample_maps=False, rsa=None, searchlight=0,
+                    output_dir='output', compress_maps=False, lags=None):
+    """Decoding stages run on the cleaned runs.
+
+    reduction ('pca' or 'parcels') adds a reduce stage between select and
+    fit, stability (a number of resamples) a stability stage after fit,
+    rsa (a distance) an rsa stage after score, with searchlights of radius
+    searchlight (in mm) if non-zero, and bundle (the name of a pipeline) a
+    bundle stage after score. The stages writing in output_dir are rerun
+    when it changes, those writing maps also when compress_maps does.
+    lags default to hrf_lags.
+    """
+    if nested and out_of_core:
+        raise ValueError('Nested cross-validation needs the design in '
+                         'memory, it is not available out of core')
+    if reduction and (nested or out_of_core):
+        raise ValueError('The reduction of the design cannot be combined '
+                         'with nested cross-validation or out of core')
+    if stability and (reduction or out_of_core):
+        raise ValueError('Stability maps are computed on the voxels, in '
+                         'memory')
+    if bundle and (reduction or out_of_core):
+        raise ValueError('Bundles are fitted on the voxels, in memory')
+    if rsa and out_of_core:
+        raise ValueError('RSA needs the design in memory, it is not '
+                         'available out of core')
+    if searchlight and not rsa:
+        raise ValueError('Searchlights need a distance (rsa)')
+    if bundle and bundle not in dict(pipelines):
+        raise ValueError('Unknown model %r, expected one of %s'
+                         % (bundle, [name for name, _ in pipelines]))
+    outputs = dict(output_dir=os.path.abspath(output_dir))
+    maps = dict(outputs, compress_maps=compress_maps)
+    lags = tuple(lags or hrf_lags)
+    select, fit = select_stage, fit_stage
+    if out_of_core:
+        select, fit = stream_select_stage, stream_fit_stage
+    stages = [pipeline.Stage('select', select, dict(
+        lags=lags, groups='runs', out_of_core=out_of_core))]
+    if reduction:
+        fit = reduced_fit_stage
+        stages.append(pipeline.Stage('reduce', reduce_stage, dict(
+            reduction=reduction, n_components=n_components,
+            cv=('runs', n_folds))))
+    stages.append(pipeline.Stage('fit', fit, dict(
+        pixel=i_p, cv=('runs', n_folds),
+        estimators=[name for name, _ in estimators],
+        pipelines=[name for name, _ in pipelines], nested=nested,
+        out_of_core=out_of_core, reduction=reduction)))
+    if stability:
+        stages.append(pipeline.Stage('stability', stability_stage, dict(
+            n_resamples=stability, resampling=resampling,
+            estimators=[name for name, _ in estimators],
+            resample_maps=resample_maps, **maps)))
+    stages.append(pipeline.Stage('score', score_stage, dict(maps)))
+    if rsa:
+        stages.append(pipeline.Stage('rsa', rsa_stage, dict(
+            metric=rsa, searchlight=searchlight, lags=lags, **maps)))
+    if bundle:
+        stages.append(pipeline.Stage('bundle', bundle_stage, dict(
+            model=bundle, lags=lags, **outputs)))
+    return stages + [pipeline.Stage('render', render_stage, dict(outputs))]
+
+
+def build(args):
+    """Decoding pipeline configured from command line arguments."""
+    if args.rsa == 'crossnobis':
+        # Known before any data is read: the random images of the decoded
+        # runs are all different
+        raise ValueError('Cross-validated distances need stimuli shown in '
+                         'several runs, and every random image of the '
+                         'dataset is shown in a single run: use --rsa '
+                         'correlation or euclidean (crossnobis is available '
+                         'with batch, for manifests repeating stimuli)')
+    return pipeline.Pipeline(
+        'decode',
+        pipeline.preprocessing_stages(out_of_core=args.out_of_core,
+                                      epi_mask=args.epi_mask,
+                                      interpolation=args.interpolation,
+                                      inputs=pipeline.dataset_files(
+                                          args.data_dir, args.labels)) +
+        analysis_stages(nested=args.nested, out_of_core=args.out_of_core,
+                        reduction=args.reduction, stability=args.stability,
+                        resampling=args.resampling, bundle=args.bundle,
+                        resample_maps=args.resample_maps, rsa=args.rsa,
+                        searchlight=args.searchlight,
+                        output_dir=args.output_dir,
+                        compress_maps=args.compress_maps, lags=args.lags),
+        checkpoint_dir=None if args.no_checkpoint else args.checkpoint_dir,
+        options=vars(args))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__)
+    pipeline.add_arguments(parser)
+    args = parser.parse_args(argv)
+    return pipeline.execute(build, args, parser)
+
+
+if __name__ == '__main__':
+    main()
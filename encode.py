@@ -1,194 +1,385 @@
-from matplotlib.colors import LinearSegmentedColormap
+"""
+Encoding: prediction of the fMRI signal of every voxel from the stimuli
 
-import matplotlib as mpl
-mpl.use('TkAgg')
+Run with ``python encode.py`` or ``python -m fMRI encode``. Stages are
+checkpointed, a rerun resumes where the previous one stopped.
+"""
 
-import numpy as np
-import pylab as pl
-import nibabel
 import os
 import sys
-import time
-
-bluegreen = LinearSegmentedColormap('bluegreen', {
-    'red': ((0., 0., 0.),
-            (1., 0., 0.)),
-    'green': ((0., 0., 0.),
-              (1., 1., 1.)),
-    'blue': ((0., 0.2, 0.2),
-             (0.5, 0.5, 0.5),
-             (1., 0., 0.))
-    })
-
-### Load Miyawaki dataset #####################################################
-import datasets
-dataset = datasets.get_miyawaki()
-
-# Keep only random runs
-X_random = dataset.func[12:]
-y_random = dataset.label[12:]
-y_shape = (10, 10)
-
-### Preprocess data ###########################################################
-import masking, preprocess
-
-sys.stderr.write("Preprocessing data...")
-t0 = time.time()
-
-# Load and mask fMRI data
-X_train = []
-for x_random in X_random:
-    # Mask data
-    x_img = nibabel.load(x_random)
-    x = masking.apply_mask(x_img, dataset.mask)
-    x = preprocess.clean(x)
-    X_train.append(x[2:])
-
-# Load target data and reshape it in 2D
-y_train = []
-for y in y_random:
-    y_train.append(np.reshape(np.loadtxt(y, dtype=np.int, delimiter=','),
-        (-1,) + y_shape, order='F')[:-2].astype(float))
-
-X_train = np.vstack(X_train)
-y_train = np.vstack(y_train)
-
-# Flatten the stimuli
-y_train = np.reshape(y_train, (-1, y_shape[0] * y_shape[1]))
-
-sys.stderr.write(" Done (%.2fs)\n" % (time.time() - t0))
-n_pixels = y_train.shape[1]
-n_features = X_train.shape[1]
+import argparse
 
-### Encoding using Lasso regression and Ridge regression
+import numpy as np
+import nibabel
 
 from sklearn.linear_model import Ridge
 from sklearn.linear_model import Lasso
-from sklearn.cross_validation import KFold
-
-print("Ridge regression")
-estimator_ridge = Ridge(alpha=100, normalize=True, max_iter=1e5)
-
-print("Lasso regression")
-estimator_lasso = Lasso(alpha=100, normalize=True, max_iter=1e5)
-
-cv = KFold(len(y_train), 10)
-predictions_lasso = [
-        estimator_lasso.fit(y_train.reshape(-1, 100)[train], X_train[train]
-            ).predict(y_train.reshape(-1, 100)[test]) for train, test in cv]
-predictions_ridge = [
-        estimator_ridge.fit(y_train.reshape(-1, 100)[train], X_train[train]
-            ).predict(y_train.reshape(-1, 100)[test]) for train, test in cv]
-
-print("Scoring")
-scores_ridge = [1. - (((X_train[test] - pred) ** 2).sum(axis=0) /
-           ((X_train[test] - X_train[test].mean(axis=0)) ** 2).sum(axis=0))
-for pred, (train, test) in zip(predictions_ridge, cv)]
-
-scores_lasso = [1. - (((X_train[test] - pred) ** 2).sum(axis=0) /
-           ((X_train[test] - X_train[test].mean(axis=0)) ** 2).sum(axis=0))
-for pred, (train, test) in zip(predictions_lasso, cv)]
-
-### Show scores
-
-# Create a mask with chosen voxels to contour them
-contour = np.zeros(nibabel.load(dataset.mask).shape, dtype=bool)
-for x, y in [(31, 9), (31, 10), (30, 10), (32, 10)]:
-    contour[x, y, 10] = 1
-
-
-from matplotlib.lines import Line2D
-
-
-def plot_lines(mask, linewidth=3, color='b'):
-    for i, j in np.ndindex(mask.shape):
-        if i + 1 < mask.shape[0] and mask[i, j] != mask[i + 1, j]:
-            pl.gca().add_line(Line2D([j - .5, j + .5], [i + .5, i + .5],
-                color=color, linewidth=linewidth))
-        if j + 1 < mask.shape[1] and mask[i, j] != mask[i, j + 1]:
-            pl.gca().add_line(Line2D([j + .5, j + .5], [i - .5, i + .5],
-                color=color, linewidth=linewidth))
-
-sbrain_ridge = masking.unmask(np.array(scores_ridge).mean(0), dataset.mask)
-
-bg = nibabel.load(os.path.join('bg.nii.gz'))
-
-pl.figure(figsize=(8, 8))
-ax1 = pl.axes([0., 0., 1., 1.])
-pl.imshow(bg.get_data()[:, :, 10].T, interpolation="nearest", cmap='gray',
-          origin='lower')
-pl.imshow(np.ma.masked_less(sbrain_ridge[:, :, 10].T, 1e-6),
-          interpolation="nearest", cmap='hot', origin="lower")
-plot_lines(contour[:, :, 10].T)
-pl.axis('off')
-ax2 = pl.axes([.08, .5, .05, .47])
-cb = pl.colorbar(cax=ax2, ax=ax1)
-cb.ax.yaxis.set_ticks_position('left')
-cb.ax.yaxis.set_tick_params(labelcolor='white')
-cb.ax.yaxis.set_tick_params(labelsize=20)
-cb.set_ticks(np.arange(0., .8, .2))
-pl.savefig(os.path.join('output', 'encoding_scores_ridge.pdf'))
-pl.savefig(os.path.join('output', 'encoding_scores_ridge.png'))
-pl.savefig(os.path.join('output', 'encoding_scores_ridge.eps'))
-pl.clf()
-
-sbrain_lasso = masking.unmask(np.array(scores_lasso).mean(0), dataset.mask)
-
-pl.figure(figsize=(8, 8))
-ax1 = pl.axes([0., 0., 1., 1.])
-pl.imshow(bg.get_data()[:, :, 10].T, interpolation="nearest", cmap='gray',
-          origin='lower')
-pl.imshow(np.ma.masked_less(sbrain_lasso[:, :, 10].T, 1e-6),
-          interpolation="nearest", cmap='hot', origin="lower")
-plot_lines(contour[:, :, 10].T)
-pl.axis('off')
-ax2 = pl.axes([.08, .5, .05, .47])
-cb = pl.colorbar(cax=ax2, ax=ax1)
-cb.ax.yaxis.set_ticks_position('left')
-cb.ax.yaxis.set_tick_params(labelcolor='white')
-cb.ax.yaxis.set_tick_params(labelsize=20)
-cb.set_ticks(np.arange(0., .8, .2))
-pl.savefig(os.path.join('output', 'encoding_scores_lasso.pdf'))
-pl.savefig(os.path.join('output', 'encoding_scores_lasso.png'))
-pl.savefig(os.path.join('output', 'encoding_scores_lasso.eps'))
-pl.clf()
-
-### Compute receptive fields
-
 from sklearn.linear_model import LassoLarsCV
+from sklearn.utils import Bunch
+
+import instrument
+import labels
+import lags
+import masking
+import nested
+import outofcore
+import pipeline
+import rendering
+import scoring
+import splits
+import volumes
 
-lasso = LassoLarsCV(max_iter=10,)
+y_shape = (10, 10)
 
+# Pixel chosen for the study
 p = (4, 2)
-# Mask for chosen pixel
-pixmask = np.zeros((10, 10), dtype=bool)
-pixmask[p] = 1
-
-for index in [1700, 1800, 1900, 2000]:
-    rf = lasso.fit(y_train, X_train[:, index]).coef_.reshape(10, 10)
-    pl.figure(figsize=(8, 8))
-    # Black background
-    pl.imshow(np.zeros_like(rf), vmin=0., vmax=1., cmap='gray')
-    pl.imshow(np.ma.masked_equal(rf, 0.), vmin=0., vmax=0.75,
-            interpolation="nearest", cmap=bluegreen)
-    plot_lines(pixmask, linewidth=6, color='r')
-    pl.axis('off')
-    pl.subplots_adjust(left=0., right=1., bottom=0., top=1.)
-    pl.savefig(os.path.join('output', 'encoding_%d.pdf' % index))
-    pl.savefig(os.path.join('output', 'encoding_%d.eps' % index))
-    pl.clf()
-
-
-### Plot the colorbar #########################################################
-
-
-fig = pl.figure(figsize=(2.4, .4))
-norm = mpl.colors.Normalize(vmin=0., vmax=.75)
-cb = mpl.colorbar.ColorbarBase(pl.gca(), cmap=bluegreen, norm=norm,
-                               orientation='horizontal')
-#cb.ax.yaxis.set_ticks_position('left')
-cb.set_ticks([0., 0.38, 0.75])
-fig.subplots_adjust(bottom=0.5, top=1., left=0.08, right=.92)
-pl.savefig(os.path.join('output', 'encoding_rf_colorbar.pdf'))
-pl.savefig(os.path.join('output', 'encoding_rf_colorbar.png'))
-pl.savefig(os.path.join('output', 'encoding_rf_colorbar.eps'))
+
+# Delays, in scans, between the stimuli and the BOLD response. Several
+# evenly spaced lags make a FIR model of the response (--lags).
+hrf_lags = (2,)
+
+# Cross-validation folds, each testing on consecutive whole runs (one
+# fold per run if there are fewer runs)
+n_folds = 10
+
+### Encoding using Lasso regression and Ridge regression
+estimators = [
+    ('ridge', Ridge(alpha=100, normalize=True, max_iter=1e5)),
+    ('lasso', Lasso(alpha=100, normalize=True, max_iter=1e5)),
+]
+
+# Voxels whose receptive field is displayed
+rf_voxels = [1700, 1800, 1900, 2000]
+
+# Grids of alpha searched by nested cross-validation (--nested), one alpha
+# per voxel. Lasso fits all voxels at once along a path from sparse to
+# dense. Unlike the models above, the stimuli are not normalized.
+nested_grids = [
+    ('ridge', np.logspace(-2, 4, 13)),
+    ('lasso', np.logspace(0, -3, 7)),
+]
+
+
+### Stages ####################################################################
+
+def _lags(pipe):
+    # Lags of the --lags option, or the default ones
+    return tuple(pipe.options.get('lags') or hrf_lags)
+
+
+def select_stage(state, pipe):
+    """Pair every scan with the flattened stimuli preceding it."""
+    hrf = _lags(pipe)
+    windows, rows, X, groups = lags.encoding_design(
+        state['runs'], labels.load(state['label'], y_shape).runs(), hrf)
+    X_train = X[rows + hrf[-1]]
+    y_train = lags.take(windows, rows).astype(float)
+    return dict(X_train=X_train, y_train=y_train, groups=groups)
+
+
+def _predict(estimator, y_train, X_train, train, test):
+    with instrument.span('estimator_fit'):
+        return estimator.fit(y_train[train], X_train[train]).predict(
+            y_train[test])
+
+
+def _receptive_field(y_train, x):
+    lasso = LassoLarsCV(max_iter=10,)
+    with instrument.span('estimator_fit'):
+        coef = lasso.fit(y_train, x).coef_
+    # Weights of a FIR model are summed over lags
+    return coef.reshape((-1,) + y_shape).sum(axis=0)
+
+
+def _nested(name, y_train, X_train, folds, n_jobs):
+    # Chosen alphas and outer R², stacked in one checkpointed array
+    grid = dict(nested_grids)[name]
+    if name == 'ridge':
+        result = nested.nested_ridge(y_train, X_train, grid, cv=folds,
+                                     n_jobs=n_jobs)
+    else:
+        result = nested.nested_path(Lasso(max_iter=1000, tol=1e-3), y_train,
+                                    X_train, 'alpha', grid, cv=folds,
+                                    multi_output=True, n_jobs=n_jobs)
+    return np.array([result.params, result.scores])
+
+
+def fit_stage(state, pipe):
+    """Cross-validated predictions, one task per (model, fold), and
+    receptive fields of a few voxels. With the nested option, the alpha of
+    every voxel is also chosen by nested cross-validation."""
+    X_train, y_train = state['X_train'], state['y_train']
+    store = pipe.tasks('fit')
+    n_jobs = pipe.options.get('n_jobs', 1)
+
+    cv = splits.run_split(state['groups'], n_folds)
+    predictions = pipeline.run_tasks(
+        store, [((name, f), (estimator, y_train, X_train, train, test))
+                for name, estimator in estimators
+                for f, (train, test) in enumerate(cv)],
+        _predict, n_jobs=n_jobs)
+
+    rfs = pipeline.run_tasks(
+        store, [(('rf', index), (y_train, X_train[:, index]))
+                for index in rf_voxels], _receptive_field, n_jobs=n_jobs)
+
+    result = dict(
+        folds=cv.tests,
+        predictions=[[predictions[(name, f)] for f in range(len(cv))]
+                     for name, _ in estimators],
+        receptive_fields=[rfs[('rf', index)] for index in rf_voxels])
+
+    if pipe.options.get('nested'):
+        sys.stderr.write("Nested cross validation\n")
+        # Outer folds are parallel inside each task
+        results = pipeline.run_tasks(
+            store, [(('nested', name), (name, y_train, X_train, cv, n_jobs))
+                    for name, _ in nested_grids], _nested)
+        result['nested'] = dict(
+            (name, Bunch(params=results[('nested', name)][0],
+                         scores=results[('nested', name)][1]))
+            for name, _ in nested_grids)
+    return result
+
+
+### Out-of-core stages #######################################################
+
+def stream_select_stage(state, pipe):
+    """select_stage on the runs stacked on disk.
+
+    The lagged stimuli are small and held in memory; the scans to predict
+    are read from the memory-mapped runs.
+    """
+    stack = state['stack']
+    y = labels.load(state['label'], y_shape)
+    if not np.array_equal(stack.run_lengths, y.run_lengths):
+        raise ValueError('Runs and labels have different lengths: %s, %s'
+                         % (stack.run_lengths, y.run_lengths))
+    stimuli = y.images.reshape(len(y.images), -1)
+    hrf = _lags(pipe)
+    rows = lags.lagged_rows(stack.run_lengths, hrf[-1])
+    windows = lags.lag_windows(stimuli, hrf[-1] - np.asarray(hrf)[::-1])
+    return dict(X_train=outofcore.StackRows(stack, rows + hrf[-1]),
+                y_train=lags.take(windows, rows).astype(float),
+                groups=lags.row_runs(stack.run_lengths, rows))
+
+
+def _stream_predict(y_train, X, train, test, paths, budget):
+    """Predictions of every model on one fold, written to paths.
+
+    Voxels are independent targets: they are fitted by chunks, as many
+    at once as the budget allows, with the same estimators as in memory.
+    """
+    n_test = len(np.arange(len(X))[test])
+    outs = [outofcore.predictions_file(path, (n_test, X.shape[1]))
+            for path in paths]
+    block_size = outofcore.block_rows(X.row_bytes, budget)
+    chunk = max(1, budget // (2 * 8 * len(X)))
+    for start in range(0, X.shape[1], chunk):
+        columns = np.arange(start, min(start + chunk, X.shape[1]))
+        targets = X.columns(columns, block_size=block_size)
+        for (name, estimator), out in zip(estimators, outs):
+            out[:, columns] = _predict(estimator, y_train, targets, train,
+                                       test)
+    return np.array([outofcore.finish_file(out, path)
+                     for out, path in zip(outs, paths)])
+
+
+def stream_fit_stage(state, pipe):
+    """fit_stage with the scans read by blocks, within the memory budget.
+
+    Predictions are memory-mapped arrays on disk, one per (model, fold).
+    """
+    X_train, y_train = state['X_train'], state['y_train']
+    store = pipe.tasks('fit')
+    n_jobs = pipe.options.get('n_jobs', 1)
+    budget = outofcore.memory_budget(pipe.options)
+    directory = outofcore.array_dir(pipe)
+
+    cv = splits.run_split(state['groups'], n_folds)
+    predictions = pipeline.run_tasks(
+        store, [(('fold', f), (y_train, X_train, train, test,
+                               [os.path.join(directory, 'predictions_%s_%d.npy'
+                                             % (name, f))
+                                for name, _ in estimators], budget))
+                for f, (train, test) in enumerate(cv)],
+        _stream_predict, n_jobs=n_jobs)
+
+    signals = X_train.columns(
+        rf_voxels, block_size=outofcore.block_rows(X_train.row_bytes, budget))
+    rfs = pipeline.run_tasks(
+        store, [(('rf', index), (y_train, signals[:, i]))
+                for i, index in enumerate(rf_voxels)],
+        _receptive_field, n_jobs=n_jobs)
+
+    return dict(
+        folds=cv.tests,
+        predictions=[[predictions[('fold', f)][m] for f in range(len(cv))]
+                     for m in range(len(estimators))],
+        receptive_fields=[rfs[('rf', index)] for index in rf_voxels])
+
+
+def score_stage(state, pipe):
+    """(model, fold, voxel) cubes of R², Pearson r and explained variance."""
+    # Out of core, predictions are paths of memory-mapped arrays
+    predictions = [[np.load(pred, mmap_mode='r') if isinstance(pred, str)
+                    else pred for pred in model]
+                   for model in state['predictions']]
+    scores = scoring.score_folds(state['X_train'], predictions,
+                                 state['folds'])
+    output_dir = pipe.options.get('output_dir', 'output')
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+    for (name, _), r2 in zip(estimators, scores.r2):
+        np.save(os.path.join(output_dir, 'encoding_%s_r2.npy' % name), r2)
+        print('%s mean R2: %f' % (name, r2.mean()))
+    # R² of shape (n_outer_folds, n_voxels), with the chosen alphas
+    for name, result in state.get('nested', {}).items():
+        np.save(os.path.join(output_dir, 'encoding_nested_%s_r2.npy' % name),
+                result.scores)
+        np.save(os.path.join(output_dir,
+                             'encoding_nested_%s_alpha.npy' % name),
+                result.params)
+        print('%s nested mean R2: %f, median alpha %g'
+              % (name, result.scores.mean(), np.median(result.params)))
+
+    # The same maps as NIfTI volumes, one map per fold
+    mask = state['dataset'].mask
+    writers = [volumes.write_maps(
+        volumes.map_path(output_dir, 'encoding_%s_r2' % name, pipe.options),
+        r2, mask) for (name, _), r2 in zip(estimators, scores.r2)]
+    for name, result in state.get('nested', {}).items():
+        for key, maps in [('r2', result.scores), ('alpha', result.params)]:
+            writers.append(volumes.write_maps(
+                volumes.map_path(output_dir, 'encoding_nested_%s_%s'
+                                 % (name, key), pipe.options), maps, mask))
+    for writer in writers:
+        writer.wait()
+    return dict(scores=scores)
+
+
+def render_stage(state, pipe):
+    renderer = rendering.Renderer(
+        output_dir=pipe.options.get('output_dir', 'output'),
+        n_jobs=pipe.options.get('render_jobs'))
+    mask = state['dataset'].mask
+
+    ### Show scores
+
+    # Create a mask with chosen voxels to contour them
+    contour = np.zeros(nibabel.load(mask).shape, dtype=bool)
+    for x, y in [(31, 9), (31, 10), (30, 10), (32, 10)]:
+        contour[x, y, 10] = 1
+
+    bg = nibabel.load(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                   'bg.nii.gz'))
+
+    for (name, _), r2 in zip(estimators, state['scores'].r2):
+        sbrain = masking.unmask(r2.mean(0), mask)
+        renderer.submit(rendering.brain_map, 'encoding_scores_%s' % name,
+                        bg=bg.get_data()[:, :, 10].T, data=sbrain[:, :, 10].T,
+                        contour=contour[:, :, 10].T, cmap='hot',
+                        threshold=1e-6, ticks=np.arange(0., .8, .2),
+                        labelsize=20, cbar_rect=(.08, .5, .05, .47),
+                        contour_color='b')
+
+    ### Show receptive fields
+
+    # Mask for chosen pixel
+    pixmask = np.zeros(y_shape, dtype=bool)
+    pixmask[p] = 1
+
+    for index, rf in zip(rf_voxels, state['receptive_fields']):
+        renderer.submit(rendering.receptive_field, 'encoding_%d' % index,
+                        formats=('pdf', 'eps'), rf=rf, pixmask=pixmask)
+
+    ### Plot the colorbar
+    renderer.submit(rendering.colorbar, 'encoding_rf_colorbar',
+                    cmap='bluegreen', vmin=0., vmax=.75,
+                    ticks=[0., 0.38, 0.75], figsize=(2.4, .4),
+                    adjust=dict(bottom=0.5, top=1., left=0.08, right=.92),
+                    orientation='horizontal')
+    return dict(figures=renderer.render())
+
+
+def summarize(state):
+    """Subject-level results stacked into group arrays by the batch runner.
+
+    R² maps are averaged over folds and unmasked, so that subjects with
+    different masks in a common space can be stacked.
+    """
+    mask = state['dataset'].mask
+    summary = dict(('%s_r2' % name, masking.unmask(r2.mean(0), mask))
+                   for (name, _), r2 in zip(estimators, state['scores'].r2))
+    for name, result in state.get('nested', {}).items():
+        summary['%s_nested_r2' % name] = masking.unmask(
+            result.scores.mean(0), mask)
+    return summary
+
+
+def analysis_stages(nested=False, out_of_core=False, reduction=None,
+                    stability=0, resampling=None, bundle=None,
+                    resample_maps=False, rsa=None, searchlight=0,
+                    output_dir='output', compress_maps=False, lags=None):
+    """Encoding stages run on the cleaned runs.
+
+    The stages writing in output_dir are rerun when it changes, score also
+    when compress_maps does. lags default to hrf_lags.
+    """
+    if nested and out_of_core:
+        raise ValueError('Nested cross-validation needs the design in '
+                         'memory, it is not available out of core')
+    if reduction:
+        # The voxels are the targets of the encoding models
+        raise ValueError('The reduction of the design only applies to '
+                         'decoding')
+    if stability or bundle:
+        raise ValueError('Stability maps and bundles are made of decoders')
+    if rsa or searchlight:
+        raise ValueError('RSA is run by the decoding analysis')
+    outputs = dict(output_dir=os.path.abspath(output_dir))
+    select, fit = select_stage, fit_stage
+    if out_of_core:
+        select, fit = stream_select_stage, stream_fit_stage
+    return [
+        pipeline.Stage('select', select, dict(
+            lags=tuple(lags or hrf_lags), groups='runs',
+            out_of_core=out_of_core)),
+        pipeline.Stage('fit', fit, dict(
+            cv=('runs', n_folds), estimators=[name for name, _ in estimators],
+            rf_voxels=rf_voxels, nested=nested, out_of_core=out_of_core)),
+        pipeline.Stage('score', score_stage,
+                       dict(outputs, compress_maps=compress_maps)),
+        pipeline.Stage('render', render_stage, dict(outputs)),
+    ]
+
+
+def build(args):
+    """Encoding pipeline configured from command line arguments."""
+    return pipeline.Pipeline(
+        'encode',
+        pipeline.preprocessing_stages(out_of_core=args.out_of_core,
+                                      epi_mask=args.epi_mask,
+                                      interpolation=args.interpolation,
+                                      inputs=pipeline.dataset_files(
+                                          args.data_dir, args.labels)) +
+        analysis_stages(nested=args.nested, out_of_core=args.out_of_core,
+                        reduction=args.reduction, stability=args.stability,
+                        resampling=args.resampling, bundle=args.bundle,
+                        resample_maps=args.resample_maps, rsa=args.rsa,
+                        searchlight=args.searchlight,
+                        output_dir=args.output_dir,
+                        compress_maps=args.compress_maps, lags=args.lags),
+        checkpoint_dir=None if args.no_checkpoint else args.checkpoint_dir,
+        options=vars(args))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__)
+    pipeline.add_arguments(parser)
+    args = parser.parse_args(argv)
+    return pipeline.execute(build, args, parser)
+
+
+if __name__ == '__main__':
+    main()
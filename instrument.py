@@ -0,0 +1,336 @@
+# *- encoding: utf-8 -*-
+"""
+Lightweight instrumentation of the pipeline stages.
+
+Named spans record wall time, bytes read and peak memory of the code they
+wrap. Recording is switched on with the ``FMRI_PROFILE`` environment
+variable, which gives the path of the report written at exit:
+
+    FMRI_PROFILE=output/profile.json python decode.py
+
+The report is a structured JSON list of spans, or a Chrome trace (open it
+in chrome://tracing or Perfetto) when ``FMRI_PROFILE_FORMAT=chrome``.
+When the variable is unset, ``span`` returns a shared no-op context
+manager and the cost is one attribute lookup per call.
+
+Peak memory is traced by tracemalloc, which slows down allocations: it is
+only recorded with ``FMRI_PROFILE_MEMORY=1``, otherwise peak_memory is
+null and timings are not inflated.
+
+Spans recorded in worker processes are sent back to the parent with the
+results of the functions wrapped by ``remote``, and merged under the
+span open in the parent by ``merge``. Their durations add up over the
+workers, so the children of a parallel span may last longer than it.
+Spans opened in other threads (e.g. the prefetching readers) are nested
+within their own thread only, so they are reported as roots.
+"""
+
+import os
+import sys
+import time
+import json
+import atexit
+import functools
+import threading
+import tracemalloc
+
+
+class _NullSpan(object):
+    """Context manager doing nothing, shared by all disabled spans."""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def add_bytes(self, n_bytes):
+        pass
+
+
+_NULL_SPAN = _NullSpan()
+
+
+class _Recorder(object):
+    """Collect finished spans and keep track of the open ones."""
+
+    def __init__(self, path, format='json', memory=False, t_origin=None):
+        self.path = path
+        self.format = format
+        self.memory = memory
+        self.records = []
+        # Every thread nests its own spans: those of the prefetching
+        # threads are roots, not children of the span open in the main
+        # thread
+        self._local = threading.local()
+        self.t_origin = time.time() if t_origin is None else t_origin
+        if memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    @property
+    def stack(self):
+        """Open spans of the current thread, outermost first."""
+        if not hasattr(self._local, 'stack'):
+            self._local.stack = []
+        return self._local.stack
+
+    def traced_memory(self):
+        if not self.memory:
+            return 0
+        return tracemalloc.get_traced_memory()[0]
+
+    def flush_peak(self):
+        # tracemalloc only has one peak counter: fold it into every open
+        # span before resetting, so that nested spans do not hide the peak
+        # of their parents.
+        if not self.memory:
+            return
+        peak = tracemalloc.get_traced_memory()[1]
+        for s in self.stack:
+            if peak > s.peak:
+                s.peak = peak
+        tracemalloc.reset_peak()
+
+    def write(self):
+        if not self.records:
+            return
+        directory = os.path.dirname(self.path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        if self.format == 'chrome':
+            # One row of the trace per thread and depth
+            threads = {'MainThread': 0}
+            events = []
+            for r in self.records:
+                thread = threads.setdefault(r['thread'], len(threads))
+                events.append({
+                    'name': r['name'], 'cat': 'fmri', 'ph': 'X',
+                    'ts': r['start'] * 1e6, 'dur': r['duration'] * 1e6,
+                    'pid': r.get('pid', os.getpid()),
+                    'tid': 100 * thread + r['depth'],
+                    'args': {'bytes_read': r['bytes_read'],
+                             'peak_memory': r['peak_memory']}})
+            report = {'traceEvents': events, 'displayTimeUnit': 'ms'}
+        else:
+            report = {'pid': os.getpid(), 'argv': sys.argv,
+                      'spans': self.records}
+        with open(self.path, 'w') as f:
+            json.dump(report, f, indent=1)
+
+
+class _Span(object):
+    """Timed region recording bytes read and peak memory."""
+
+    def __init__(self, recorder, name, n_bytes=0):
+        self.recorder = recorder
+        self.name = name
+        self.bytes_read = n_bytes
+        self.peak = 0
+
+    def add_bytes(self, n_bytes):
+        self.bytes_read += n_bytes
+
+    def __enter__(self):
+        rec = self.recorder
+        rec.flush_peak()
+        self.mem_start = rec.traced_memory()
+        self.path = '/'.join([s.name for s in rec.stack] + [self.name])
+        self.depth = len(rec.stack)
+        rec.stack.append(self)
+        self.t0 = time.time()
+        return self
+
+    def __exit__(self, *exc):
+        duration = time.time() - self.t0
+        rec = self.recorder
+        rec.flush_peak()
+        rec.stack.remove(self)
+        rec.records.append({
+            'name': self.path,
+            'depth': self.depth,
+            'thread': threading.current_thread().name,
+            'start': self.t0 - rec.t_origin,
+            'duration': duration,
+            'bytes_read': self.bytes_read,
+            # Peak allocation above what was live when the span started
+            'peak_memory': (max(self.peak - self.mem_start, 0)
+                            if rec.memory else None),
+        })
+        return False
+
+
+_recorder = None
+
+
+def enable(path, format='json', memory=False):
+    """Start recording spans, the report is written to path at exit.
+
+    Parameters
+    ----------
+    path: string
+        File receiving the report.
+
+    format: 'json' or 'chrome'
+        Structured list of spans, or Chrome trace event format.
+
+    memory: bool
+        Also record the peak memory of the spans with tracemalloc, at the
+        cost of slower allocations.
+    """
+    global _recorder
+    if format not in ('json', 'chrome'):
+        raise ValueError("Unknown profile format: %s" % format)
+    if _recorder is None:
+        atexit.register(_write_report)
+    _recorder = _Recorder(path, format=format, memory=memory)
+    return _recorder
+
+
+def disable():
+    """Write the pending report and stop recording spans."""
+    global _recorder
+    _write_report()
+    _recorder = None
+
+
+def enabled():
+    return _recorder is not None
+
+
+def _write_report():
+    if _recorder is not None:
+        _recorder.write()
+
+
+def span(name, n_bytes=0):
+    """Context manager timing a named pipeline stage.
+
+    Parameters
+    ----------
+    name: string
+        Name of the stage. Nested spans are reported as 'parent/child'.
+
+    n_bytes: int, optional
+        Bytes read from disk by the stage. More can be added from inside
+        the block with the ``add_bytes`` method of the returned object.
+    """
+    if _recorder is None:
+        return _NULL_SPAN
+    return _Span(_recorder, name, n_bytes)
+
+
+def timed(name=None):
+    """Decorator wrapping every call of a function in a span."""
+    def decorate(func):
+        span_name = name or func.__name__
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if _recorder is None:
+                return func(*args, **kwargs)
+            with span(span_name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorate
+
+
+class _Remote(object):
+    """Picklable function recording its spans in a worker process."""
+
+    def __init__(self, func, memory, t_origin):
+        self.func = func
+        self.memory = memory
+        self.t_origin = t_origin
+
+    def __call__(self, *args, **kwargs):
+        global _recorder
+        # Spans of the parent inherited by a forked worker are dropped
+        _recorder = _Recorder(None, memory=self.memory,
+                              t_origin=self.t_origin)
+        try:
+            result = self.func(*args, **kwargs)
+            records = _recorder.records
+        finally:
+            _recorder = None
+        for r in records:
+            r['pid'] = os.getpid()
+        return result, records
+
+
+def remote(func):
+    """func, to be run in a worker process.
+
+    When recording, the returned function also returns the spans recorded
+    in the worker; pass its results to merge. Otherwise func is returned.
+    """
+    if _recorder is None:
+        return func
+    return _Remote(func, _recorder.memory, _recorder.t_origin)
+
+
+def merge(result):
+    """Result of a function wrapped by remote, its spans being recorded
+    under the spans open in this process."""
+    if _recorder is None:
+        return result
+    result, records = result
+    stack = _recorder.stack
+    prefix = ''.join(s.name + '/' for s in stack)
+    for r in records:
+        r['name'] = prefix + r['name']
+        r['depth'] += len(stack)
+    _recorder.records.extend(records)
+    return result
+
+
+def summary():
+    """Finished spans aggregated by name, nested spans after their parent.
+
+    Returns
+    -------
+    rows: list of dict
+        'name', 'calls', 'duration' (total seconds), 'bytes_read' (total)
+        and 'peak_memory' (maximum over calls, None if memory is not
+        traced) of every span name.
+    """
+    if _recorder is None:
+        return []
+    rows = {}
+    for r in _recorder.records:
+        row = rows.setdefault(r['name'], {
+            'name': r['name'], 'calls': 0, 'duration': 0., 'bytes_read': 0,
+            'peak_memory': None})
+        row['calls'] += 1
+        row['duration'] += r['duration']
+        row['bytes_read'] += r['bytes_read']
+        if r['peak_memory'] is not None:
+            row['peak_memory'] = max(row['peak_memory'] or 0,
+                                     r['peak_memory'])
+    return sorted(rows.values(), key=lambda row: row['name'])
+
+
+def format_summary(rows):
+    """Text table of the rows returned by summary."""
+    lines = ['%-40s %6s %10s %10s %10s' % ('span', 'calls', 'time (s)',
+                                            'read (MB)', 'peak (MB)')]
+    for row in rows:
+        peak = row['peak_memory']
+        lines.append('%-40s %6d %10.2f %10.1f %10s' % (
+            row['name'], row['calls'], row['duration'],
+            row['bytes_read'] / 1e6,
+            '-' if peak is None else '%.1f' % (peak / 1e6)))
+    return '\n'.join(lines)
+
+
+def file_size(path):
+    """Size on disk of path, or 0 if it is not a readable file."""
+    try:
+        return os.path.getsize(path)
+    except (OSError, TypeError):
+        return 0
+
+
+if os.getenv('FMRI_PROFILE'):
+    enable(os.getenv('FMRI_PROFILE'),
+           format=os.getenv('FMRI_PROFILE_FORMAT', 'json'),
+           memory=os.getenv('FMRI_PROFILE_MEMORY', '0') not in ('', '0'))
@@ -0,0 +1,135 @@
+# *- encoding: utf-8 -*-
+"""
+Stimuli of the runs
+
+Each run comes with a CSV file holding one line per scan: the pixels of
+the stimulus image (0 or 1) in column-major order, or -1 during rest.
+The CSV files of all the runs are parsed in one vectorised read, or the
+labels are read from the packed file written by ``python -m fMRI pack``.
+The rest and stimulus masks of the scans are computed once; the targets
+of the decoders are the stimulus rows only, as compact uint8 arrays.
+"""
+
+import numpy as np
+
+import lags
+
+
+class Labels(object):
+    """Stimuli of stacked runs.
+
+    Parameters
+    ----------
+    images: numpy.ndarray
+        Stimuli, shape (n_scans,) + y_shape, -1 during rest.
+
+    run_lengths: numpy.ndarray
+        Number of scans of every run.
+
+    Attributes
+    ----------
+    rest, stimulus: numpy.ndarray
+        Boolean masks of the rest and stimulus scans, shape (n_scans,).
+    """
+
+    def __init__(self, images, run_lengths):
+        self.images = np.ascontiguousarray(images, dtype=np.int8)
+        self.run_lengths = np.asarray(run_lengths)
+        if self.run_lengths.sum() != len(self.images):
+            raise ValueError('Runs of %d scans in total, got %d labels'
+                             % (self.run_lengths.sum(), len(self.images)))
+        self.rest = self.images.reshape(len(self.images), -1)[:, 0] == -1
+        self.stimulus = ~self.rest
+
+    @property
+    def y_shape(self):
+        return self.images.shape[1:]
+
+    def _split(self, array):
+        starts = lags.run_starts(self.run_lengths)
+        return [array[start:start + length]
+                for start, length in zip(starts, self.run_lengths)]
+
+    def runs(self):
+        """Stimuli of every run, views of shape (n_scans,) + y_shape."""
+        return self._split(self.images)
+
+    def targets(self, rows):
+        """Flattened stimuli of stimulus scans, as 0/1 uint8.
+
+        Parameters
+        ----------
+        rows: numpy.ndarray
+            Scans, in stacked coordinates; none of them may be at rest.
+
+        Returns
+        -------
+        targets: numpy.ndarray, shape (len(rows), n_pixels)
+        """
+        if np.any(self.rest[rows]):
+            raise ValueError('Rest scans have no stimulus to decode')
+        images = self.images[rows]
+        return images.reshape(len(images), -1).view(np.uint8)
+
+    def packed(self):
+        """Bitpacked pixels and rest mask, with what is needed to unpack
+        them (see from_packed)."""
+        flat = self.images.reshape(len(self.images), -1)
+        return dict(label_bits=np.packbits(flat > 0, axis=1),
+                    rest_bits=np.packbits(self.rest),
+                    run_lengths=self.run_lengths,
+                    y_shape=np.array(self.y_shape))
+
+    @classmethod
+    def from_packed(cls, label_bits, rest_bits, run_lengths, y_shape):
+        n_scans = int(np.sum(run_lengths))
+        n_pixels = int(np.prod(y_shape))
+        images = np.unpackbits(label_bits, axis=1)[:, :n_pixels].astype(
+            np.int8)
+        images[np.unpackbits(rest_bits)[:n_scans].astype(bool)] = -1
+        return cls(images.reshape((n_scans,) + tuple(y_shape)), run_lengths)
+
+
+def _scan_lines(content):
+    return sum(1 for line in content.splitlines() if line.strip())
+
+
+def read_csv(paths, y_shape=(10, 10)):
+    """Labels of the runs, parsed from their CSV files in one read.
+
+    Raises a ValueError naming the file if a line does not have one value
+    per pixel, or if values other than -1, 0 and 1 are found.
+    """
+    contents = []
+    for path in paths:
+        with open(path, 'rb') as f:
+            contents.append(f.read())
+    n_pixels = int(np.prod(y_shape))
+    run_lengths = np.array([_scan_lines(c) for c in contents])
+    text = b'\n'.join(contents).replace(b',', b' ')
+    values = np.fromstring(text, dtype=np.int16, sep=' ')
+    if values.size != run_lengths.sum() * n_pixels:
+        # Find the culprit, only on failure
+        for path, content in zip(paths, contents):
+            n_values = np.fromstring(content.replace(b',', b' '),
+                                     dtype=np.int16, sep=' ').size
+            if n_values != _scan_lines(content) * n_pixels:
+                raise ValueError('%s: expected %d values per line, for '
+                                 'images of shape %s' % (path, n_pixels,
+                                                         y_shape))
+        raise ValueError('Could not parse the labels of %s' % (paths, ))
+    if values.min() < -1 or values.max() > 1:
+        raise ValueError('Labels must be -1 (rest), 0 or 1, got values in '
+                         '[%d, %d]' % (values.min(), values.max()))
+    # Pixels are written in column-major order
+    images = values.reshape((-1, ) + tuple(y_shape[::-1])).transpose(0, 2, 1)
+    return Labels(images, run_lengths)
+
+
+def load(paths, y_shape=(10, 10)):
+    """Labels from a list of CSV files, or from a packed .npz file."""
+    if isinstance(paths, str):
+        with np.load(paths) as pack:
+            return Labels.from_packed(pack['label_bits'], pack['rest_bits'],
+                                      pack['run_lengths'], pack['y_shape'])
+    return read_csv(paths, y_shape)
@@ -0,0 +1,183 @@
+# *- encoding: utf-8 -*-
+"""
+Time-lagged designs built from strided views of the stacked runs
+
+The haemodynamic response peaks a few scans after the stimulus. Instead
+of dropping samples run by run, the runs are stacked once and every lag
+of the design is a strided view of that single array: a FIR model with
+several lags does not hold one copy of the data per lag. Samples whose
+window would cross a run boundary are excluded.
+"""
+
+import numpy as np
+from numpy.lib.stride_tricks import as_strided
+
+
+def _check_lags(lags):
+    lags = np.atleast_1d(np.asarray(lags, dtype=int))
+    if lags.ndim != 1 or np.any(lags < 0):
+        raise ValueError('Lags must be non-negative integers, got %s'
+                         % (lags, ))
+    if np.any(np.diff(lags) <= 0):
+        raise ValueError('Lags must be sorted and unique, got %s' % (lags, ))
+    if len(lags) > 2 and len(np.unique(np.diff(lags))) > 1:
+        raise ValueError('Lags must be evenly spaced to be viewed with '
+                         'strides, got %s' % (lags, ))
+    return lags
+
+
+def run_starts(run_lengths):
+    """Index of the first sample of every run in the stacked array."""
+    return np.concatenate([[0], np.cumsum(run_lengths)[:-1]]).astype(int)
+
+
+def stack_runs(runs, dtype=None):
+    """Stack runs in one C-contiguous array, return it with the run lengths.
+    """
+    run_lengths = np.array([len(run) for run in runs])
+    data = np.concatenate(runs, axis=0)
+    if dtype is not None:
+        data = data.astype(dtype, copy=False)
+    return np.ascontiguousarray(data), run_lengths
+
+
+def lag_windows(data, lags):
+    """Read-only view of data at several lags.
+
+    Parameters
+    ----------
+    data: numpy.ndarray
+        Stacked samples, shape (n_samples, n_features).
+
+    lags: list of int
+        Sorted, evenly spaced lags.
+
+    Returns
+    -------
+    windows: numpy.ndarray
+        View of shape (n_samples - max(lags), n_lags, n_features), with
+        windows[r, k] = data[r + lags[k]]. No data is copied.
+    """
+    lags = _check_lags(lags)
+    step = lags[1] - lags[0] if len(lags) > 1 else 1
+    n_windows = data.shape[0] - lags[-1]
+    if n_windows <= 0:
+        raise ValueError('Lag %d is too long for %d samples'
+                         % (lags[-1], data.shape[0]))
+    start = data[lags[0]:]
+    return as_strided(start, shape=(n_windows, len(lags)) + data.shape[1:],
+                      strides=(data.strides[0], step * data.strides[0]) +
+                      data.strides[1:], writeable=False)
+
+
+def lagged_rows(run_lengths, span):
+    """Samples whose window of span scans stays within their run.
+
+    Returns
+    -------
+    rows: numpy.ndarray
+        Indices r, in stacked coordinates, such that r + span is in the
+        same run as r.
+    """
+    rows = [np.arange(start, start + length - span)
+            for start, length in zip(run_starts(run_lengths), run_lengths)
+            if length > span]
+    if not rows:
+        return np.array([], dtype=int)
+    return np.concatenate(rows)
+
+
+def row_runs(run_lengths, rows):
+    """Run index of every row, in stacked coordinates.
+
+    These are the groups of the run-aware cross-validation (see splits).
+    """
+    return np.searchsorted(np.cumsum(run_lengths), rows, side='right')
+
+
+def take(windows, rows):
+    """Materialize the selected windows as a 2D design matrix."""
+    return windows[rows].reshape(len(rows), -1)
+
+
+def take_columns(windows, rows, columns):
+    """Materialize some columns of the design of take(windows, rows).
+
+    Columns are ordered by lag, then feature: only the selected features
+    are read, at their lags, without building the full lagged rows.
+    """
+    lag, feature = np.divmod(np.asarray(columns), windows.shape[2])
+    return windows[np.asarray(rows)[:, np.newaxis], lag, feature]
+
+
+def decoding_design(runs, labels, lags):
+    """Lagged fMRI features of each stimulus.
+
+    The stimulus of scan s is described by the scans s + lag of its run,
+    for every lag.
+
+    Parameters
+    ----------
+    runs: list of numpy.ndarray
+        Masked runs, shape (n_scans, n_voxels) each.
+
+    labels: list of numpy.ndarray
+        Stimuli of each run, first dimension n_scans.
+
+    lags: list of int
+
+    Returns
+    -------
+    windows: numpy.ndarray
+        lag_windows view of the stacked runs.
+
+    rows: numpy.ndarray
+        Valid stimulus scans, in stacked coordinates. windows[rows] are the
+        features, stacked_labels[rows] the targets.
+
+    stacked_labels: numpy.ndarray
+
+    groups: numpy.ndarray
+        Run of every row.
+    """
+    lags = _check_lags(lags)
+    data, run_lengths = stack_runs(runs)
+    stacked_labels, label_lengths = stack_runs(labels)
+    if not np.array_equal(run_lengths, label_lengths):
+        raise ValueError('Runs and labels have different lengths: %s, %s'
+                         % (run_lengths, label_lengths))
+    rows = lagged_rows(run_lengths, lags[-1])
+    return (lag_windows(data, lags), rows, stacked_labels,
+            row_runs(run_lengths, rows))
+
+
+def encoding_design(runs, labels, lags):
+    """Lagged stimuli preceding each scan (FIR encoding design).
+
+    Scan t is described by the stimuli of scans t - lag of its run, for
+    every lag, in order of decreasing lag.
+
+    Returns
+    -------
+    windows: numpy.ndarray
+        lag_windows view of the stacked, flattened stimuli.
+
+    rows: numpy.ndarray
+        Window indices. windows[rows] are the features,
+        stacked_runs[rows + max(lags)] the targets.
+
+    stacked_runs: numpy.ndarray
+
+    groups: numpy.ndarray
+        Run of every row.
+    """
+    lags = _check_lags(lags)
+    data, run_lengths = stack_runs(runs)
+    stimuli, label_lengths = stack_runs(
+        [np.reshape(y, (len(y), -1)) for y in labels])
+    if not np.array_equal(run_lengths, label_lengths):
+        raise ValueError('Runs and labels have different lengths: %s, %s'
+                         % (run_lengths, label_lengths))
+    rows = lagged_rows(run_lengths, lags[-1])
+    return (lag_windows(stimuli, lags[-1] - lags[::-1]), rows, data,
+            row_runs(run_lengths, rows))
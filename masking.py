@@ -2,16 +2,83 @@
 Utilities to compute a brain mask from EPI images
 """
 
+import os
+import hashlib
+import collections
+
 import numpy as np
 from scipy import ndimage
 import nibabel
 
+import instrument
+
 ###############################################################################
 # Time series extraction
 ###############################################################################
 
+INTERPOLATIONS = ('nearest', 'linear')
+
+# Sampling of the mask voxels in image space, by geometry of the mask and
+# of the image, for the most recently used geometries
+_sampling_cache = collections.OrderedDict()
+_SAMPLING_CACHE_SIZE = 8
+
+
+def _sampling(mask_data, mask_affine, img_affine, img_shape, interpolation):
+    """Voxels of the image sampled for every mask voxel, and their weights.
+
+    Returns
+    -------
+    corners: numpy.ndarray
+        Image voxel indices, shape (n_corners, 3, n_mask_voxels): one corner
+        for nearest neighbour, the 8 corners of the cell for trilinear
+        interpolation.
+
+    weights: numpy.ndarray
+        Weights of the corners, shape (n_corners, n_mask_voxels), 0 for
+        corners outside the image.
+    """
+    if interpolation not in INTERPOLATIONS:
+        raise ValueError('Unknown interpolation %r, expected one of %s'
+                         % (interpolation, INTERPOLATIONS))
+    key = hashlib.md5(b''.join([
+        np.packbits(mask_data).tobytes(), repr(mask_data.shape).encode(),
+        np.asarray(mask_affine, dtype=np.float64).tobytes(),
+        np.asarray(img_affine, dtype=np.float64).tobytes(),
+        repr(tuple(img_shape)).encode(), interpolation.encode()])).digest()
+    if key in _sampling_cache:
+        _sampling_cache.move_to_end(key)
+        return _sampling_cache[key]
+
+    # Mask voxels -> world -> image voxels
+    transform = np.dot(np.linalg.inv(img_affine), mask_affine)
+    ijk = np.array(np.nonzero(mask_data), dtype=np.float64)
+    coords = np.dot(transform[:3, :3], ijk) + transform[:3, 3:]
+    shape = np.array(img_shape[:3])[:, np.newaxis]
+    if interpolation == 'nearest':
+        corners = np.round(coords).astype(np.intp)[np.newaxis]
+        weights = np.ones((1, coords.shape[1]))
+    else:
+        floor = np.floor(coords)
+        frac = coords - floor
+        floor = floor.astype(np.intp)
+        corners, weights = [], []
+        for offset in np.ndindex(2, 2, 2):
+            offset = np.array(offset)[:, np.newaxis]
+            corners.append(floor + offset)
+            weights.append(np.prod(np.where(offset, frac, 1 - frac), axis=0))
+        corners, weights = np.array(corners), np.array(weights)
+    inside = np.all((corners >= 0) & (corners < shape), axis=1)
+    weights = np.where(inside, weights, 0.)
+    corners = np.where(inside[:, np.newaxis], corners, 0)
+    _sampling_cache[key] = corners, weights
+    while len(_sampling_cache) > _SAMPLING_CACHE_SIZE:
+        _sampling_cache.popitem(last=False)
+    return corners, weights
+
+
 def apply_mask(niimgs, mask_img, dtype=np.float32,
-                     ensure_finite=True):
+                     ensure_finite=True, interpolation=None):
     """Extract signals from images using specified mask.
 
     Read the time series from the given nifti images or filepaths,
@@ -25,10 +92,20 @@ def apply_mask(niimgs, mask_img, dtype=np.float32,
     mask_img: niimg (x, y, z)
         3D mask array: True where a voxel should be used.
 
+    dtype: numpy dtype
+        dtype of the series, whether the images are resampled or not.
+
     ensure_finite: bool
         If ensure_finite is True (default), the non-finite values (NaNs and
         infs) found in the images will be replaced by zeros.
 
+    interpolation: 'nearest', 'linear' or None
+        If the mask and the images differ in affine or shape, sample the
+        images at the mask voxels by nearest neighbour or trilinear
+        interpolation. Only the mask voxels are sampled, the mappings of
+        the last few geometries being cached. If None (default), a
+        ValueError is raised instead.
+
     Returns
     --------
     session_series: numpy.ndarray
@@ -44,6 +121,12 @@ def apply_mask(niimgs, mask_img, dtype=np.float32,
     # Affine transformation to preserve points from one plane to another.
     affine = niimgs.get_affine()[:3, :3]
 
+    same_geometry = (np.allclose(mask_affine, niimgs.get_affine()) and
+                     mask_data.shape == niimgs.shape[:3])
+    if not same_geometry and interpolation is not None:
+        return _resample_mask(niimgs, mask_data, mask_affine, dtype,
+                              ensure_finite, interpolation)
+
     # Check to make sure the mask affine is similar enough to the image affine.
     if not np.allclose(mask_affine, niimgs.get_affine()):
         raise ValueError('Mask affine: \n%s\n is different from img affine:'
@@ -58,11 +141,41 @@ def apply_mask(niimgs, mask_img, dtype=np.float32,
     # All the following has been optimized for C order.
     # Time that may be lost in conversion here is regained multiple times
     # afterward
-    data = niimgs.get_data()
-    series = np.asarray(data)
-    del data, niimgs  # frees a lot of memory
+    with instrument.span('apply_mask') as span:
+        if nibabel.is_proxy(niimgs.dataobj):
+            # Images already in memory were counted when read
+            span.add_bytes(instrument.file_size(niimgs.get_filename()))
+        data = niimgs.get_data()
+        series = np.asarray(data)
+        del data, niimgs  # frees a lot of memory
 
-    return series[mask_data].T
+        # Same dtype as the resampled runs
+        return series[mask_data].T.astype(dtype, copy=False)
+
+
+def _resample_mask(niimg, mask_data, mask_affine, dtype, ensure_finite,
+                   interpolation):
+    """apply_mask for an image of another geometry than the mask."""
+    corners, weights = _sampling(mask_data, mask_affine, niimg.get_affine(),
+                                 niimg.shape[:3], interpolation)
+    with instrument.span('apply_mask') as span:
+        if nibabel.is_proxy(niimg.dataobj):
+            span.add_bytes(instrument.file_size(niimg.get_filename()))
+        n_volumes = niimg.shape[3] if len(niimg.shape) > 3 else 1
+        series = np.empty((n_volumes, mask_data.sum()), dtype=dtype)
+        start = 0
+        # The run is streamed by blocks of volumes: only the corners of the
+        # mask voxels are kept from each block
+        for block in iter_volumes(niimg):
+            sampled = np.zeros((block.shape[3], series.shape[1]))
+            for (i, j, k), weight in zip(corners, weights):
+                values = block[i, j, k].T
+                if ensure_finite:
+                    values = np.where(np.isfinite(values), values, 0)
+                sampled += weight * values
+            series[start:start + len(sampled)] = sampled
+            start += len(sampled)
+        return series
 
 
 def unmask(X, mask_img, order="C"):
@@ -71,7 +184,8 @@ def unmask(X, mask_img, order="C"):
     Parameters
     ==========
     X: numpy.ndarray
-        Masked data. shape: (samples,)
+        Masked data. shape: (samples,), or (n_maps, samples) to unmask
+        several maps at once into a 4D array (x, y, z, n_maps).
 
     mask_img: niimg
         3D mask array: True where a voxel should be used.
@@ -80,9 +194,193 @@ def unmask(X, mask_img, order="C"):
     mask_img = nibabel.load(mask_img)
     mask_data = mask_img.get_data().astype(bool)
 
-    data = np.zeros(
-        (mask_data.shape[0], mask_data.shape[1], mask_data.shape[2]),
-        dtype=X.dtype, order=order)
+    shape = mask_data.shape[:3]
+    if X.ndim == 2:
+        # One assignment for all the maps
+        data = np.zeros(shape + (X.shape[0],), dtype=X.dtype, order=order)
+        data[mask_data] = X.T
+        return data
+    data = np.zeros(shape, dtype=X.dtype, order=order)
     data[mask_data] = X
     return data
 
+
+###############################################################################
+# Mask computation
+###############################################################################
+
+def iter_volumes(img, chunk_size=16):
+    """Yield blocks of chunk_size volumes of a 4D image, in float64.
+
+    The file is read once, in order, even when gzipped: only chunk_size
+    volumes are in memory at a time.
+    """
+    if isinstance(img, str):
+        img = nibabel.load(img)
+    shape = img.shape[:3]
+    n_volumes = img.shape[3] if len(img.shape) > 3 else 1
+    proxy = img.dataobj
+    if not nibabel.is_proxy(proxy):
+        # In-memory image
+        data = np.asarray(proxy).reshape(shape + (n_volumes, ))
+        for start in range(0, n_volumes, chunk_size):
+            yield data[..., start:start + chunk_size].astype(np.float64)
+        return
+    volume_bytes = int(np.prod(shape)) * proxy.dtype.itemsize
+    with nibabel.openers.ImageOpener(proxy.file_like) as f:
+        f.seek(proxy.offset)
+        for start in range(0, n_volumes, chunk_size):
+            n = min(chunk_size, n_volumes - start)
+            block = np.frombuffer(f.read(n * volume_bytes), dtype=proxy.dtype)
+            block = block.reshape(shape + (n, ), order='F').astype(np.float64)
+            block *= proxy.slope
+            block += proxy.inter
+            yield block
+
+
+def mean_epi(imgs, chunk_size=16):
+    """Mean volume of 4D images, streaming over their volumes.
+
+    Parameters
+    ----------
+    imgs: list of string or nibabel images
+        Runs of the same shape.
+
+    Returns
+    -------
+    mean: numpy.ndarray
+        3D mean volume, non-finite values being ignored.
+    """
+    total, count = None, 0
+    for img in imgs:
+        path = img if isinstance(img, str) else img.get_filename()
+        with instrument.span('mean_epi', instrument.file_size(path)):
+            for block in iter_volumes(img, chunk_size):
+                finite = np.isfinite(block)
+                if total is None:
+                    total = np.zeros(block.shape[:3])
+                    count = np.zeros(block.shape[:3])
+                total += np.where(finite, block, 0.).sum(axis=3)
+                count += finite.sum(axis=3)
+    return total / np.maximum(count, 1)
+
+
+def _largest_component(mask):
+    labels, n_labels = ndimage.label(mask)
+    if n_labels < 2:
+        return mask
+    sizes = np.bincount(labels.ravel())
+    sizes[0] = 0
+    return labels == sizes.argmax()
+
+
+def compute_epi_mask(mean, lower_cutoff=0.2, upper_cutoff=0.85,
+                     connected=True, opening=2):
+    """Brain mask of a mean EPI volume.
+
+    The threshold is in the largest gap of the histogram of intensities
+    between the lower_cutoff and upper_cutoff quantiles, which separates
+    the dark background from the brain. The mask is then cleaned.
+
+    Parameters
+    ----------
+    mean: numpy.ndarray
+        Mean EPI volume, see mean_epi.
+
+    lower_cutoff, upper_cutoff: float
+        Quantiles of the intensities where the threshold is searched.
+
+    connected: bool
+        Keep only the largest connected component.
+
+    opening: int
+        Iterations of the morphological opening removing thin
+        structures, 0 for none.
+
+    Returns
+    -------
+    mask: numpy.ndarray
+        3D boolean mask, holes filled.
+    """
+    values = np.sort(mean[np.isfinite(mean)].ravel())
+    n = len(values)
+    values = values[int(n * lower_cutoff):int(n * upper_cutoff)]
+    if len(values) < 2:
+        raise ValueError('Cannot threshold a volume of %d voxels' % n)
+    gap = np.argmax(np.diff(values))
+    mask = mean >= .5 * (values[gap] + values[gap + 1])
+    with instrument.span('mask_morphology'):
+        if opening:
+            mask = ndimage.binary_opening(mask, iterations=opening)
+        if connected:
+            mask = _largest_component(mask)
+        mask = ndimage.binary_fill_holes(mask)
+    return mask
+
+
+def compute_multi_epi_mask(imgs, threshold=1., chunk_size=16, **params):
+    """Brain mask common to several runs.
+
+    Parameters
+    ----------
+    imgs: list of string or nibabel images
+
+    threshold: float
+        Fraction of the runs whose mask must contain a voxel: 1. for the
+        intersection of the masks, 0. for their union.
+
+    params: dict
+        Parameters of compute_epi_mask.
+
+    Returns
+    -------
+    mask_img: nibabel image
+        int8 mask, with the affine of the first run.
+    """
+    if not 0. <= threshold <= 1.:
+        raise ValueError('threshold must be between 0 and 1, got %r'
+                         % threshold)
+    count = None
+    for img in imgs:
+        mask = compute_epi_mask(mean_epi([img], chunk_size), **params)
+        count = mask.astype(int) if count is None else count + mask
+    if threshold == 0.:
+        mask = count > 0
+    else:
+        mask = count >= threshold * len(imgs)
+    if params.get('connected', True):
+        mask = _largest_component(mask)
+    first = nibabel.load(imgs[0]) if isinstance(imgs[0], str) else imgs[0]
+    return nibabel.Nifti1Image(mask.astype(np.int8), first.get_affine())
+
+
+def files_fingerprint(paths, params=None):
+    """md5 of the path, size and modification time of files, and of params.
+
+    The contents are not read: fingerprinting many runs is instantaneous.
+    """
+    md5 = hashlib.md5()
+    for path in paths:
+        stat = os.stat(path)
+        md5.update(repr((os.path.abspath(path), stat.st_size,
+                         stat.st_mtime_ns)).encode('utf-8'))
+    md5.update(repr(sorted((params or {}).items())).encode('utf-8'))
+    return md5.hexdigest()
+
+
+def cached_epi_mask(paths, directory, **params):
+    """Path of the mask of runs computed by compute_multi_epi_mask, cached
+    in directory by the fingerprint of the runs and of the parameters."""
+    path = os.path.join(directory, 'epi_mask_%s.nii.gz'
+                        % files_fingerprint(paths, params))
+    if not os.path.exists(path):
+        with instrument.span('compute_epi_mask'):
+            mask_img = compute_multi_epi_mask(paths, **params)
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        # Written under a temporary name: concurrent jobs never read a
+        # partial file
+        tmp_path = path[:-len('.nii.gz')] + '.part.nii.gz'
+        nibabel.save(mask_img, tmp_path)
+        os.replace(tmp_path, path)
+    return path
@@ -0,0 +1,382 @@
+# *- encoding: utf-8 -*-
+"""
+Nested cross-validation with hyper-parameter search
+
+The outer folds give unbiased scores, the inner search chooses the
+hyper-parameter of every target (pixel or voxel) on the outer training set
+only. For ridge-type models, the SVD of each outer training set is computed
+once: the leave-one-run-out (or leave-one-out) predictions of the whole
+alpha grid, for all the targets at once, follow from it in closed form.
+Other models (L1 logistic regression, Lasso...) are fitted along a
+warm-started path of their regularization parameter on every inner fold;
+when the parameter belongs to the last step of a pipeline, the previous
+steps (e.g. feature selection) are fitted once per path, not once per
+value. Outer folds run in parallel, and so do groups of targets fitted
+one by one when there are more workers than folds.
+
+Folds are given as a splits.RunSplit, so that inner folds also keep the
+runs whole, or as a number of contiguous folds.
+"""
+
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from scipy import linalg
+from sklearn.base import clone
+from sklearn.pipeline import Pipeline
+from sklearn.utils import Bunch
+
+import instrument
+
+
+def contiguous_folds(n_samples, n_folds):
+    """(train, test) index arrays of n_folds contiguous test blocks."""
+    bounds = np.linspace(0, n_samples, n_folds + 1).astype(int)
+    indices = np.arange(n_samples)
+    return [(np.concatenate([indices[:start], indices[stop:]]),
+             indices[start:stop])
+            for start, stop in zip(bounds[:-1], bounds[1:])]
+
+
+def _as_folds(cv, n_samples):
+    if isinstance(cv, int):
+        return contiguous_folds(n_samples, cv)
+    return list(cv)
+
+
+def _inner_folds(cv, train, n_samples, n_folds):
+    """Inner folds of an outer training set, in its own coordinates.
+
+    Runs are kept whole if cv is a RunSplit. With n_folds None, one fold
+    per run, or None (leave-one-out) without runs.
+    """
+    if hasattr(cv, 'inner'):
+        return list(cv.inner(train, n_folds))
+    if n_folds is None:
+        return None
+    return contiguous_folds(len(np.arange(n_samples)[train]), n_folds)
+
+
+def score_targets(y_true, y_pred, classification=False):
+    """Accuracy or R² of every column of y_true."""
+    if y_true.ndim == 1:
+        y_true, y_pred = y_true[:, np.newaxis], y_pred[:, np.newaxis]
+    if classification:
+        return np.mean(y_true == y_pred, axis=0)
+    ss_res = ((y_true - y_pred) ** 2).sum(axis=0)
+    ss_tot = ((y_true - y_true.mean(axis=0)) ** 2).sum(axis=0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return 1. - ss_res / ss_tot
+
+
+###############################################################################
+# Ridge-type models: one SVD per outer fold
+###############################################################################
+
+class SVDRidge(object):
+    """Ridge regressions of many targets for many alphas, from one SVD.
+
+    The intercept is not penalized. With the centered design
+    Xc = U S V^T, the hat matrix is H = 1/n + U diag(s² / (s² + alpha)) U^T,
+    which gives the exact held-out residuals of every alpha without
+    refitting: r_i / (1 - H_ii) when leaving sample i out, and
+    (I - H_bb)^-1 r_b when leaving a block b (a run) out.
+
+    Parameters
+    ----------
+    X: numpy.ndarray
+        Training design, shape (n_samples, n_features).
+
+    Y: numpy.ndarray
+        Training targets, shape (n_samples, n_targets).
+    """
+
+    def __init__(self, X, Y):
+        with instrument.span('svd'):
+            self.x_mean = X.mean(axis=0)
+            self.y_mean = Y.mean(axis=0)
+            self.U, self.s, self.Vt = linalg.svd(X - self.x_mean,
+                                                 full_matrices=False)
+            self.Y = Y - self.y_mean
+            self.UtY = np.dot(self.U.T, self.Y)
+        self.n_samples = X.shape[0]
+
+    def loo_predictions(self, alpha, blocks=None):
+        """Held-out predictions of all targets, for one alpha.
+
+        Parameters
+        ----------
+        alpha: float
+
+        blocks: list of slices, optional
+            Contiguous blocks (e.g. runs) left out in turn. Default: every
+            sample is left out in turn.
+        """
+        d = self.s ** 2 / (self.s ** 2 + alpha)
+        residuals = self.Y - np.dot(self.U, d[:, np.newaxis] * self.UtY)
+        if blocks is None:
+            hat = 1. / self.n_samples + np.dot(self.U ** 2, d)
+            residuals /= (1. - hat)[:, np.newaxis]
+        else:
+            for block in blocks:
+                U = self.U[block]
+                hat = 1. / self.n_samples + np.dot(U * d, U.T)
+                residuals[block] = linalg.solve(
+                    np.eye(len(hat)) - hat, residuals[block])
+        return self.Y - residuals + self.y_mean
+
+    def coef(self, alphas):
+        """Weights and intercepts, with one alpha per target.
+
+        Returns
+        -------
+        coef: numpy.ndarray, shape (n_targets, n_features)
+
+        intercept: numpy.ndarray, shape (n_targets,)
+        """
+        alphas = np.asarray(alphas)
+        coef = np.empty((self.UtY.shape[1], self.Vt.shape[1]))
+        for alpha in np.unique(alphas):
+            targets = alphas == alpha
+            d = self.s / (self.s ** 2 + alpha)
+            coef[targets] = np.dot(self.Vt.T,
+                                   d[:, np.newaxis] * self.UtY[:, targets]).T
+        intercept = self.y_mean - np.dot(coef, self.x_mean)
+        return coef, intercept
+
+
+def _ridge_outer_fold(X, Y, train, test, inner, alphas, classification):
+    ridge = SVDRidge(X[train], Y[train])
+    y_true = Y[train]
+    blocks = None if inner is None else [t for _, t in inner]
+    best_score = np.empty(Y.shape[1])
+    best_score.fill(-np.inf)
+    best_alpha = np.empty(Y.shape[1])
+    with instrument.span('inner_grid'):
+        for alpha in alphas:
+            pred = ridge.loo_predictions(alpha, blocks)
+            if classification:
+                score = score_targets(y_true > 0, pred > 0, True)
+            else:
+                score = -((y_true - pred) ** 2).mean(axis=0)
+            better = score > best_score
+            best_score[better] = score[better]
+            best_alpha[better] = alpha
+    coef, intercept = ridge.coef(best_alpha)
+    pred = np.dot(X[test], coef.T) + intercept
+    if classification:
+        scores = score_targets(Y[test] > 0, pred > 0, True)
+    else:
+        scores = score_targets(Y[test], pred)
+    return best_alpha, scores
+
+
+def nested_ridge(X, Y, alphas, cv=5, classification=False, n_jobs=1):
+    """Nested cross-validation of ridge models, one alpha per target.
+
+    Parameters
+    ----------
+    X: numpy.ndarray
+        Design, shape (n_samples, n_features).
+
+    Y: numpy.ndarray
+        Targets, shape (n_samples, n_targets). For classification, binary
+        targets coded as 0/1 or -1/1.
+
+    alphas: list of float
+        Grid of regularization parameters.
+
+    cv: RunSplit, int or list of (train, test)
+        Outer folds. An int gives contiguous folds. With a RunSplit, alpha
+        is chosen by leave-one-run-out on the outer training set,
+        otherwise by leave-one-out.
+
+    classification: bool
+        If True, ridge classifiers are chosen and scored on accuracy,
+        otherwise ridge regressions on squared error and R².
+
+    n_jobs: int
+        Number of outer folds processed in parallel.
+
+    Returns
+    -------
+    result: Bunch
+        'scores' and 'params', arrays of shape (n_outer_folds, n_targets)
+        holding the outer test score and the chosen alpha of every target.
+    """
+    Y = np.asarray(Y, dtype=np.float64)
+    if Y.ndim == 1:
+        Y = Y[:, np.newaxis]
+    if classification:
+        # Targets coded as -1/1, the decision threshold is 0
+        Y = np.where(Y > 0, 1., -1.)
+    folds = _as_folds(cv, X.shape[0])
+    args = [(X, Y, train, test, _inner_folds(cv, train, X.shape[0], None),
+             alphas, classification) for train, test in folds]
+    with instrument.span('nested_ridge'):
+        if n_jobs == 1:
+            results = [_ridge_outer_fold(*a) for a in args]
+        else:
+            with ProcessPoolExecutor(min(n_jobs, len(folds))) as executor:
+                results = [instrument.merge(r) for r in executor.map(
+                    instrument.remote(_ridge_outer_fold), *zip(*args))]
+    return Bunch(params=np.array([r[0] for r in results]),
+                 scores=np.array([r[1] for r in results]))
+
+
+###############################################################################
+# Other models: warm-started regularization paths
+###############################################################################
+
+def _split_path(estimator, param):
+    """Steps fitted once per path (or None), the model fitted along it and
+    its parameter."""
+    steps = getattr(estimator, 'steps', None)
+    if steps and len(steps) > 1 and param.startswith(steps[-1][0] + '__'):
+        name, model = steps[-1]
+        return Pipeline(steps[:-1]), model, param[len(name) + 2:]
+    return None, estimator, param
+
+
+def _path_scores(estimator, X, Y, train, test, param, grid, classification,
+                 multi_output):
+    """Test scores along the path of param, shape (len(grid), n_targets).
+
+    Parameters are visited in the given order: the grid should go from
+    the strongest to the weakest regularization so that every fit starts
+    from the sparse solution of the previous one.
+    """
+    if multi_output:
+        targets = [slice(None)]
+    else:
+        targets = [slice(t, t + 1) for t in range(Y.shape[1])]
+    scores = np.empty((len(grid), Y.shape[1]))
+    X_train, X_test = X[train], X[test]
+    head, model, param = _split_path(estimator, param)
+    for target in targets:
+        y_train = Y[train, target]
+        if not multi_output:
+            y_train = y_train.ravel()
+        Z_train, Z_test = X_train, X_test
+        if head is not None:
+            # The same features are used along the whole path
+            head = clone(head)
+            Z_train = head.fit_transform(X_train, y_train)
+            Z_test = head.transform(X_test)
+        est = clone(model)
+        # Also reaches the final step of a sklearn Pipeline
+        est.set_params(**dict((key, True) for key in est.get_params()
+                              if key.split('__')[-1] == 'warm_start'))
+        for g, value in enumerate(grid):
+            est.set_params(**{param: value})
+            est.fit(Z_train, y_train)
+            pred = est.predict(Z_test)
+            pred = pred.reshape(pred.shape[0], -1)
+            scores[g, target] = score_targets(Y[test, target], pred,
+                                              classification)
+    return scores
+
+
+def _path_outer_fold(estimator, X, Y, train, test, inner, param, grid,
+                     classification, multi_output):
+    inner_scores = np.zeros((len(grid), Y.shape[1]))
+    X_train, Y_train = X[train], Y[train]
+    with instrument.span('inner_path'):
+        for inner_train, inner_test in inner:
+            inner_scores += _path_scores(
+                estimator, X_train, Y_train, inner_train, inner_test,
+                param, grid, classification, multi_output)
+    best = np.argmax(inner_scores, axis=0)
+    best_values = np.asarray(grid)[best]
+    scores = np.empty(Y.shape[1])
+    # Refit on the outer training set, grouping the targets sharing a value
+    for g in np.unique(best):
+        targets = np.where(best == g)[0]
+        est = clone(estimator).set_params(**{param: grid[g]})
+        if multi_output:
+            est.fit(X_train, Y_train[:, targets])
+            pred = est.predict(X[test])
+            pred = pred.reshape(pred.shape[0], -1)
+            scores[targets] = score_targets(Y[test][:, targets], pred,
+                                            classification)
+        else:
+            for t in targets:
+                est.fit(X_train, Y_train[:, t])
+                scores[t] = score_targets(Y[test, t], est.predict(X[test]),
+                                          classification)[0]
+    return best_values, scores
+
+
+def nested_path(estimator, X, Y, param, grid, cv=5, n_inner=5,
+                classification=False, multi_output=False, n_jobs=1):
+    """Nested cross-validation along a warm-started regularization path.
+
+    Parameters
+    ----------
+    estimator: sklearn estimator or Pipeline
+        Model whose parameter param is searched. If it has a warm_start
+        parameter, it is switched on along the path.
+
+    X: numpy.ndarray
+        Design, shape (n_samples, n_features).
+
+    Y: numpy.ndarray
+        Targets, shape (n_samples, n_targets).
+
+    param: string
+        Name of the searched parameter (e.g. 'C', 'alpha' or 'clf__C').
+
+    grid: list
+        Values of param, from the strongest to the weakest regularization.
+
+    cv: RunSplit, int or list of (train, test)
+        Outer folds. An int gives contiguous folds.
+
+    n_inner: int
+        Number of inner folds, made of whole runs with a RunSplit.
+
+    classification: bool
+        Score on accuracy rather than R².
+
+    multi_output: bool
+        If True, the estimator fits all targets at once (e.g. Lasso).
+        Otherwise one model is fitted per target.
+
+    n_jobs: int
+        Number of worker processes. Without multi_output, the targets of
+        every outer fold are split between them if there are fewer outer
+        folds than workers.
+
+    Returns
+    -------
+    result: Bunch
+        'scores' and 'params', arrays of shape (n_outer_folds, n_targets).
+    """
+    Y = np.asarray(Y)
+    if Y.ndim == 1:
+        Y = Y[:, np.newaxis]
+    folds = _as_folds(cv, X.shape[0])
+    n_chunks = 1
+    if not multi_output:
+        n_chunks = min(Y.shape[1], -(-n_jobs // len(folds)))
+    chunks = np.array_split(np.arange(Y.shape[1]), n_chunks)
+    args = [(estimator, X, Y[:, chunk], train, test, inner, param,
+             list(grid), classification, multi_output)
+            for train, test in folds
+            for inner in [_inner_folds(cv, train, X.shape[0], n_inner)]
+            for chunk in chunks]
+    with instrument.span('nested_path'):
+        if n_jobs == 1:
+            results = [_path_outer_fold(*a) for a in args]
+        else:
+            with ProcessPoolExecutor(min(n_jobs, len(args))) as executor:
+                results = [instrument.merge(r) for r in executor.map(
+                    instrument.remote(_path_outer_fold), *zip(*args))]
+    # Targets of every outer fold, back in order
+    results = [results[i:i + n_chunks]
+               for i in range(0, len(results), n_chunks)]
+    return Bunch(
+        params=np.array([np.concatenate([r[0] for r in fold])
+                         for fold in results]),
+        scores=np.array([np.concatenate([r[1] for r in fold])
+                         for fold in results]))
@@ -0,0 +1,324 @@
+# *- encoding: utf-8 -*-
+"""
+Out-of-core analyses for datasets larger than memory
+
+The masked and cleaned runs are written one run at a time in a single
+stacked array on disk, and memory-mapped afterwards. The designs are never
+materialized: they are read by blocks of rows whose size follows the
+memory budget, and fed to
+
+  * streamed sufficient statistics (ANOVA F scores of the feature
+    selection), after which only the selected voxels are gathered in
+    memory, so that the in-memory estimators give the same scores;
+  * minibatch solvers (``partial_fit``) for models using every voxel;
+  * column chunks, for models predicting many voxels independently.
+
+Enabled with the ``--out-of-core`` option; ``--memory`` sets the budget.
+"""
+
+import os
+import sys
+
+import numpy as np
+import nibabel
+from numpy.lib.format import open_memmap
+from sklearn.base import is_classifier
+
+import instrument
+import lags
+import prefetch
+
+
+###############################################################################
+# Memory budget
+###############################################################################
+
+def available_memory():
+    """Physical memory of the machine, in bytes."""
+    try:
+        return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+    except (ValueError, OSError, AttributeError):
+        return 4 * 1024 ** 3
+
+
+def parse_memory(value):
+    """Memory size from a string such as '512M' or '16G', in bytes."""
+    units = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3, 'T': 1024 ** 4}
+    value = value.strip().upper().rstrip('B')
+    if value and value[-1] in units:
+        return int(float(value[:-1]) * units[value[-1]])
+    return int(value)
+
+
+def memory_budget(options):
+    """Bytes a worker may use: the --memory option shared by the jobs, or
+    a quarter of the physical memory."""
+    budget = options.get('memory') or available_memory() // 4
+    return budget // max(options.get('n_jobs') or 1, 1)
+
+
+def block_rows(row_bytes, budget):
+    """Number of rows of row_bytes each, such that a block and its
+    temporaries (about four copies) fit in the budget."""
+    return int(max(1, budget // (4 * max(row_bytes, 1))))
+
+
+###############################################################################
+# Stacked runs on disk
+###############################################################################
+
+class RunStack(object):
+    """Runs stacked in one .npy file, opened as a read-only memory map.
+
+    Only the path and run lengths are pickled, so checkpoints and worker
+    processes never copy the data.
+    """
+
+    def __init__(self, path, run_lengths):
+        self.path = path
+        self.run_lengths = np.asarray(run_lengths)
+        self._data = None
+
+    def __getstate__(self):
+        return dict(path=self.path, run_lengths=self.run_lengths)
+
+    def __setstate__(self, state):
+        self.__init__(**state)
+
+    @property
+    def data(self):
+        if self._data is None:
+            self._data = np.load(self.path, mmap_mode='r')
+        return self._data
+
+    def runs(self):
+        """Memory-mapped view of every run."""
+        starts = lags.run_starts(self.run_lengths)
+        return [self.data[start:start + length]
+                for start, length in zip(starts, self.run_lengths)]
+
+
+def _write_stack(path, shapes, dtype, runs):
+    """Write the arrays yielded by runs in one .npy file, atomically."""
+    directory = os.path.dirname(path)
+    if directory and not os.path.exists(directory):
+        os.makedirs(directory)
+    n_samples = int(sum(s[0] for s in shapes))
+    part = path + '.part'
+    out = open_memmap(part, mode='w+', dtype=dtype,
+                      shape=(n_samples, int(shapes[0][1])))
+    start = 0
+    for run in runs:
+        out[start:start + len(run)] = run
+        start += len(run)
+    out.flush()
+    del out
+    os.replace(part, path)
+    return RunStack(path, [int(s[0]) for s in shapes])
+
+
+def array_dir(pipe):
+    """Where the arrays of an out-of-core pipeline are written."""
+    return os.path.join(pipe.directory or os.path.join(
+        pipe.options.get('output_dir', 'output'), 'scratch'), 'arrays')
+
+
+def mask_stage(state, pipe):
+    """Mask the runs one at a time into a stacked array on disk."""
+    import masking
+    mask_img = nibabel.load(state['dataset'].mask)
+    n_voxels = int(np.count_nonzero(mask_img.get_data()))
+    shapes = []
+    for path in state['func']:
+        shape = nibabel.load(path).shape
+        shapes.append((shape[3] if len(shape) > 3 else 1, n_voxels))
+
+    # The next runs are read while the current one is masked and written
+    loader = prefetch.prefetch_runs(state['func'], pipe.options)
+    masked = (masking.apply_mask(
+        img, mask_img, interpolation=pipe.options.get('interpolation'))
+        for img in loader)
+    stack = _write_stack(os.path.join(array_dir(pipe), 'masked.npy'),
+                         shapes, np.float32, masked)
+    loader.report()
+    sys.stderr.write("Masked %d scans of %d voxels on disk\n"
+                     % (stack.data.shape[0], n_voxels))
+    return dict(stack=stack)
+
+
+def clean_stage(state, pipe):
+    """Clean the runs one at a time, from and to the disk."""
+    import pipeline
+    import preprocess
+    stack = state['stack']
+    cleaned = (preprocess.clean(np.asarray(run), **pipeline.clean_params)
+               for run in stack.runs())
+    return dict(stack=_write_stack(
+        os.path.join(array_dir(pipe), 'cleaned.npy'),
+        [(n, stack.data.shape[1]) for n in stack.run_lengths],
+        np.float32, cleaned))
+
+
+###############################################################################
+# Designs read by blocks
+###############################################################################
+
+def _positions(X, index):
+    positions = np.arange(len(X))
+    if index is not None:
+        positions = positions[index]
+    return positions
+
+
+def _iter_blocks(X, index, block_size):
+    """Yield (positions, X[positions]) by blocks of the rows in index."""
+    positions = _positions(X, index)
+    for start in range(0, len(positions), block_size):
+        block = positions[start:start + block_size]
+        yield block, X[block]
+
+
+class StackRows(object):
+    """Rows of the stacked runs, optionally with lags, as a virtual matrix.
+
+    Row i is the concatenation of data[rows[i] + lag] for every lag (see
+    lags.lag_windows). Indexing with rows (an int, slice or index array)
+    materializes only those rows.
+
+    Parameters
+    ----------
+    stack: RunStack
+
+    rows: numpy.ndarray
+        Rows in stacked coordinates.
+
+    lags: list of int, optional
+    """
+
+    def __init__(self, stack, rows, lags=(0,)):
+        self.stack = stack
+        self.rows = np.asarray(rows)
+        self.lags = tuple(lags)
+        n_features = stack.data.shape[1] * len(self.lags)
+        self.shape = (len(self.rows), n_features)
+        self.row_bytes = n_features * stack.data.dtype.itemsize
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, index):
+        windows = lags.lag_windows(self.stack.data, self.lags)
+        if np.ndim(index) == 0 and not isinstance(index, slice):
+            return lags.take(windows, self.rows[[index]])[0]
+        return lags.take(windows, self.rows[index])
+
+    def blocks(self, index=None, block_size=256):
+        """Yield (positions, block) over the rows selected by index."""
+        return _iter_blocks(self, index, block_size)
+
+    def columns(self, columns, index=None, block_size=256):
+        """Materialize some columns of the selected rows, in float64.
+
+        Only the features of the columns are read, at their lags.
+        """
+        windows = lags.lag_windows(self.stack.data, self.lags)
+        positions = _positions(self, index)
+        out = np.empty((len(positions), len(columns)))
+        for start in range(0, len(positions), block_size):
+            block = self.rows[positions[start:start + block_size]]
+            out[start:start + len(block)] = lags.take_columns(
+                windows, block, columns)
+        return out
+
+
+def f_classif_stream(X, Y, index=None, block_size=256):
+    """ANOVA F scores of binary targets, from statistics streamed by
+    blocks of rows.
+
+    Same formula as sklearn.feature_selection.f_classif for two classes,
+    for all targets in one pass over the data.
+
+    Parameters
+    ----------
+    X: StackRows or numpy.ndarray
+        Design, shape (n_samples, n_features).
+
+    Y: numpy.ndarray
+        0/1 targets, shape (n_samples, n_targets).
+
+    index: slice or index array, optional
+        Rows used, e.g. the training set of a fold.
+
+    Returns
+    -------
+    F: numpy.ndarray, shape (n_targets, n_features)
+    """
+    n_features = X.shape[1]
+    Y = np.asarray(Y)
+    s = np.zeros(n_features)
+    ss = np.zeros(n_features)
+    s1 = np.zeros((Y.shape[1], n_features))
+    n1 = np.zeros(Y.shape[1])
+    n = 0
+    with instrument.span('f_classif_stream'):
+        for positions, block in _iter_blocks(X, index, block_size):
+            block = np.asarray(block, dtype=np.float64)
+            y = (Y[positions] > 0).astype(np.float64)
+            n += len(block)
+            s += block.sum(axis=0)
+            ss += np.einsum('ij,ij->j', block, block)
+            s1 += np.dot(y.T, block)
+            n1 += y.sum(axis=0)
+    n0 = n - n1
+    s0 = s - s1
+    with np.errstate(divide='ignore', invalid='ignore'):
+        ss_alldata = ss - s ** 2 / n
+        ssbn = (s1 ** 2 / n1[:, np.newaxis] + s0 ** 2 / n0[:, np.newaxis]
+                - s ** 2 / n)
+        sswn = ss_alldata - ssbn
+        return ssbn / (sswn / (n - 2))
+
+
+def select_k_best(F, k):
+    """Columns of the k best scores of every target, in increasing order,
+    as selected by SelectKBest."""
+    F = np.where(np.isnan(F), np.finfo(F.dtype).min, F)
+    best = np.argsort(F, axis=1, kind='mergesort')[:, -k:]
+    return np.sort(best, axis=1)
+
+
+def partial_fit_stream(estimator, X, y, index=None, block_size=256,
+                       n_epochs=5, random_state=0):
+    """Fit an estimator with partial_fit on minibatches of rows.
+
+    Blocks are visited in a different random order at every epoch.
+    """
+    rng = np.random.RandomState(random_state)
+    positions = _positions(X, index)
+    starts = np.arange(0, len(positions), block_size)
+    kwargs = {}
+    if is_classifier(estimator):
+        kwargs['classes'] = np.unique(y[positions])
+    with instrument.span('partial_fit'):
+        for _ in range(n_epochs):
+            for start in rng.permutation(starts):
+                sl = positions[start:start + block_size]
+                estimator.partial_fit(np.asarray(X[sl], dtype=np.float64),
+                                      y[sl], **kwargs)
+    return estimator
+
+
+def predictions_file(path, shape):
+    """Memory map receiving predictions, moved to path by finish_file."""
+    directory = os.path.dirname(path)
+    if directory and not os.path.exists(directory):
+        os.makedirs(directory)
+    return open_memmap(path + '.part', mode='w+', dtype=np.float64,
+                       shape=tuple(int(n) for n in shape))
+
+
+def finish_file(out, path):
+    out.flush()
+    del out
+    os.replace(path + '.part', path)
+    return path
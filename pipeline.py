@@ -0,0 +1,610 @@
+# *- encoding: utf-8 -*-
+"""
+Staged, restartable execution of the analyses
+
+An analysis is a chain of named stages (fetch -> mask -> clean -> select
+[-> reduce] -> fit [-> stability] -> score [-> rsa] [-> bundle] ->
+render, the bracketed ones being optional). Every stage returns a dict of
+outputs that is merged into the pipeline state and checkpointed to disk,
+so that a rerun skips the stages already completed. Long stages split
+their work into tasks (e.g. one cross-validation per (pipeline, pixel))
+that are checkpointed one by one, so an interrupted stage resumes at the
+last finished task.
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import pickle
+import hashlib
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from multiprocessing import shared_memory
+
+import numpy as np
+import nibabel
+
+import instrument
+import outofcore
+import prefetch
+
+STAGES = ('fetch', 'mask', 'clean', 'pack', 'select', 'reduce', 'fit',
+          'stability', 'score', 'rsa', 'bundle', 'render')
+
+# Parameters of preprocess.clean, also recorded in the decoder bundles
+clean_params = dict(detrend=True, standardize=True, low_pass=None,
+                    high_pass=None, t_r=2.5)
+
+# Arrays of the task arguments larger than this are put once in shared
+# memory for the worker processes, rather than pickled with every task
+share_bytes = 1 << 20
+
+
+def _atomic_write(path, write):
+    """Call write(file) on a temporary file, then move it to path."""
+    tmp_path = path + '.part'
+    with open(tmp_path, 'wb') as f:
+        write(f)
+    os.replace(tmp_path, path)
+
+
+class Stage(object):
+    """A named step of a pipeline.
+
+    Parameters
+    ----------
+    name: string
+        Name of the stage, used for checkpoints and timings.
+
+    func: callable
+        func(state, pipeline) returning a dict of outputs.
+
+    params: dict, optional
+        Parameters the outputs depend on. Changing them invalidates the
+        checkpoint of this stage and of the following ones.
+    """
+
+    def __init__(self, name, func, params=None):
+        self.name = name
+        self.func = func
+        self.params = params or {}
+
+
+class TaskStore(object):
+    """Directory holding the results of the tasks of a stage.
+
+    The store is emptied when the stage fingerprint changes, so results
+    computed from stale inputs are never reused. If directory is None,
+    results are only kept in memory.
+    """
+
+    def __init__(self, directory, fingerprint):
+        self.directory = directory
+        self._memory = {}
+        if directory is None:
+            return
+        stamp = os.path.join(directory, 'fingerprint')
+        if os.path.exists(stamp):
+            with open(stamp) as f:
+                if f.read() != fingerprint:
+                    shutil.rmtree(directory)
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+            with open(stamp, 'w') as f:
+                f.write(fingerprint)
+
+    def _path(self, key):
+        return os.path.join(self.directory, '%s.npy' % '-'.join(map(str, key)))
+
+    def done(self, key):
+        if self.directory is None:
+            return key in self._memory
+        return os.path.exists(self._path(key))
+
+    def save(self, key, value):
+        if self.directory is None:
+            self._memory[key] = np.asarray(value)
+        else:
+            _atomic_write(self._path(key), lambda f: np.save(f, value))
+
+    def load(self, key):
+        if self.directory is None:
+            return self._memory[key]
+        return np.load(self._path(key))
+
+
+# Arrays shared with the worker processes of run_tasks, by index
+_shared = {}
+
+
+class _SharedArray(object):
+    """Placeholder of a task argument held in shared memory."""
+
+    def __init__(self, index):
+        self.index = index
+
+
+def _attach(specs):
+    for index, (name, shape, dtype) in enumerate(specs):
+        shm = shared_memory.SharedMemory(name=name)
+        array = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+        array.flags.writeable = False
+        _shared[index] = (shm, array)
+
+
+class _SharedTask(object):
+    """func, called with the shared arrays in place of their placeholders.
+    """
+
+    def __init__(self, func):
+        self.func = func
+
+    def __call__(self, *args):
+        return self.func(*[_shared[arg.index][1]
+                           if isinstance(arg, _SharedArray) else arg
+                           for arg in args])
+
+
+def _share_arrays(tasks):
+    """Tasks whose large array arguments are replaced by placeholders, and
+    the distinct arrays replaced."""
+    arrays, shared_tasks = [], []
+    for key, args in tasks:
+        args = list(args)
+        for i, arg in enumerate(args):
+            if type(arg) is np.ndarray and arg.nbytes > share_bytes:
+                index = [j for j, array in enumerate(arrays)
+                         if array is arg]
+                if not index:
+                    index = [len(arrays)]
+                    arrays.append(arg)
+                args[i] = _SharedArray(index[0])
+        shared_tasks.append((key, args))
+    return shared_tasks, arrays
+
+
+def run_tasks(store, tasks, func, n_jobs=1):
+    """Run func(*args) for the tasks not yet in store.
+
+    Parameters
+    ----------
+    store: TaskStore
+        Where results are checkpointed, one file per task.
+
+    tasks: list of (key, args)
+        key is a tuple of strings and ints identifying the task.
+
+    func: callable
+        Picklable function computing the result of a task.
+
+    n_jobs: int
+        Number of worker processes. Array arguments larger than
+        share_bytes (e.g. the design) are copied once in shared memory,
+        read-only for the workers, instead of being pickled with every
+        task.
+
+    Returns
+    -------
+    results: dict
+        Result of every task, indexed by key.
+    """
+    pending = [(key, args) for key, args in tasks if not store.done(key)]
+    if pending:
+        sys.stderr.write("\t%d/%d tasks to run\n" % (len(pending), len(tasks)))
+    if n_jobs == 1 or len(pending) < 2:
+        for key, args in pending:
+            store.save(key, func(*args))
+    else:
+        pending, arrays = _share_arrays(pending)
+        specs, blocks = [], []
+        try:
+            for array in arrays:
+                shm = shared_memory.SharedMemory(create=True,
+                                                 size=max(array.nbytes, 1))
+                blocks.append(shm)
+                np.ndarray(array.shape, dtype=array.dtype,
+                           buffer=shm.buf)[...] = array
+                specs.append((shm.name, array.shape, array.dtype))
+            # The spans of the workers are merged in the profile
+            task = instrument.remote(_SharedTask(func))
+            with ProcessPoolExecutor(min(n_jobs, len(pending)),
+                                     initializer=_attach,
+                                     initargs=(specs, )) as executor:
+                futures = dict((executor.submit(task, *args), key)
+                               for key, args in pending)
+                for future in as_completed(futures):
+                    store.save(futures[future],
+                               instrument.merge(future.result()))
+        finally:
+            for shm in blocks:
+                shm.close()
+                shm.unlink()
+    return dict((key, store.load(key)) for key, args in tasks)
+
+
+class Pipeline(object):
+    """Chain of stages with on-disk checkpoints.
+
+    Parameters
+    ----------
+    name: string
+        Name of the analysis, checkpoints go in checkpoint_dir/name.
+
+    stages: list of Stage
+
+    checkpoint_dir: string or None
+        Root of the checkpoints. If None, nothing is written and every
+        stage is computed.
+
+    options: dict, optional
+        Run options that do not change the results (number of jobs,
+        output directory...), available to the stages.
+    """
+
+    def __init__(self, name, stages, checkpoint_dir='checkpoints',
+                 options=None):
+        self.name = name
+        self.stages = list(stages)
+        self.options = options or {}
+        if checkpoint_dir is None:
+            self.directory = None
+        else:
+            self.directory = os.path.join(checkpoint_dir, name)
+        self._fingerprints = {}
+        fingerprint = name
+        for stage in self.stages:
+            fingerprint = hashlib.md5(json.dumps(
+                [fingerprint, stage.name, stage.params], sort_keys=True,
+                default=str).encode('utf-8')).hexdigest()
+            self._fingerprints[stage.name] = fingerprint
+
+    def stage_names(self):
+        return [stage.name for stage in self.stages]
+
+    def _index_path(self, stage):
+        return os.path.join(self.directory, '%s.json' % stage.name)
+
+    def _data_path(self, stage):
+        return os.path.join(self.directory, '%s.pkl' % stage.name)
+
+    def completed(self, stage):
+        """Whether stage has an up-to-date checkpoint."""
+        if self.directory is None:
+            return False
+        try:
+            with open(self._index_path(stage)) as f:
+                index = json.load(f)
+        except (IOError, ValueError):
+            return False
+        return index['fingerprint'] == self._fingerprints[stage.name]
+
+    def _keys(self, stage):
+        with open(self._index_path(stage)) as f:
+            return json.load(f)['keys']
+
+    def _load(self, stage):
+        with open(self._data_path(stage), 'rb') as f:
+            return pickle.load(f)
+
+    def _save(self, stage, outputs, duration):
+        _atomic_write(self._data_path(stage),
+                      lambda f: pickle.dump(outputs, f, protocol=-1))
+        index = {'fingerprint': self._fingerprints[stage.name],
+                 'keys': sorted(outputs), 'duration': duration}
+        # The index is written last: it marks the stage as completed
+        _atomic_write(self._index_path(stage),
+                      lambda f: f.write(json.dumps(index).encode('utf-8')))
+
+    def tasks(self, stage_name):
+        """TaskStore of a stage, for task-level resumption."""
+        directory = None
+        if self.directory is not None:
+            directory = os.path.join(self.directory, stage_name + '_tasks')
+        return TaskStore(directory, self._fingerprints[stage_name])
+
+    def invalidate(self, stage_name):
+        """Drop the checkpoints of stage_name and of the following stages."""
+        names = self.stage_names()
+        if stage_name not in names:
+            raise ValueError("Pipeline %s has no stage %s, stages are: %s"
+                             % (self.name, stage_name, ', '.join(names)))
+        if self.directory is None:
+            return
+        for stage in self.stages[names.index(stage_name):]:
+            for path in (self._index_path(stage), self._data_path(stage)):
+                if os.path.exists(path):
+                    os.remove(path)
+            tasks_dir = os.path.join(self.directory, stage.name + '_tasks')
+            if os.path.exists(tasks_dir):
+                shutil.rmtree(tasks_dir)
+
+    def run(self, until=None, skip=()):
+        """Run the stages, resuming after the last completed one.
+
+        Parameters
+        ----------
+        until: string, optional
+            Name of the last stage to run.
+
+        skip: list of string, optional
+            Stages not to run (e.g. 'render' for --no-plots).
+
+        Returns
+        -------
+        state: dict
+            Outputs of all the stages run or loaded.
+        """
+        names = self.stage_names()
+        if until is not None and until not in names:
+            raise ValueError("Pipeline %s has no stage %s, stages are: %s"
+                             % (self.name, until, ', '.join(names)))
+        stop = len(names) if until is None else names.index(until) + 1
+        stages = [s for s in self.stages[:stop] if s.name not in skip]
+        if self.directory is not None and not os.path.exists(self.directory):
+            os.makedirs(self.directory)
+
+        # Stages are resumed after the longest completed prefix
+        n_done = 0
+        while n_done < len(stages) and self.completed(stages[n_done]):
+            n_done += 1
+
+        # Load the outputs of completed stages that are still needed: later
+        # stages overwrite the keys of earlier ones.
+        state = {}
+        for stage in reversed(stages[:n_done]):
+            if not set(self._keys(stage)) <= set(state):
+                for key, value in self._load(stage).items():
+                    state.setdefault(key, value)
+        for stage in stages[:n_done]:
+            sys.stderr.write("[%s] %s: checkpoint found, skipped\n"
+                             % (self.name, stage.name))
+
+        for stage in stages[n_done:]:
+            sys.stderr.write("[%s] %s...\n" % (self.name, stage.name))
+            t0 = time.time()
+            with instrument.span(stage.name):
+                outputs = stage.func(state, self) or {}
+            duration = time.time() - t0
+            state.update(outputs)
+            if self.directory is not None:
+                self._save(stage, outputs, duration)
+            sys.stderr.write("[%s] %s: done (%.2fs)\n"
+                             % (self.name, stage.name, duration))
+        return state
+
+
+def add_arguments(parser):
+    """Options shared by the commands running a pipeline."""
+    parser.add_argument('--data-dir', default=None,
+                        help='Where datasets are downloaded')
+    parser.add_argument('--output-dir', default='output',
+                        help='Where results and figures are written')
+    parser.add_argument('--checkpoint-dir', default='checkpoints',
+                        help='Where stage checkpoints are written')
+    parser.add_argument('--no-checkpoint', action='store_true',
+                        help='Recompute every stage, write no checkpoint')
+    parser.add_argument('--restart-from', choices=STAGES, default=None,
+                        help='Discard the checkpoints from this stage on')
+    parser.add_argument('--until', choices=STAGES, default=None,
+                        help='Stop after this stage')
+    parser.add_argument('--n-jobs', type=int, default=1,
+                        help='Number of worker processes')
+    parser.add_argument('--render-jobs', type=int, default=None,
+                        help='Number of processes rendering the figures. '
+                             'Default: number of CPUs')
+    parser.add_argument('--no-plots', action='store_true',
+                        help='Skip figure rendering')
+    parser.add_argument('--nested', action='store_true',
+                        help='Also choose hyper-parameters by nested '
+                             'cross-validation')
+    parser.add_argument('--out-of-core', action='store_true',
+                        help='Keep the runs on disk and stream them by '
+                             'blocks, for data larger than memory')
+    parser.add_argument('--memory', type=outofcore.parse_memory,
+                        default=None,
+                        help='Memory budget, e.g. 16G. Default: 75%% of RAM '
+                             'for batch, 25%% out of core')
+    parser.add_argument('--prefetch', type=int, default=2,
+                        help='Number of runs read ahead in the background, '
+                             '0 to read them in turn')
+    parser.add_argument('--io-workers', type=int, default=1,
+                        help='Number of threads reading and decompressing '
+                             'runs')
+    parser.add_argument('--reduction', choices=('pca', 'parcels'),
+                        default=None,
+                        help='Decode from the principal components of every '
+                             'training fold, or from the mean of every ROI')
+    parser.add_argument('--lags', type=int, nargs='+', default=None,
+                        metavar='LAG',
+                        help='Delays in scans between the stimuli and the '
+                             'BOLD response, several evenly spaced ones '
+                             'for a FIR model. Default: 3 for decoding, 2 '
+                             'for encoding')
+    parser.add_argument('--stability', type=int, default=0,
+                        metavar='N_RESAMPLES',
+                        help='Decoding: maps of the selection frequency and '
+                             'weight moments over resamples of the scans')
+    parser.add_argument('--resampling', choices=('subsample', 'bootstrap'),
+                        default='subsample',
+                        help='Half of the scans of each run, or a bootstrap '
+                             'sample of each run')
+    parser.add_argument('--resample-maps', action='store_true',
+                        help='With --stability, also write the weight maps '
+                             'of every resample')
+    parser.add_argument('--compress-maps', action='store_true',
+                        help='Write .nii.gz rather than .nii maps, '
+                             'compressed in the background')
+    parser.add_argument('--labels', default=None, metavar='PACK',
+                        help='Read the labels from a .npz file written by '
+                             'pack rather than from the CSV files')
+    parser.add_argument('--epi-mask', action='store_true',
+                        help='Compute the brain mask from the mean EPI of '
+                             'the runs rather than using the given one')
+    parser.add_argument('--interpolation', choices=('nearest', 'linear'),
+                        default=None,
+                        help='Resample the runs to the mask when their '
+                             'affine or shape differ, rather than failing')
+    parser.add_argument('--rsa', choices=('correlation', 'euclidean',
+                                          'crossnobis'), default=None,
+                        help='Decoding: dissimilarity matrices of the '
+                             'stimuli in the mask and every ROI, compared '
+                             'to models of the stimuli')
+    parser.add_argument('--searchlight', type=float, default=0,
+                        metavar='RADIUS',
+                        help='With --rsa, also compare the models in '
+                             'spheres of RADIUS mm around every voxel')
+    parser.add_argument('--bundle', default=None, metavar='MODEL',
+                        help='Decoding: refit MODEL (e.g. logR) on all the '
+                             'scans and save the decoders of all the pixels '
+                             'as a bundle')
+    return parser
+
+
+def check_stages(parser, args, names):
+    """Exit with a usage error if --restart-from or --until is not one of
+    the stage names of the pipeline built from args."""
+    for option, name in [('--restart-from', args.restart_from),
+                         ('--until', args.until)]:
+        if name is not None and name not in names:
+            parser.error('argument %s: this pipeline has no stage %r '
+                         '(choose from %s)'
+                         % (option, name, ', '.join(map(repr, names))))
+
+
+def execute(build, args, parser=None):
+    """Build a pipeline from parsed arguments and run it.
+
+    The stage options are checked against the pipeline if the parser of
+    the arguments is given.
+    """
+    pipe = build(args)
+    if parser is not None:
+        check_stages(parser, args, pipe.stage_names())
+    if args.restart_from is not None:
+        pipe.invalidate(args.restart_from)
+    skip = ['render'] if args.no_plots else []
+    return pipe.run(until=args.until, skip=skip)
+
+
+###############################################################################
+# Stages shared by the decoding and encoding analyses
+###############################################################################
+
+def epi_mask(func, pipe):
+    """Path of the brain mask computed from the runs func.
+
+    Masks are cached by the fingerprint of the runs next to the
+    checkpoints, or in the output directory without checkpoints.
+    """
+    import masking
+    if pipe.directory is not None:
+        directory = os.path.join(os.path.dirname(pipe.directory), 'masks')
+    else:
+        directory = os.path.join(pipe.options.get('output_dir', 'output'),
+                                 'masks')
+    return masking.cached_epi_mask(func, directory)
+
+
+def _fetch(data_dir):
+    import datasets
+    dataset = datasets.get_miyawaki(data_dir=data_dir)
+    # Keep only random runs
+    return dataset, dataset.func[12:], dataset.label[12:]
+
+
+def dataset_files(data_dir=None, packed_labels=None):
+    """Input files of the analyses, downloaded if missing.
+
+    Their fingerprint is a parameter of the fetch stage (see
+    preprocessing_stages): checkpoints computed from other files, or from
+    files modified since, are not reused. packed_labels replaces the
+    label files, see fetch_stage.
+    """
+    dataset, func, label = _fetch(data_dir)
+    if packed_labels is not None:
+        label = [packed_labels]
+    return func + label + [dataset.mask] + list(dataset.mask_roi)
+
+
+def fetch_stage(state, pipe):
+    dataset, func, label = _fetch(pipe.options.get('data_dir'))
+    if pipe.options.get('labels'):
+        # Bitpacked labels written by pack, read by labels.load
+        label = pipe.options['labels']
+    if pipe.options.get('epi_mask'):
+        dataset.mask = epi_mask(func, pipe)
+    return dict(dataset=dataset, func=func, label=label)
+
+
+def mask_stage(state, pipe):
+    import masking
+    mask_img = nibabel.load(state['dataset'].mask)
+    # The next runs are read while the current one is masked
+    loader = prefetch.prefetch_runs(state['func'], pipe.options)
+    runs = [masking.apply_mask(
+        img, mask_img, interpolation=pipe.options.get('interpolation'))
+        for img in loader]
+    loader.report()
+    return dict(runs=runs)
+
+
+def clean_stage(state, pipe):
+    import preprocess
+    return dict(runs=[preprocess.clean(x, **clean_params)
+                      for x in state['runs']])
+
+
+def preprocessing_stages(out_of_core=False, epi_mask=False,
+                         interpolation=None, inputs=()):
+    """fetch -> mask -> clean stages, common to all analyses.
+
+    Out of core, the masked and cleaned runs are stacked on disk rather
+    than kept in memory. With epi_mask, the brain mask is computed from
+    the runs when fetching them. With interpolation, runs whose geometry
+    differs from the mask are resampled to it (see masking.apply_mask).
+    inputs are the files read by the fetch stage, see dataset_files.
+    """
+    import masking
+    fetch_params = dict(inputs=masking.files_fingerprint(inputs))
+    if epi_mask:
+        fetch_params['epi_mask'] = True
+    fetch = Stage('fetch', fetch_stage, fetch_params)
+    mask_params = dict(interpolation=interpolation) if interpolation else {}
+    if out_of_core:
+        return [fetch,
+                Stage('mask', outofcore.mask_stage,
+                      dict(mask_params, out_of_core=True)),
+                Stage('clean', outofcore.clean_stage, dict(out_of_core=True))]
+    return [fetch,
+            Stage('mask', mask_stage, mask_params),
+            Stage('clean', clean_stage)]
+
+
+def pack_stage(state, pipe):
+    """Write the cleaned runs and their labels in one .npz file."""
+    output_dir = pipe.options.get('output_dir', 'output')
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+    import labels
+    path = os.path.join(output_dir, 'miyawaki_random.npz')
+    runs = state['runs']
+    # Labels are bitpacked, labels.load reads them back
+    _atomic_write(path, lambda f: np.savez(
+        f, X=np.vstack(runs), mask=state['dataset'].mask,
+        **labels.load(state['label']).packed()))
+    sys.stderr.write("Packed %d runs in %s\n" % (len(runs), path))
+    return dict(pack=path)
+
+
+def build_pack(args):
+    """Pipeline preprocessing the runs and packing them in one file."""
+    return Pipeline(
+        'pack', preprocessing_stages(epi_mask=args.epi_mask,
+                                     interpolation=args.interpolation,
+                                     inputs=dataset_files(args.data_dir,
+                                                          args.labels)) +
+        [Stage('pack', pack_stage)],
+        checkpoint_dir=None if args.no_checkpoint else args.checkpoint_dir,
+        options=vars(args))
+
@@ -0,0 +1,128 @@
+# *- encoding: utf-8 -*-
+"""
+Asynchronous loading of the runs
+
+Reading and inflating a .nii.gz run takes about as long as masking it.
+The runs are read ahead by background threads, at most ``depth`` runs
+ahead of the consumer, so that the next runs are decoded while the current
+one is masked. The time the consumer spends waiting for a run (the stall
+time) is reported: when it is high, more workers or a deeper queue help.
+
+The gzip files are read in one call and inflated by zlib, or by the
+faster igzip of python-isal when it is installed. Both release the GIL,
+so several workers decode several runs in parallel.
+"""
+
+import sys
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import nibabel
+
+import instrument
+
+try:
+    from isal import isal_zlib as _zlib
+except ImportError:
+    _zlib = zlib
+
+
+def gunzip(raw):
+    """Inflate gzip data, made of one or several members."""
+    chunks = []
+    while raw:
+        decompressor = _zlib.decompressobj(31)
+        chunks.append(decompressor.decompress(raw))
+        raw = decompressor.unused_data
+    return b''.join(chunks)
+
+
+def read_image(path):
+    """NIfTI image of path, with its data read in memory."""
+    with instrument.span('read_image', instrument.file_size(path)):
+        if path.endswith('.gz'):
+            with open(path, 'rb') as f:
+                img = nibabel.Nifti1Image.from_bytes(gunzip(f.read()))
+        else:
+            img = nibabel.load(path)
+        img = nibabel.Nifti1Image(np.asarray(img.get_data()), img.get_affine(),
+                                  img.header)
+    # Keeps the path of the image known; its bytes are counted here, not
+    # again by apply_mask
+    img.set_filename(path)
+    return img
+
+
+class Prefetcher(object):
+    """Iterate over load(item) for the items, loading ahead in threads.
+
+    Parameters
+    ----------
+    items: list
+        E.g. paths of the runs.
+
+    load: callable
+        Function loading an item, called in the worker threads.
+
+    depth: int
+        Maximum number of items loaded ahead of the consumer, which bounds
+        the memory used. With 0, items are loaded synchronously.
+
+    n_workers: int
+        Number of worker threads.
+
+    Attributes
+    ----------
+    stall_time: float
+        Seconds the consumer waited for items.
+    """
+
+    def __init__(self, items, load=read_image, depth=2, n_workers=1):
+        self.items = list(items)
+        self.load = load
+        self.depth = depth
+        self.n_workers = n_workers
+        self.stall_time = 0.
+
+    def __len__(self):
+        return len(self.items)
+
+    def __iter__(self):
+        self.stall_time = 0.
+        if self.depth < 1:
+            for item in self.items:
+                t0 = time.time()
+                value = self.load(item)
+                self.stall_time += time.time() - t0
+                yield value
+            return
+        with ThreadPoolExecutor(self.n_workers) as executor:
+            pending = []
+            for i, item in enumerate(self.items):
+                pending.append(executor.submit(self.load, item))
+                if len(pending) <= self.depth and i < len(self.items) - 1:
+                    continue
+                yield self._wait(pending.pop(0))
+            while pending:
+                yield self._wait(pending.pop(0))
+
+    def _wait(self, future):
+        t0 = time.time()
+        with instrument.span('prefetch_stall'):
+            value = future.result()
+        self.stall_time += time.time() - t0
+        return value
+
+    def report(self, name='runs'):
+        sys.stderr.write("Loaded %d %s, waited %.2fs for the disk\n"
+                         % (len(self), name, self.stall_time))
+
+
+def prefetch_runs(paths, options):
+    """Prefetcher of the runs, configured by the --prefetch and
+    --io-workers options."""
+    depth = options.get('prefetch')
+    return Prefetcher(paths, depth=2 if depth is None else depth,
+                      n_workers=options.get('io_workers') or 1)
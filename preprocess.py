@@ -4,6 +4,8 @@ import numpy as np
 from scipy import signal, stats, linalg
 from sklearn.utils import gen_even_slices
 
+import instrument
+
 np_version = distutils.version.LooseVersion(np.version.short_version).version
 
 def _standard(signals, detrend=False, normalize=True):
@@ -129,56 +131,63 @@ def clean(signals, detrend=True, standardize=True, confounds=None,
         # If confounds are to be removed, then force normalization to improve
         # matrix conditioning.
         normalize = True
-    signals = _standard(signals, normalize=normalize, detrend=detrend)
+    with instrument.span('detrend'):
+        signals = _standard(signals, normalize=normalize, detrend=detrend)
 
     # Remove confounds
     if confounds is not None:
-        if not isinstance(confounds, (list, tuple)):
-            confounds = (confounds, )
-
-        # Read confounds
-        all_confounds = []
-        for confound in confounds:
-            if isinstance(confound, str):
-                filename = confound
-                confound = np.genfromtxt(filename)
-                if np.isnan(confound.flat[0]):
-                    # There may be a header
-                    if np_version >= [1, 4, 0]:
-                        confound = np.genfromtxt(filename, skip_header=1)
-                    else:
-                        confound = np.genfromtxt(filename, skiprows=1)
-                if confound.shape[0] != signals.shape[0]:
-                    raise ValueError("Confound signal has an incorrect length")
-
-            elif isinstance(confound, np.ndarray):
-                if confound.ndim == 1:
-                    confound = np.atleast_2d(confound).T
-                elif confound.ndim != 2:
-                    raise ValueError("confound array has an incorrect number "
-                                     "of dimensions: %d" % confound.ndim)
-
-                if confound.shape[0] != signals.shape[0]:
-                    raise ValueError("Confound signal has an incorrect length")
-            else:
-                raise TypeError("confound has an unhandled type: %s"
-                                % confound.__class__)
-            all_confounds.append(confound)
-
-        # Restrict the signal to the orthogonal of the confounds
-        confounds = np.hstack(all_confounds)
-        del all_confounds
-        confounds = _standard(confounds, normalize=True, detrend=detrend)
-        Q = qr_economic(confounds)[0]
-        signals -= np.dot(Q, np.dot(Q.T, signals))
+        with instrument.span('confounds'):
+            if not isinstance(confounds, (list, tuple)):
+                confounds = (confounds, )
+
+            # Read confounds
+            all_confounds = []
+            for confound in confounds:
+                if isinstance(confound, str):
+                    filename = confound
+                    confound = np.genfromtxt(filename)
+                    if np.isnan(confound.flat[0]):
+                        # There may be a header
+                        if np_version >= [1, 4, 0]:
+                            confound = np.genfromtxt(filename, skip_header=1)
+                        else:
+                            confound = np.genfromtxt(filename, skiprows=1)
+                    if confound.shape[0] != signals.shape[0]:
+                        raise ValueError("Confound signal has an incorrect "
+                                         "length")
+
+                elif isinstance(confound, np.ndarray):
+                    if confound.ndim == 1:
+                        confound = np.atleast_2d(confound).T
+                    elif confound.ndim != 2:
+                        raise ValueError("confound array has an incorrect "
+                                         "number of dimensions: %d"
+                                         % confound.ndim)
+
+                    if confound.shape[0] != signals.shape[0]:
+                        raise ValueError("Confound signal has an incorrect "
+                                         "length")
+                else:
+                    raise TypeError("confound has an unhandled type: %s"
+                                    % confound.__class__)
+                all_confounds.append(confound)
+
+            # Restrict the signal to the orthogonal of the confounds
+            confounds = np.hstack(all_confounds)
+            del all_confounds
+            confounds = _standard(confounds, normalize=True, detrend=detrend)
+            Q = qr_economic(confounds)[0]
+            signals -= np.dot(Q, np.dot(Q.T, signals))
 
     if low_pass is not None or high_pass is not None:
-        signals = butterworth(signals, sampling_rate=1. / t_r,
-                              low_pass=low_pass, high_pass=high_pass)
+        with instrument.span('filter'):
+            signals = butterworth(signals, sampling_rate=1. / t_r,
+                                  low_pass=low_pass, high_pass=high_pass)
 
     if standardize:
-        signals = _standard(signals, normalize=True, detrend=False)
-        signals *= np.sqrt(signals.shape[0])  # for unit variance
+        with instrument.span('standardize'):
+            signals = _standard(signals, normalize=True, detrend=False)
+            signals *= np.sqrt(signals.shape[0])  # for unit variance
 
     return signals
 
@@ -0,0 +1,218 @@
+# *- encoding: utf-8 -*-
+"""
+Dimensionality reduction of the decoding design
+
+Hundreds of decoders are fitted on the same voxels: reducing them once
+per training fold makes every fit cheaper. Two reductions are available:
+
+  * randomized PCA, fitted on the training set of each fold;
+  * parcel averaging, the mean signal of each ROI of the dataset (visual
+    areas, eccentricity bands), applied by a sparse matrix.
+
+Projections are cached by (mask, fold), on disk next to the checkpoints,
+so the analyses and benchmarks sharing a mask reuse them.
+"""
+
+import os
+import pickle
+import hashlib
+
+import numpy as np
+import nibabel
+from scipy import sparse
+from sklearn.utils.extmath import randomized_svd
+
+import instrument
+
+METHODS = ('pca', 'parcels')
+
+
+class Projection(object):
+    """Linear map from voxels to a few features, Z = (X - mean) W^T.
+
+    Parameters
+    ----------
+    components: numpy.ndarray or scipy.sparse matrix
+        W, shape (n_features, n_voxels).
+
+    mean: numpy.ndarray, optional
+        Mean removed before projecting, shape (n_voxels,).
+    """
+
+    def __init__(self, components, mean=None):
+        self.components = components
+        self.mean = mean
+
+    @property
+    def n_features(self):
+        return self.components.shape[0]
+
+    def transform(self, X):
+        """Features of the rows of X, shape (n_samples, n_features)."""
+        if self.mean is not None:
+            X = X - self.mean
+        return np.asarray(self.components.dot(X.T).T)
+
+    def inverse_weights(self, coef):
+        """Voxel weights equivalent to weights on the features.
+
+        coef has shape (n_targets, n_features), the result
+        (n_targets, n_voxels), e.g. to display a decoder as a brain map.
+        """
+        return np.asarray(self.components.T.dot(np.asarray(coef).T).T)
+
+
+def randomized_pca(X, n_components, random_state=0):
+    """Projection on the first principal components of X."""
+    mean = X.mean(axis=0)
+    with instrument.span('randomized_pca'):
+        _, _, components = randomized_svd(X - mean, n_components,
+                                          random_state=random_state)
+    return Projection(components, mean)
+
+
+def parcel_averaging(roi_imgs, mask_img, n_lags=1):
+    """Sparse projection averaging the voxels of each ROI.
+
+    Parameters
+    ----------
+    roi_imgs: list of string or nibabel images
+        ROI masks, in the space of mask_img. ROIs may overlap; those
+        without any voxel of the mask are dropped.
+
+    mask_img: string or nibabel image
+        Mask of the analysed voxels.
+
+    n_lags: int
+        Number of lags of the design: the averaging is repeated on every
+        lag (block-diagonal matrix).
+    """
+    if isinstance(mask_img, str):
+        mask_img = nibabel.load(mask_img)
+    mask = mask_img.get_data() != 0
+    rows, columns, weights = [], [], []
+    for roi in roi_imgs:
+        if isinstance(roi, str):
+            roi = nibabel.load(roi)
+        if roi.shape[:3] != mask.shape[:3]:
+            raise ValueError('ROI of shape %s does not match the mask shape '
+                             '%s' % (roi.shape, mask.shape))
+        voxels = np.flatnonzero(roi.get_data()[mask] != 0)
+        if len(voxels) == 0:
+            continue
+        rows.append(np.repeat(len(rows), len(voxels)))
+        columns.append(voxels)
+        weights.append(np.repeat(1. / len(voxels), len(voxels)))
+    if not rows:
+        raise ValueError('No ROI overlaps the mask')
+    averaging = sparse.csr_matrix(
+        (np.concatenate(weights), (np.concatenate(rows),
+                                   np.concatenate(columns))),
+        shape=(len(rows), int(mask.sum())))
+    if n_lags > 1:
+        averaging = sparse.kron(sparse.identity(n_lags), averaging,
+                                format='csr')
+    return Projection(averaging)
+
+
+###############################################################################
+# Cache
+###############################################################################
+
+def digest(*parts):
+    """md5 of arrays, file contents (for existing paths) and values."""
+    md5 = hashlib.md5()
+    for part in parts:
+        if isinstance(part, np.ndarray):
+            md5.update(str((part.shape, part.dtype)).encode('utf-8'))
+            md5.update(np.ascontiguousarray(part).data)
+        elif isinstance(part, str) and os.path.isfile(part):
+            with open(part, 'rb') as f:
+                for chunk in iter(lambda: f.read(1 << 20), b''):
+                    md5.update(chunk)
+        else:
+            md5.update(repr(part).encode('utf-8'))
+    return md5.hexdigest()
+
+
+class ProjectionCache(object):
+    """Projections stored by key, in directory or in memory if None.
+
+    The memory cache belongs to the instance, and lives as long as it.
+    """
+
+    def __init__(self, directory=None):
+        self.directory = directory
+        self._memory = {}
+
+    def get(self, key, compute):
+        """Cached projection of key, computed by compute() if missing."""
+        if self.directory is None:
+            if key not in self._memory:
+                self._memory[key] = compute()
+            return self._memory[key]
+        path = os.path.join(self.directory, key + '.pkl')
+        if os.path.exists(path):
+            with open(path, 'rb') as f:
+                return pickle.load(f)
+        projection = compute()
+        if not os.path.exists(self.directory):
+            os.makedirs(self.directory)
+        with open(path + '.part', 'wb') as f:
+            pickle.dump(projection, f, protocol=-1)
+        os.replace(path + '.part', path)
+        return projection
+
+
+def fold_projections(X, trains, method, mask, rois=None, n_components=200,
+                     n_lags=1, cache=None):
+    """Projection of every training set.
+
+    Parameters
+    ----------
+    X: numpy.ndarray
+        Design, shape (n_samples, n_lags * n_voxels).
+
+    trains: list
+        Training rows of every fold (slices or index arrays).
+
+    method: 'pca' or 'parcels'
+
+    mask: string
+        Path of the mask of the voxels. With rois, it identifies the
+        parcels; PCA projections are also keyed by the data and fold.
+
+    rois: list of string, optional
+        ROI masks, required for parcel averaging.
+
+    n_components: int
+        Number of principal components.
+
+    n_lags: int
+        Number of lags of the design.
+
+    cache: ProjectionCache, optional
+
+    Returns
+    -------
+    projections: list of Projection
+    """
+    if method not in METHODS:
+        raise ValueError('Unknown reduction %r, expected one of %s'
+                         % (method, METHODS))
+    cache = cache or ProjectionCache()
+    with instrument.span('projections'):
+        if method == 'parcels':
+            if not rois:
+                raise ValueError('Parcel averaging needs the ROI masks of '
+                                 'the dataset (mask_roi)')
+            key = 'parcels_' + digest(mask, n_lags, *rois)
+            projection = cache.get(key, lambda: parcel_averaging(
+                rois, mask, n_lags=n_lags))
+            return [projection] * len(trains)
+        data_key = digest(mask, X)
+        indices = np.arange(len(X))
+        return [cache.get('pca_' + digest(data_key, n_components,
+                                          indices[train]),
+                          lambda: randomized_pca(X[train], n_components))
+                for train in trains]
@@ -0,0 +1,232 @@
+# *- encoding: utf-8 -*-
+"""
+Headless rendering of the figures saved in output/
+
+Figures are described as jobs (a plotting function and its arrays) and
+rendered with the non-interactive Agg backend, optionally in a process
+pool, so that the analysis scripts run on nodes without a display.
+"""
+
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import matplotlib as mpl
+mpl.use('Agg')
+from matplotlib import pyplot as plt
+from matplotlib.collections import LineCollection
+from matplotlib.colors import LinearSegmentedColormap, Normalize
+
+import instrument
+
+bluegreen = LinearSegmentedColormap('bluegreen', {
+    'red': ((0., 0., 0.),
+            (1., 0., 0.)),
+    'green': ((0., 0., 0.),
+              (1., 1., 1.)),
+    'blue': ((0., 0.2, 0.2),
+             (0.5, 0.5, 0.5),
+             (1., 0., 0.))
+    })
+
+_cmaps = {'bluegreen': bluegreen}
+
+
+def get_cmap(name):
+    """Colormap from its name, including the ones defined here."""
+    if name in _cmaps:
+        return _cmaps[name]
+    return plt.get_cmap(name)
+
+
+###############################################################################
+# Drawing primitives
+###############################################################################
+
+def contour_segments(mask):
+    """Segments of the edges between pixels of different mask values.
+
+    Parameters
+    ----------
+    mask: numpy.ndarray
+        2D boolean array, as displayed by imshow.
+
+    Returns
+    -------
+    segments: numpy.ndarray
+        Array of shape (n_edges, 2, 2) of (x, y) segment end points.
+    """
+    mask = np.asarray(mask, dtype=bool)
+    # Edges between rows i and i + 1
+    i, j = np.nonzero(mask[1:] != mask[:-1])
+    horizontal = np.empty((len(i), 2, 2))
+    horizontal[:, 0, 0] = j - .5
+    horizontal[:, 1, 0] = j + .5
+    horizontal[:, :, 1] = (i + .5)[:, np.newaxis]
+    # Edges between columns j and j + 1
+    i, j = np.nonzero(mask[:, 1:] != mask[:, :-1])
+    vertical = np.empty((len(i), 2, 2))
+    vertical[:, :, 0] = (j + .5)[:, np.newaxis]
+    vertical[:, 0, 1] = i - .5
+    vertical[:, 1, 1] = i + .5
+    return np.concatenate([horizontal, vertical])
+
+
+def plot_lines(mask, linewidth=3, color='b', ax=None):
+    """Draw the contour of mask as a single LineCollection."""
+    if ax is None:
+        ax = plt.gca()
+    lines = LineCollection(contour_segments(mask), colors=color,
+                           linewidths=linewidth)
+    ax.add_collection(lines)
+    return lines
+
+
+def _save(fig, paths):
+    for path in paths:
+        fig.savefig(path)
+    plt.close(fig)
+
+
+###############################################################################
+# Figures
+###############################################################################
+
+def brain_map(paths, bg, data, contour, cmap='bluegreen', vmin=None,
+              vmax=None, threshold=None, ticks=None, labelsize=32,
+              cbar_rect=(.1, .5, .05, .45), contour_color='r'):
+    """Axial slice of a map over the background anatomy, with colorbar.
+
+    Parameters
+    ----------
+    paths: list of string
+        Files the figure is saved to.
+
+    bg, data, contour: numpy.ndarray
+        2D slices of the background, the map and the contour mask, already
+        transposed for display.
+
+    threshold: float, optional
+        If given, values below threshold are hidden. Otherwise only zeros
+        are hidden.
+    """
+    fig = plt.figure(figsize=(8, 8))
+    ax1 = fig.add_axes([0., 0., 1., 1.])
+    ax1.imshow(bg, interpolation="nearest", cmap='gray', origin='lower')
+    if threshold is None:
+        data = np.ma.masked_equal(data, 0.)
+    else:
+        data = np.ma.masked_less(data, threshold)
+    im = ax1.imshow(data, interpolation="nearest", cmap=get_cmap(cmap),
+                    origin='lower', vmin=vmin, vmax=vmax)
+    plot_lines(contour, color=contour_color, ax=ax1)
+    ax1.axis('off')
+    ax2 = fig.add_axes(list(cbar_rect))
+    cb = fig.colorbar(im, cax=ax2)
+    cb.ax.yaxis.set_ticks_position('left')
+    cb.ax.yaxis.set_tick_params(labelcolor='white')
+    cb.ax.yaxis.set_tick_params(labelsize=labelsize)
+    if ticks is not None:
+        cb.set_ticks(ticks)
+    _save(fig, paths)
+
+
+def score_map(paths, scores, pixmask, vmin=.3, vmax=1., cmap='hot'):
+    """Per-pixel scores on the stimulus grid, chosen pixel outlined."""
+    fig = plt.figure(figsize=(8, 8))
+    ax = fig.add_axes([0., 0., 1., 1.])
+    ax.imshow(scores, interpolation="nearest", vmin=vmin, vmax=vmax,
+              cmap=get_cmap(cmap))
+    plot_lines(pixmask, linewidth=6, ax=ax)
+    ax.axis('off')
+    _save(fig, paths)
+
+
+def receptive_field(paths, rf, pixmask, vmax=.75, cmap='bluegreen'):
+    """Receptive field of a voxel on a black stimulus grid."""
+    fig = plt.figure(figsize=(8, 8))
+    ax = fig.add_axes([0., 0., 1., 1.])
+    ax.imshow(np.zeros_like(rf), vmin=0., vmax=1., cmap='gray')
+    ax.imshow(np.ma.masked_equal(rf, 0.), vmin=0., vmax=vmax,
+              interpolation="nearest", cmap=get_cmap(cmap))
+    plot_lines(pixmask, linewidth=6, color='r', ax=ax)
+    ax.axis('off')
+    _save(fig, paths)
+
+
+def colorbar(paths, cmap, vmin, vmax, ticks, figsize, adjust,
+             orientation='vertical'):
+    """Standalone colorbar, adjust holds the subplots_adjust parameters."""
+    fig = plt.figure(figsize=figsize)
+    cb = mpl.colorbar.ColorbarBase(fig.gca(), cmap=get_cmap(cmap),
+                                   norm=Normalize(vmin=vmin, vmax=vmax),
+                                   orientation=orientation)
+    cb.set_ticks(ticks)
+    fig.subplots_adjust(**adjust)
+    _save(fig, paths)
+
+
+###############################################################################
+# Job scheduling
+###############################################################################
+
+def _render_job(job):
+    func, paths, kwargs = job
+    with instrument.span(func.__name__):
+        func(paths, **kwargs)
+    return paths
+
+
+class Renderer(object):
+    """Collect figure jobs and render them, serially or in a process pool.
+
+    Parameters
+    ----------
+    output_dir: string
+        Directory the figures are written to.
+
+    formats: tuple of string
+        Default file formats, one file is written per format.
+
+    n_jobs: int, optional
+        Number of rendering processes. Default: number of CPUs.
+
+    enabled: bool
+        If False (the --no-plots mode), jobs are dropped.
+    """
+
+    def __init__(self, output_dir='output', formats=('pdf', 'png', 'eps'),
+                 n_jobs=None, enabled=True):
+        self.output_dir = output_dir
+        self.formats = formats
+        self.n_jobs = n_jobs or os.cpu_count() or 1
+        self.enabled = enabled
+        self.jobs = []
+
+    def submit(self, func, name, formats=None, **kwargs):
+        """Queue the figure func(paths, **kwargs) saved as name.<format>."""
+        if not self.enabled:
+            return
+        formats = formats or self.formats
+        paths = [os.path.join(self.output_dir, '%s.%s' % (name, fmt))
+                 for fmt in formats]
+        self.jobs.append((func, paths, kwargs))
+
+    def render(self):
+        """Render all queued figures and return the written paths."""
+        jobs, self.jobs = self.jobs, []
+        if not jobs:
+            return []
+        if not os.path.exists(self.output_dir):
+            os.makedirs(self.output_dir)
+        with instrument.span('render'):
+            n_jobs = min(self.n_jobs, len(jobs))
+            if n_jobs == 1:
+                results = [_render_job(job) for job in jobs]
+            else:
+                # The spans of the workers are merged in the profile
+                with ProcessPoolExecutor(n_jobs) as executor:
+                    results = [instrument.merge(result) for result in
+                               executor.map(instrument.remote(_render_job),
+                                            jobs)]
+        return [path for job_paths in results for path in job_paths]
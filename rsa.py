@@ -0,0 +1,486 @@
+# *- encoding: utf-8 -*-
+"""
+Representational similarity analysis of the stimuli
+
+The conditions are the distinct stimulus images of the design. The pattern
+of a condition is the mean of the rows of the design showing it, and a
+representational dissimilarity matrix (RDM) holds the distances between
+the patterns of all pairs of conditions, in condensed form (upper
+triangle, ordered as scipy.spatial.distance.pdist). Three distances are
+available:
+
+  * 'correlation': one minus the Pearson correlation of the patterns;
+  * 'euclidean': Euclidean distance of the patterns;
+  * 'crossnobis': cross-validated Mahalanobis distance. Patterns are
+    estimated in every run, whitened by the noise covariance of the
+    residuals (Ledoit-Wolf shrinkage, only its diagonal in large regions),
+    and the differences of patterns in one run are multiplied with those
+    of the other runs: noise averages out, and the expected distance of
+    identical conditions is zero.
+
+Correlation distances to a constant pattern are undefined (nan, as
+scipy.spatial.distance.pdist); the pairs of conditions undefined in a
+model RDM are left out of the comparisons.
+
+All the distances come from one matrix product per block of conditions,
+so the full condition-by-condition matrix is never held in memory. RDMs
+are computed per ROI or per searchlight, in a process pool sharing the
+patterns, and compared to model RDMs of the stimuli by Spearman
+correlation.
+"""
+
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+
+import numpy as np
+import nibabel
+from scipy import sparse
+from scipy.linalg import solve_triangular
+from scipy.spatial import cKDTree
+from scipy.stats import rankdata
+from sklearn.covariance import ledoit_wolf
+
+import instrument
+
+METRICS = ('correlation', 'euclidean', 'crossnobis')
+
+# Above this number of features, the noise covariance of crossnobis is
+# diagonal: the full matrix would take n_features ** 2 floats
+MAX_COVARIANCE_FEATURES = 2000
+
+
+###############################################################################
+# Conditions and patterns
+###############################################################################
+
+def stimulus_conditions(y):
+    """Condition of every row of the design: its distinct stimulus.
+
+    Parameters
+    ----------
+    y: numpy.ndarray
+        Flattened stimuli, shape (n_samples, n_pixels).
+
+    Returns
+    -------
+    conditions: numpy.ndarray
+        Index of the stimulus of every row, shape (n_samples,).
+
+    stimuli: numpy.ndarray
+        Distinct stimuli, shape (n_conditions, n_pixels).
+    """
+    stimuli, conditions = np.unique(y, axis=0, return_inverse=True)
+    return np.ravel(conditions), stimuli
+
+
+def common_conditions(conditions, groups):
+    """Rows whose condition is shown in every run, as a boolean mask."""
+    runs, run_index = np.unique(groups, return_inverse=True)
+    shown = np.zeros((len(runs), conditions.max() + 1), dtype=bool)
+    shown[run_index, conditions] = True
+    return shown.all(axis=0)[conditions]
+
+
+def condition_patterns(X, conditions, groups=None):
+    """Mean pattern of every condition, in every run.
+
+    Parameters
+    ----------
+    X: numpy.ndarray
+        Design, shape (n_samples, n_features).
+
+    conditions: numpy.ndarray
+        Condition of every row, from 0 to n_conditions - 1.
+
+    groups: numpy.ndarray, optional
+        Run of every row. If given, patterns are estimated in every run,
+        and the residuals of the rows around them are returned, for the
+        cross-validated distances.
+
+    Returns
+    -------
+    patterns: numpy.ndarray
+        Shape (n_runs, n_conditions, n_features), n_runs = 1 without
+        groups.
+
+    residuals: numpy.ndarray or None
+        Shape (n_samples, n_features), only with groups.
+    """
+    n_conditions = conditions.max() + 1
+    if groups is None:
+        partitions = np.zeros(len(conditions), dtype=int)
+    else:
+        partitions = np.unique(groups, return_inverse=True)[1].ravel()
+    n_partitions = partitions.max() + 1
+    # One sparse product averages the rows of all the cells
+    cells = partitions * n_conditions + conditions
+    counts = np.bincount(cells, minlength=n_partitions * n_conditions)
+    if np.any(counts == 0):
+        partition, condition = divmod(np.flatnonzero(counts == 0)[0],
+                                      n_conditions)
+        raise ValueError('Condition %d is not shown in run %d: keep the '
+                         'conditions of every run (see common_conditions)'
+                         % (condition, partition))
+    averaging = sparse.csr_matrix(
+        (1. / counts[cells], (cells, np.arange(len(cells)))),
+        shape=(len(counts), len(cells)))
+    with instrument.span('rsa_patterns'):
+        means = np.asarray(averaging.dot(X))
+        residuals = None
+        if groups is not None:
+            residuals = X - means[cells]
+    return (means.reshape(n_partitions, n_conditions, -1), residuals)
+
+
+###############################################################################
+# Distances
+###############################################################################
+
+def _condensed(A, B, block_size=256):
+    """Condensed matrix of norm_i + norm_j - 2 A_i.B_j, norm_i = A_i.B_i.
+
+    Rows are processed by blocks: each block is one matrix product with
+    the following rows.
+    """
+    n = len(A)
+    norms = np.einsum('ij,ij->i', A, B)
+    out = np.empty(n * (n - 1) // 2)
+    for start in range(0, n - 1, block_size):
+        stop = min(start + block_size, n - 1)
+        gram = np.dot(A[start:stop], B[start + 1:].T)
+        for i in range(start, stop):
+            offset = i * n - i * (i + 1) // 2
+            out[offset:offset + n - i - 1] = (
+                norms[i] + norms[i + 1:] - 2 * gram[i - start, i - start:])
+    return out
+
+
+def _standardize_rows(A):
+    A = A - A.mean(axis=1)[:, np.newaxis]
+    norms = np.sqrt(np.einsum('ij,ij->i', A, A))
+    # The correlation with a constant pattern is undefined
+    norms[norms == 0] = np.nan
+    return A / norms[:, np.newaxis]
+
+
+def pattern_rdm(patterns, metric='correlation', residuals=None,
+                block_size=256, max_features=MAX_COVARIANCE_FEATURES):
+    """RDM of condition patterns.
+
+    Parameters
+    ----------
+    patterns: numpy.ndarray
+        Shape (n_runs, n_conditions, n_features), see condition_patterns.
+        Runs are averaged for the correlation and Euclidean distances.
+
+    metric: 'correlation', 'euclidean' or 'crossnobis'
+
+    residuals: numpy.ndarray
+        Residuals of the rows, for the noise covariance of 'crossnobis'.
+
+    block_size: int
+        Number of conditions per matrix product.
+
+    max_features: int
+        With more features, 'crossnobis' only uses the variances of the
+        residuals, not their full covariance.
+
+    Returns
+    -------
+    rdm: numpy.ndarray
+        Condensed RDM, shape (n_conditions * (n_conditions - 1) / 2,).
+        Correlation distances involving a constant pattern are nan.
+    """
+    if metric not in METRICS:
+        raise ValueError('Unknown metric %r, expected one of %s'
+                         % (metric, METRICS))
+    if metric == 'correlation':
+        A = _standardize_rows(patterns.mean(axis=0))
+        # Squared distance of standardized rows is 2 - 2 r
+        return .5 * _condensed(A, A, block_size)
+    if metric == 'euclidean':
+        A = patterns.mean(axis=0)
+        return np.sqrt(np.maximum(_condensed(A, A, block_size), 0))
+
+    n_runs, _, n_features = patterns.shape
+    if n_runs < 2:
+        raise ValueError('Cross-validated distances need patterns of at '
+                         'least 2 runs, got %d' % n_runs)
+    if residuals is None:
+        raise ValueError('Cross-validated distances need the residuals')
+    if n_features <= max_features:
+        covariance = ledoit_wolf(residuals, assume_centered=True)[0]
+        # Whitened patterns L^-1 U^T, with covariance = L L^T
+        cholesky = np.linalg.cholesky(covariance)
+        whitened = solve_triangular(
+            cholesky, patterns.reshape(-1, n_features).T, lower=True)
+        whitened = whitened.T.reshape(patterns.shape)
+    else:
+        scale = np.sqrt(np.einsum('ij,ij->j', residuals, residuals) /
+                        len(residuals))
+        # Features without noise are left out
+        scale[scale == 0] = np.inf
+        whitened = patterns / scale
+    # Sum over pairs of different runs k, l of U_k U_l^T, as one product:
+    # S S^T - sum_k U_k U_k^T with S = sum_k U_k
+    total = whitened.sum(axis=0)
+    A = np.hstack([total] + list(whitened))
+    B = np.hstack([total] + list(-whitened))
+    return _condensed(A, B, block_size) / (n_runs * (n_runs - 1) *
+                                            n_features)
+
+
+def rdm(X, conditions, metric='correlation', groups=None, block_size=256):
+    """RDM of the conditions of the rows of X.
+
+    groups (the run of every row) is needed by the 'crossnobis' metric;
+    see condition_patterns and pattern_rdm.
+    """
+    if metric == 'crossnobis' and groups is None:
+        raise ValueError('Cross-validated distances need the runs')
+    patterns, residuals = condition_patterns(
+        X, conditions, groups if metric == 'crossnobis' else None)
+    return pattern_rdm(patterns, metric, residuals, block_size)
+
+
+def square(rdm):
+    """Square, symmetric form of a condensed RDM."""
+    n = int(round((1 + np.sqrt(1 + 8 * len(rdm))) / 2))
+    matrix = np.zeros((n, n))
+    matrix[np.triu_indices(n, 1)] = rdm
+    return matrix + matrix.T
+
+
+###############################################################################
+# Models and comparison
+###############################################################################
+
+def stimulus_rdms(stimuli, block_size=256):
+    """Model RDMs of the stimuli.
+
+    Returns
+    -------
+    names: list of string
+        'pixels' (fraction of differing pixels), 'correlation' (one minus
+        the correlation of the images) and 'luminance' (difference of the
+        fraction of lit pixels).
+
+    rdms: numpy.ndarray
+        Shape (3, n_pairs).
+    """
+    stimuli = np.asarray(stimuli, dtype=np.float64)
+    patterns = stimuli[np.newaxis]
+    luminance = stimuli.mean(axis=1)[:, np.newaxis]
+    rdms = np.vstack([
+        _condensed(stimuli, stimuli, block_size) / stimuli.shape[1],
+        pattern_rdm(patterns, 'correlation', block_size=block_size),
+        pattern_rdm(luminance[np.newaxis], 'euclidean',
+                    block_size=block_size)])
+    return ['pixels', 'correlation', 'luminance'], rdms
+
+
+def _ranks(rdms):
+    # Standardized ranks: Spearman correlation is then a dot product.
+    # RDMs with undefined distances have undefined correlations.
+    rdms = np.atleast_2d(rdms)
+    ranks = rankdata(rdms, axis=1)
+    ranks[~np.isfinite(rdms).all(axis=1)] = np.nan
+    return _standardize_rows(ranks)
+
+
+def _defined(models):
+    # Pairs of conditions with a distance in all the models
+    return np.isfinite(np.atleast_2d(models)).all(axis=0)
+
+
+def compare(rdms, models):
+    """Spearman correlation of RDMs with model RDMs.
+
+    Parameters
+    ----------
+    rdms: numpy.ndarray
+        Shape (n_rdms, n_pairs).
+
+    models: numpy.ndarray
+        Shape (n_models, n_pairs).
+
+    Returns
+    -------
+    correlations: numpy.ndarray, shape (n_rdms, n_models)
+        nan for the RDMs with undefined distances.
+    """
+    pairs = _defined(models)
+    return np.dot(_ranks(np.atleast_2d(rdms)[:, pairs]),
+                  _ranks(np.atleast_2d(models)[:, pairs]).T)
+
+
+###############################################################################
+# Regions
+###############################################################################
+
+def _lagged(voxels, n_voxels, n_lags):
+    # Columns of the voxels at every lag of the design
+    return (np.arange(n_lags)[:, np.newaxis] * n_voxels +
+            np.asarray(voxels)).ravel()
+
+
+def roi_regions(roi_imgs, mask_img, n_lags=1):
+    """Columns of the design in every ROI.
+
+    ROIs without any voxel of the mask are dropped.
+
+    Returns
+    -------
+    names: list of string
+        Names of the ROI files, 'roi<i>' for images.
+
+    regions: list of numpy.ndarray
+    """
+    if isinstance(mask_img, str):
+        mask_img = nibabel.load(mask_img)
+    mask = mask_img.get_data() != 0
+    n_voxels = int(mask.sum())
+    names, regions = [], []
+    for i, roi in enumerate(roi_imgs):
+        name = 'roi%d' % i
+        if isinstance(roi, str):
+            name = roi.split('/')[-1].split('.')[0]
+            roi = nibabel.load(roi)
+        if roi.shape[:3] != mask.shape[:3]:
+            raise ValueError('ROI of shape %s does not match the mask shape '
+                             '%s' % (roi.shape, mask.shape))
+        voxels = np.flatnonzero(roi.get_data()[mask] != 0)
+        if len(voxels):
+            names.append(name)
+            regions.append(_lagged(voxels, n_voxels, n_lags))
+    return names, regions
+
+
+def searchlight_regions(mask_img, radius, n_lags=1):
+    """Columns of the design in the sphere around every mask voxel.
+
+    Parameters
+    ----------
+    mask_img: string or nibabel image
+
+    radius: float
+        Radius of the spheres, in mm.
+
+    Returns
+    -------
+    regions: list of numpy.ndarray
+        One per voxel of the mask, in mask order.
+    """
+    if isinstance(mask_img, str):
+        mask_img = nibabel.load(mask_img)
+    mask = mask_img.get_data() != 0
+    ijk = np.array(np.nonzero(mask))
+    affine = mask_img.get_affine()
+    coords = (np.dot(affine[:3, :3], ijk) + affine[:3, 3:]).T
+    neighbours = cKDTree(coords).query_ball_point(coords, radius)
+    return [_lagged(np.sort(voxels), len(coords), n_lags)
+            for voxels in neighbours]
+
+
+# Patterns and residuals of the worker processes, in shared memory
+_shared = {}
+
+
+def _attach(specs):
+    for name, (shm_name, shape, dtype) in specs.items():
+        shm = shared_memory.SharedMemory(name=shm_name)
+        _shared[name + '_shm'] = shm
+        _shared[name] = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+
+
+def _region_rdms(regions, metric, models=None, block_size=256,
+                 patterns=None, residuals=None, pairs=None):
+    """RDMs of regions, or their correlations with the models (ranked, on
+    the pairs of conditions pairs).
+
+    With models, regions are processed by blocks of block_size, each
+    reduced to its correlations before the next: only block_size RDMs
+    are held at once.
+    """
+    if patterns is None:
+        patterns, residuals = _shared['patterns'], _shared.get('residuals')
+    results = []
+    step = len(regions) if models is None else block_size
+    for start in range(0, len(regions), step):
+        rdms = np.array([pattern_rdm(
+            patterns[:, :, columns], metric,
+            None if residuals is None else residuals[:, columns],
+            block_size) for columns in regions[start:start + step]])
+        if models is not None:
+            rdms = np.dot(_ranks(rdms[:, pairs]), models.T)
+        results.append(rdms)
+    return np.vstack(results)
+
+
+def region_rdms(patterns, regions, metric='correlation', residuals=None,
+                models=None, n_jobs=1, block_size=256):
+    """RDMs of many regions of the patterns.
+
+    Parameters
+    ----------
+    patterns, residuals: numpy.ndarray
+        See condition_patterns.
+
+    regions: list of numpy.ndarray
+        Columns of every region, see roi_regions and searchlight_regions.
+
+    metric: 'correlation', 'euclidean' or 'crossnobis'
+
+    models: numpy.ndarray, optional
+        Model RDMs. If given, the RDMs of the regions are not returned,
+        only their Spearman correlations with the models: for searchlights,
+        one RDM per voxel would not fit in memory.
+
+    n_jobs: int
+        Number of worker processes, sharing the patterns and residuals in
+        shared memory.
+
+    Returns
+    -------
+    rdms: numpy.ndarray
+        Shape (n_regions, n_pairs), or (n_regions, n_models) with models.
+    """
+    pairs = None
+    if models is not None:
+        pairs = _defined(models)
+        models = _ranks(np.atleast_2d(models)[:, pairs])
+    with instrument.span('rsa'):
+        if n_jobs == 1:
+            return _region_rdms(regions, metric, models, block_size,
+                                patterns, residuals, pairs)
+        arrays = dict(patterns=patterns)
+        if residuals is not None:
+            arrays['residuals'] = residuals
+        specs, blocks = {}, []
+        try:
+            for name, array in arrays.items():
+                array = np.ascontiguousarray(array)
+                shm = shared_memory.SharedMemory(create=True,
+                                                 size=max(array.nbytes, 1))
+                blocks.append(shm)
+                np.ndarray(array.shape, dtype=array.dtype,
+                           buffer=shm.buf)[...] = array
+                specs[name] = (shm.name, array.shape, array.dtype)
+            # Contiguous chunks of regions, a few per worker for balance
+            bounds = np.linspace(0, len(regions),
+                                 min(4 * n_jobs, len(regions)) + 1)
+            bounds = bounds.astype(int)
+            with ProcessPoolExecutor(n_jobs, initializer=_attach,
+                                     initargs=(specs, )) as executor:
+                task = instrument.remote(_region_rdms)
+                futures = [executor.submit(task, regions[start:stop], metric,
+                                           models, block_size, None, None,
+                                           pairs)
+                           for start, stop in zip(bounds[:-1], bounds[1:])
+                           if stop > start]
+                return np.vstack([instrument.merge(future.result())
+                                  for future in futures])
+        finally:
+            for shm in blocks:
+                shm.close()
+                shm.unlink()
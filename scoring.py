@@ -0,0 +1,143 @@
+# *- encoding: utf-8 -*-
+"""
+Voxel-wise scores of cross-validated predictions, computed from sums
+"""
+
+import functools
+
+import numpy as np
+from sklearn.utils import Bunch
+
+import instrument
+
+
+class _Accumulator(object):
+    """Running sum of vectors with Neumaier error compensation.
+
+    The compensation term keeps float32 sums accurate to roughly float32
+    precision whatever the number of blocks accumulated.
+    """
+
+    def __init__(self, shape, dtype, compensated=True):
+        self.total = np.zeros(shape, dtype=dtype)
+        self.compensated = compensated
+        if compensated:
+            self.error = np.zeros(shape, dtype=dtype)
+
+    def add(self, values):
+        if not self.compensated:
+            self.total += values
+            return
+        t = self.total + values
+        big = np.abs(self.total) >= np.abs(values)
+        self.error += np.where(big, (self.total - t) + values,
+                               (values - t) + self.total)
+        self.total = t
+
+    def value(self):
+        if self.compensated:
+            return self.total.astype(np.float64) + self.error
+        return self.total.astype(np.float64)
+
+
+def _as_indices(test, n_samples):
+    """Turn a slice, boolean mask or index array into an index array."""
+    if isinstance(test, slice):
+        return np.arange(n_samples)[test]
+    test = np.asarray(test)
+    if test.dtype == bool:
+        return np.where(test)[0]
+    return test
+
+
+def score_folds(y_true, predictions, folds, dtype=np.float64,
+                block_size=64):
+    """Voxel-wise R², Pearson r and explained variance of many folds and
+    models in one pass.
+
+    Scores are combined from the sums of y, y², p, p² and y*p accumulated
+    over blocks of test samples, so no full-size residual or centered
+    matrix is created. Both signals are shifted by the first test sample of
+    each fold before accumulation, which does not change the scores but
+    avoids catastrophic cancellation when forming the variances.
+
+    Parameters
+    ----------
+    y_true: numpy.ndarray
+        Observed signals, shape (n_samples, n_voxels).
+
+    predictions: list of lists of numpy.ndarray
+        predictions[m][f] holds the predictions of model m on the test set
+        of fold f, shape (n_test_samples, n_voxels).
+
+    folds: list
+        Test set of each fold, as index arrays, boolean masks or slices of
+        the rows of y_true.
+
+    dtype: numpy dtype, optional
+        Accumulation dtype. float32 halves the memory traffic; sums are then
+        error-compensated across blocks.
+
+    block_size: int, optional
+        Number of test samples processed at once.
+
+    Returns
+    -------
+    scores: Bunch
+        'r2', 'r' and 'explained_variance' cubes of shape
+        (n_models, n_folds, n_voxels), ready to be unmasked in bulk.
+    """
+    n_samples, n_voxels = y_true.shape
+    n_models, n_folds = len(predictions), len(folds)
+    for model_predictions in predictions:
+        if len(model_predictions) != n_folds:
+            raise ValueError("Expected %d folds of predictions, got %d"
+                             % (n_folds, len(model_predictions)))
+    compensated = np.dtype(dtype) != np.float64
+    acc = functools.partial(_Accumulator, n_voxels, dtype, compensated)
+
+    r2 = np.empty((n_models, n_folds, n_voxels))
+    r = np.empty((n_models, n_folds, n_voxels))
+    ev = np.empty((n_models, n_folds, n_voxels))
+
+    with instrument.span('score'):
+        for f, test in enumerate(folds):
+            test = _as_indices(test, n_samples)
+            n = float(len(test))
+            for pred in predictions:
+                if pred[f].shape != (len(test), n_voxels):
+                    raise ValueError('Prediction shape %s does not match the '
+                                     'test set shape %s' % (pred[f].shape,
+                                     (len(test), n_voxels)))
+            shift = np.asarray(y_true[test[0]], dtype=dtype)
+            s_y, s_yy = acc(), acc()
+            s_p = [acc() for _ in range(n_models)]
+            s_pp = [acc() for _ in range(n_models)]
+            s_yp = [acc() for _ in range(n_models)]
+
+            for start in range(0, len(test), block_size):
+                rows = test[start:start + block_size]
+                y = np.asarray(y_true[rows], dtype=dtype)
+                y -= shift
+                s_y.add(y.sum(axis=0))
+                s_yy.add(np.einsum('ij,ij->j', y, y))
+                for m, pred in enumerate(predictions):
+                    p = np.asarray(pred[f][start:start + block_size],
+                                   dtype=dtype) - shift
+                    s_p[m].add(p.sum(axis=0))
+                    s_pp[m].add(np.einsum('ij,ij->j', p, p))
+                    s_yp[m].add(np.einsum('ij,ij->j', y, p))
+
+            sy, syy = s_y.value(), s_yy.value()
+            ss_tot = syy - sy ** 2 / n
+            with np.errstate(divide='ignore', invalid='ignore'):
+                for m in range(n_models):
+                    sp, spp, syp = (s_p[m].value(), s_pp[m].value(),
+                                    s_yp[m].value())
+                    ss_res = syy - 2 * syp + spp
+                    ss_pp = spp - sp ** 2 / n
+                    r2[m, f] = 1. - ss_res / ss_tot
+                    r[m, f] = (syp - sy * sp / n) / np.sqrt(ss_tot * ss_pp)
+                    ev[m, f] = 1. - (ss_res - (sy - sp) ** 2 / n) / ss_tot
+
+    return Bunch(r2=r2, r=r, explained_variance=ev)
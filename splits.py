@@ -0,0 +1,126 @@
+# *- encoding: utf-8 -*-
+"""
+Cross-validation folds respecting the fMRI runs
+
+Consecutive scans of a run are autocorrelated: a fold testing on scans
+whose neighbours are in the training set gives inflated scores. Runs are
+kept whole, either one run per fold (leave-one-run-out) or a few
+consecutive runs per fold (grouped K-fold). As the runs are stacked in
+order, every test set is a contiguous slice of the data, and so is the
+training set of the first and last folds: indexing with them gives views,
+not copies. The folds are computed once and can be iterated as many times
+as needed, by the engines of this package or by scikit-learn.
+"""
+
+import numpy as np
+
+
+def run_blocks(groups):
+    """Start and stop of the blocks of equal consecutive groups.
+
+    Raises a ValueError if a group appears in several blocks, i.e. if the
+    samples are not ordered by run (for instance after a shuffle).
+    """
+    groups = np.asarray(groups)
+    if groups.ndim != 1 or len(groups) == 0:
+        raise ValueError('Expected a non-empty 1D array of groups, got '
+                         'shape %s' % (groups.shape, ))
+    change = np.flatnonzero(groups[1:] != groups[:-1]) + 1
+    starts = np.concatenate([[0], change])
+    stops = np.concatenate([change, [len(groups)]])
+    if len(np.unique(groups[starts])) != len(starts):
+        raise ValueError('Samples of a run are not contiguous: runs must be '
+                         'stacked in order and never shuffled, otherwise '
+                         'scans of a test run leak in the training set')
+    return starts, stops
+
+
+def run_split(groups, n_folds=None):
+    """RunSplit of n_folds folds, or of one fold per run if there are fewer
+    runs than n_folds."""
+    if n_folds is not None:
+        n_folds = min(n_folds, len(run_blocks(groups)[0]))
+    return RunSplit(groups, n_folds)
+
+
+class RunSplit(object):
+    """Leave-one-run-out or grouped K-fold cross-validation.
+
+    Iterating gives (train, test) pairs. test is a slice; train is a slice
+    when the test runs are at one end of the data, otherwise a
+    precomputed index array.
+
+    Parameters
+    ----------
+    groups: numpy.ndarray
+        Run of every sample, shape (n_samples,). Samples of a run must be
+        contiguous.
+
+    n_folds: int, optional
+        Number of folds, each testing on consecutive runs. Default: one
+        fold per run.
+    """
+
+    def __init__(self, groups, n_folds=None):
+        self.groups = np.asarray(groups)
+        starts, stops = run_blocks(self.groups)
+        n_runs = len(starts)
+        if n_folds is None:
+            n_folds = n_runs
+        if not 2 <= n_folds <= n_runs:
+            raise ValueError('Cannot make %s folds out of %d runs'
+                             % (n_folds, n_runs))
+        self.n_folds = n_folds
+        n_samples = len(self.groups)
+        bounds = np.linspace(0, n_runs, n_folds + 1).astype(int)
+        self.folds = []
+        for first, last in zip(bounds[:-1], bounds[1:]):
+            test = slice(starts[first], stops[last - 1])
+            if test.start == 0:
+                train = slice(test.stop, n_samples)
+            elif test.stop == n_samples:
+                train = slice(0, test.start)
+            else:
+                train = np.concatenate([np.arange(test.start),
+                                        np.arange(test.stop, n_samples)])
+            self.folds.append((train, test))
+        # Index arrays handed to scikit-learn, computed once
+        indices = np.arange(n_samples)
+        self.indices = [(indices[train], indices[test])
+                        for train, test in self.folds]
+
+    def __iter__(self):
+        return iter(self.folds)
+
+    def __len__(self):
+        return self.n_folds
+
+    def __repr__(self):
+        return '%s(n_runs=%d, n_folds=%d)' % (
+            self.__class__.__name__, len(run_blocks(self.groups)[0]),
+            self.n_folds)
+
+    @property
+    def tests(self):
+        """Test slice of every fold."""
+        return [test for _, test in self.folds]
+
+    def inner(self, train, n_folds=None):
+        """Folds of the runs of one training set, in its own coordinates.
+
+        The training data, once taken with X[train], is split again
+        without mixing runs, e.g. for nested cross-validation. There are
+        at most as many folds as runs in the training set.
+        """
+        return run_split(self.groups[train], n_folds)
+
+    # scikit-learn splitter interface
+
+    def get_n_splits(self, X=None, y=None, groups=None):
+        return self.n_folds
+
+    def split(self, X=None, y=None, groups=None):
+        if X is not None and len(X) != len(self.groups):
+            raise ValueError('Splitter built for %d samples, got %d'
+                             % (len(self.groups), len(X)))
+        return iter(self.indices)
@@ -0,0 +1,202 @@
+# *- encoding: utf-8 -*-
+"""
+Stability of decoder weights under resampling of the scans
+
+Sparse (L1) weights change from one fit to another. The decoders are
+refitted on many resamples of the scans, drawn within every run (half of
+the scans of each run for stability selection, or a bootstrap sample of
+each run), and the maps summarize all the fits: how often each voxel is
+selected, and the mean and standard deviation of its weight.
+
+The coefficient vectors are not kept in memory. Each worker updates
+running moments fit after fit, and the moments of the workers are merged
+at the end; the weight maps of the fits can also be written to a NIfTI
+file on disk (see volumes.MapWriter). The design lives once in shared
+memory, where every worker of the process pool reads it.
+"""
+
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+
+import numpy as np
+from sklearn.base import clone
+
+import instrument
+import splits
+
+METHODS = ('subsample', 'bootstrap')
+
+
+def draw_resample(starts, stops, seed, method='subsample'):
+    """Indices of one resample, drawn in every run.
+
+    Parameters
+    ----------
+    starts, stops: numpy.ndarray
+        Bounds of the runs, see splits.run_blocks.
+
+    seed: int
+        Seed of the resample: the same seed draws the same indices.
+
+    method: 'subsample' or 'bootstrap'
+        Half of the scans of each run without replacement, or as many scans
+        as the run with replacement.
+    """
+    if method not in METHODS:
+        raise ValueError('Unknown resampling %r, expected one of %s'
+                         % (method, METHODS))
+    rng = np.random.RandomState(seed)
+    indices = []
+    for start, stop in zip(starts, stops):
+        if method == 'bootstrap':
+            indices.append(rng.randint(start, stop, stop - start))
+        else:
+            indices.append(start + np.sort(rng.permutation(stop - start)
+                                           [:(stop - start) // 2]))
+    return np.concatenate(indices)
+
+
+class WeightMoments(object):
+    """Selection counts and running mean and variance of weight vectors.
+
+    Updated one vector at a time (Welford), and merged with the moments of
+    other vectors (Chan et al.).
+    """
+
+    def __init__(self, n_features):
+        self.n = 0
+        self.selected = np.zeros(n_features)
+        self.mean = np.zeros(n_features)
+        self.m2 = np.zeros(n_features)
+
+    def update(self, coef):
+        self.n += 1
+        self.selected += coef != 0
+        delta = coef - self.mean
+        self.mean += delta / self.n
+        self.m2 += delta * (coef - self.mean)
+
+    def merge(self, other):
+        n = self.n + other.n
+        if n == 0:
+            return self
+        delta = other.mean - self.mean
+        self.m2 += other.m2 + delta ** 2 * self.n * other.n / n
+        self.mean += delta * other.n / n
+        self.selected += other.selected
+        self.n = n
+        return self
+
+    @property
+    def frequency(self):
+        return self.selected / max(self.n, 1)
+
+    @property
+    def std(self):
+        return np.sqrt(self.m2 / max(self.n - 1, 1))
+
+    def maps(self):
+        """Selection frequency, mean and std, shape (3, n_features)."""
+        return np.vstack([self.frequency, self.mean, self.std])
+
+
+# Design of the worker processes, attached to the shared memory
+_shared = {}
+
+
+def _attach(name, shape, dtype):
+    shm = shared_memory.SharedMemory(name=name)
+    _shared['shm'] = shm
+    _shared['X'] = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+
+
+def _fit_resamples(estimator, y, starts, stops, seeds, method, writer=None,
+                   first_seed=0, X=None):
+    """Moments of the weights of the fits on the resamples of seeds.
+
+    With a volumes.MapWriter, the weights of every fit are also written,
+    n_lags maps per resample, resample seed - first_seed first.
+    """
+    if X is None:
+        X = _shared['X']
+    moments = None
+    for seed in seeds:
+        indices = draw_resample(starts, stops, seed, method)
+        with instrument.span('estimator_fit'):
+            est = clone(estimator).fit(X[indices], y[indices])
+        coef = np.ravel(est.coef_)
+        if moments is None:
+            moments = WeightMoments(len(coef))
+        moments.update(coef)
+        if writer is not None:
+            coef = coef.reshape(-1, len(writer.voxels))
+            writer.write((seed - first_seed) * len(coef), coef)
+    if writer is not None:
+        writer.flush()
+    return moments
+
+
+def stability_maps(estimator, X, y, groups, n_resamples=100,
+                   method='subsample', n_jobs=1, random_state=0, writer=None):
+    """Selection frequency and weight moments of a decoder over resamples.
+
+    Parameters
+    ----------
+    estimator: sklearn estimator
+        Linear model with a coef_ attribute after fitting.
+
+    X: numpy.ndarray
+        Design, shape (n_samples, n_features).
+
+    y: numpy.ndarray
+        Target, shape (n_samples,).
+
+    groups: numpy.ndarray
+        Run of every sample, runs being contiguous.
+
+    n_resamples: int
+
+    method: 'subsample' or 'bootstrap'
+        See draw_resample.
+
+    n_jobs: int
+        Number of worker processes, sharing X in shared memory.
+
+    random_state: int
+        Seed of the first resample, the others follow.
+
+    writer: volumes.MapWriter, optional
+        Receives the weight maps of every fit, n_resamples * n_lags maps,
+        written by the workers to the same file.
+
+    Returns
+    -------
+    maps: numpy.ndarray, shape (3, n_features)
+        Selection frequency, mean and standard deviation of the weights.
+    """
+    starts, stops = splits.run_blocks(groups)
+    seeds = random_state + np.arange(n_resamples)
+    with instrument.span('stability'):
+        if n_jobs == 1:
+            return _fit_resamples(estimator, y, starts, stops, seeds, method,
+                                  writer, random_state, X=X).maps()
+        X = np.ascontiguousarray(X)
+        shm = shared_memory.SharedMemory(create=True, size=max(X.nbytes, 1))
+        try:
+            np.ndarray(X.shape, dtype=X.dtype, buffer=shm.buf)[...] = X
+            with ProcessPoolExecutor(
+                    n_jobs, initializer=_attach,
+                    initargs=(shm.name, X.shape, X.dtype)) as executor:
+                task = instrument.remote(_fit_resamples)
+                futures = [executor.submit(task, estimator, y, starts, stops,
+                                           chunk, method, writer,
+                                           random_state)
+                           for chunk in np.array_split(seeds, n_jobs)
+                           if len(chunk)]
+                moments = instrument.merge(futures[0].result())
+                for future in futures[1:]:
+                    moments.merge(instrument.merge(future.result()))
+        finally:
+            shm.close()
+            shm.unlink()
+        return moments.maps()
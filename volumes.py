@@ -0,0 +1,163 @@
+# *- encoding: utf-8 -*-
+"""
+NIfTI volumes of many maps, written through a memory map
+
+Score and weight maps are computed in masked space, one vector of voxels
+per map. MapWriter scatters them into a 4D volume (x, y, z, n_maps) on
+disk, with the affine of the mask. The uncompressed NIfTI file is created
+at its final size and memory-mapped, so maps are written one at a time or
+by blocks, without ever holding all of them in memory. A writer sent to
+worker processes reopens the same file, and they write different maps of
+it. If the path ends with .gz, the file is compressed when closed, in a
+background thread.
+"""
+
+import os
+import gzip
+import shutil
+import threading
+
+import numpy as np
+import nibabel
+
+# Header and empty extension flag of a single file NIfTI-1
+_DATA_OFFSET = 352
+
+
+def _compress(source, path):
+    with open(source, 'rb') as f_in:
+        with gzip.open(path + '.part', 'wb', compresslevel=6) as f_out:
+            shutil.copyfileobj(f_in, f_out, 1 << 24)
+    os.replace(path + '.part', path)
+    os.remove(source)
+
+
+class MapWriter(object):
+    """4D NIfTI file receiving masked maps.
+
+    Parameters
+    ----------
+    path: string
+        .nii or .nii.gz file.
+
+    mask_img: string or nibabel image
+        Mask of the voxels of the maps, giving the shape and affine.
+
+    n_maps: int
+
+    dtype: numpy dtype
+    """
+
+    def __init__(self, path, mask_img, n_maps, dtype=np.float32):
+        if isinstance(mask_img, str):
+            mask_img = nibabel.load(mask_img)
+        mask = mask_img.get_data() != 0
+        self.path = path
+        self.shape = mask.shape[:3] + (int(n_maps),)
+        # NIfTI data is in Fortran order: every map is a contiguous block
+        self.voxels = np.ravel_multi_index(np.nonzero(mask), mask.shape[:3],
+                                           order='F')
+        self.dtype = np.dtype(dtype)
+        self.thread = None
+
+        header = nibabel.Nifti1Header()
+        header.set_data_shape(self.shape)
+        header.set_data_dtype(self.dtype)
+        header.set_data_offset(_DATA_OFFSET)
+        header.set_qform(mask_img.get_affine(), code='aligned')
+        header.set_sform(mask_img.get_affine(), code='aligned')
+        directory = os.path.dirname(path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        with open(self._data_path, 'wb') as f:
+            f.write(header.binaryblock)
+            f.write(b'\0' * (_DATA_OFFSET - len(header.binaryblock)))
+            # Sparse file: unwritten maps read as zeros
+            f.truncate(_DATA_OFFSET + self.dtype.itemsize *
+                       int(np.prod(self.shape)))
+        self._open()
+
+    @property
+    def _data_path(self):
+        # Written uncompressed under a temporary name until closed
+        return (self.path[:-3] if self.path.endswith('.gz')
+                else self.path) + '.part'
+
+    def _open(self):
+        self.maps = np.memmap(self._data_path, dtype=self.dtype, mode='r+',
+                              offset=_DATA_OFFSET,
+                              shape=(self.shape[3],
+                                     int(np.prod(self.shape[:3]))))
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['maps'] = state['thread'] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._open()
+
+    def write(self, index, maps):
+        """Write masked maps, of shape (n_voxels,) or (n, n_voxels), from
+        map index on."""
+        maps = np.atleast_2d(maps)
+        self.maps[index:index + len(maps), self.voxels] = maps
+        return self
+
+    def flush(self):
+        self.maps.flush()
+
+    def close(self, wait=False):
+        """Finish the file; .gz files are compressed in the background
+        unless wait is True."""
+        self.maps.flush()
+        self.maps = None
+        if not self.path.endswith('.gz'):
+            os.replace(self._data_path, self.path)
+            return self.path
+        self.thread = threading.Thread(target=_compress,
+                                       args=(self._data_path, self.path))
+        self.thread.start()
+        if wait:
+            self.wait()
+        return self.path
+
+    def wait(self):
+        """Wait for the background compression, if any."""
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        if self.maps is not None:
+            self.close()
+        return False
+
+
+def map_path(directory, name, options):
+    """Path of the maps called name, compressed with the --compress-maps
+    option."""
+    return os.path.join(directory, name + ('.nii.gz'
+                                           if options.get('compress_maps')
+                                           else '.nii'))
+
+
+def write_maps(path, maps, mask_img, dtype=np.float32, block_size=256):
+    """Write masked maps, shape (n_maps, n_voxels), by blocks of maps.
+
+    maps may be memory-mapped: only block_size maps are read at once.
+
+    Returns
+    -------
+    writer: MapWriter
+        Closed writer, whose wait method waits for the compression.
+    """
+    writer = MapWriter(path, mask_img, len(maps), dtype)
+    for start in range(0, len(maps), block_size):
+        writer.write(start, np.asarray(maps[start:start + block_size]))
+    writer.close()
+    return writer